@@ -6,6 +6,8 @@ from flask_socketio import SocketIO
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from fanout import create_client_manager
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 
@@ -28,13 +30,101 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 # File upload configuration
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Chat attachments are streamed to disk, so they may exceed MAX_CONTENT_LENGTH. Partial
+# uploads live outside UPLOAD_FOLDER so they are never served, see uploads.py.
+app.config['ATTACHMENT_MAX_SIZE'] = int(os.environ.get("ATTACHMENT_MAX_SIZE", 2 * 1024 * 1024 * 1024))  # 2GB
+app.config['UPLOAD_CHUNK_MAX_SIZE'] = int(os.environ.get("UPLOAD_CHUNK_MAX_SIZE", 8 * 1024 * 1024))  # 8MB
+app.config['UPLOAD_TMP_FOLDER'] = os.environ.get("UPLOAD_TMP_FOLDER", "uploads_tmp")
+app.config['UPLOAD_SESSION_TTL'] = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))  # seconds
+
+# Content-addressed media storage, see media_store.py. MEDIA_BACKEND is "local" or "s3";
+# MEDIA_S3_ENDPOINT_URL points the s3 backend at a compatible server such as MinIO.
+app.config['MEDIA_BACKEND'] = os.environ.get("MEDIA_BACKEND", "local")
+app.config['MEDIA_ROOT'] = os.environ.get("MEDIA_ROOT", os.path.join(app.config['UPLOAD_FOLDER'], 'media'))
+app.config['MEDIA_S3_BUCKET'] = os.environ.get("MEDIA_S3_BUCKET")
+app.config['MEDIA_S3_ENDPOINT_URL'] = os.environ.get("MEDIA_S3_ENDPOINT_URL")
+app.config['MEDIA_GC_GRACE_PERIOD'] = int(os.environ.get("MEDIA_GC_GRACE_PERIOD", 3600))  # seconds
+# Processes rendering resized image variants; 0 disables variants
+app.config['MEDIA_VARIANT_WORKERS'] = int(os.environ.get("MEDIA_VARIANT_WORKERS", 2))
+# Let a front proxy send media bytes: "nginx" (X-Accel-Redirect to MEDIA_ACCEL_PREFIX, an
+# internal location aliased to UPLOAD_FOLDER) or "sendfile" (X-Sendfile). Empty serves from Python.
+app.config['MEDIA_ACCEL_MODE'] = os.environ.get("MEDIA_ACCEL_MODE", "")
+app.config['MEDIA_ACCEL_PREFIX'] = os.environ.get("MEDIA_ACCEL_PREFIX", "/internal-uploads/")
+
+# Expired stories are deleted by the sweep-stories command, see commands.py
+app.config['STORY_SWEEP_BATCH_SIZE'] = int(os.environ.get("STORY_SWEEP_BATCH_SIZE", 500))
+# Seconds a viewer's first story feed page stays cached for /api/stories
+app.config['STORY_FEED_CACHE_TTL'] = int(os.environ.get("STORY_FEED_CACHE_TTL", 60))
+
+# Presence configuration: last-seen values are flushed to the database in batches
+app.config['PRESENCE_FLUSH_INTERVAL'] = int(os.environ.get("PRESENCE_FLUSH_INTERVAL", 15))  # seconds
+app.config['PRESENCE_MIN_CHANGE'] = int(os.environ.get("PRESENCE_MIN_CHANGE", 60))  # seconds
+# With Redis, connections of a worker that stops heartbeating for this long no longer count
+app.config['PRESENCE_WORKER_TTL'] = int(os.environ.get("PRESENCE_WORKER_TTL", 30))  # seconds
+
+# Typing indicators are sent as one digest per room every interval; a typing
+# state that is not refreshed within the TTL expires
+app.config['TYPING_DIGEST_INTERVAL'] = float(os.environ.get("TYPING_DIGEST_INTERVAL", 0.5))  # seconds
+app.config['TYPING_TTL'] = float(os.environ.get("TYPING_TTL", 6))  # seconds
+
+# Opt-in request/event instrumentation, see metrics.py. The sample rate is the
+# fraction of requests and events whose cost is recorded.
+app.config['METRICS_ENABLED'] = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+app.config['METRICS_SAMPLE_RATE'] = float(os.environ.get("METRICS_SAMPLE_RATE", 0.1))
+
+# Socket.IO configuration. Setting REDIS_URL enables scale-out mode: events are
+# relayed through Redis so emits reach clients connected to any worker.
+app.config['REDIS_URL'] = os.environ.get("REDIS_URL")
+app.config['SOCKETIO_ASYNC_MODE'] = os.environ.get("SOCKETIO_ASYNC_MODE", "threading")  # threading, eventlet, gevent
+# Long-polling needs every request of a session to reach the same worker. Without a
+# sticky load balancer, scale-out mode falls back to WebSocket-only transport.
+app.config['SOCKETIO_STICKY_SESSIONS'] = os.environ.get("SOCKETIO_STICKY_SESSIONS", "true").lower() == "true"
+if app.config['REDIS_URL'] and not app.config['SOCKETIO_STICKY_SESSIONS']:
+    app.config['SOCKETIO_TRANSPORTS'] = ['websocket']
+else:
+    app.config['SOCKETIO_TRANSPORTS'] = ['polling', 'websocket']
+
+# Seconds a user's identity fields stay cached for Flask-Login, see user_cache.py
+app.config['USER_CACHE_TTL'] = int(os.environ.get("USER_CACHE_TTL", 30))
+# Seconds a (user, group) membership lookup stays cached, see membership_cache.py
+app.config['MEMBERSHIP_CACHE_TTL'] = int(os.environ.get("MEMBERSHIP_CACHE_TTL", 300))
+
+# Write-behind mode for socket messages: broadcast first, then insert in batches
+app.config['MESSAGE_WRITE_BEHIND'] = os.environ.get("MESSAGE_WRITE_BEHIND", "false").lower() == "true"
+app.config['MESSAGE_WRITE_BATCH_SIZE'] = int(os.environ.get("MESSAGE_WRITE_BATCH_SIZE", 200))
+app.config['MESSAGE_WRITE_INTERVAL'] = float(os.environ.get("MESSAGE_WRITE_INTERVAL", 0.05))  # seconds
+# Message ids reserved per sequence call; above 1, ids of different workers are no longer in send order
+app.config['MESSAGE_ID_BLOCK_SIZE'] = int(os.environ.get("MESSAGE_ID_BLOCK_SIZE", 1))
+
+# Compact socket events, see wire.py: short keys, epoch timestamps and sender ids
+# that clients resolve from /api/users/directory instead of names and images
+app.config['SOCKET_COMPACT_EVENTS'] = os.environ.get("SOCKET_COMPACT_EVENTS", "false").lower() == "true"
+
+# Broadcast fan-out, see fanout.py: broadcasts to at least FANOUT_QUEUE_THRESHOLD
+# clients are sent by a background task in batches; clients with more than
+# FANOUT_MAX_BACKLOG unsent packets are treated as slow consumers
+app.config['FANOUT_BATCH_SIZE'] = int(os.environ.get("FANOUT_BATCH_SIZE", 500))
+app.config['FANOUT_QUEUE_THRESHOLD'] = int(os.environ.get("FANOUT_QUEUE_THRESHOLD", 100))
+app.config['FANOUT_MAX_BACKLOG'] = int(os.environ.get("FANOUT_MAX_BACKLOG", 1000))
 
 # Initialize extensions
 db = SQLAlchemy(app, model_class=Base)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+    client_manager=create_client_manager(
+        app.config['REDIS_URL'],
+        batch_size=app.config['FANOUT_BATCH_SIZE'],
+        queue_threshold=app.config['FANOUT_QUEUE_THRESHOLD'],
+        max_backlog=app.config['FANOUT_MAX_BACKLOG']
+    ),
+    transports=app.config['SOCKETIO_TRANSPORTS']
+)
 
 # Create upload directory if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['UPLOAD_TMP_FOLDER'], exist_ok=True)
 
 # Create tables
 with app.app_context():
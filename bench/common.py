@@ -0,0 +1,48 @@
+"""Shared setup for the benchmark scripts in this directory.
+
+Each script boots the application the way main.py does, configured from the
+environment. Without DATABASE_URL it runs against a temporary SQLite file;
+point DATABASE_URL at a scratch Postgres database to measure production
+behaviour, never at a database you care about, since the scripts seed it.
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def boot(**config):
+    """Import and return the app. Keyword arguments are set as environment variables first."""
+    scratch = tempfile.mkdtemp(prefix='prochat-bench-')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(scratch, 'bench.db'))
+    os.environ.setdefault('SESSION_SECRET', 'bench')
+    os.environ.setdefault('UPLOAD_TMP_FOLDER', os.path.join(scratch, 'uploads_tmp'))
+    for name, value in config.items():
+        os.environ[name] = str(value)
+    sys.path.insert(0, ROOT)
+
+    logging.disable(logging.INFO)
+    from main import app
+    return app
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def timed(fn, repeat):
+    """Run fn repeat times; returns the duration of each call in seconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def report(label, durations, unit='ms'):
+    scale = 1000 if unit == 'ms' else 1_000_000
+    print(f"{label:<44} median {percentile(durations, 50) * scale:9.2f}{unit}  "
+          f"p99 {percentile(durations, 99) * scale:9.2f}{unit}")
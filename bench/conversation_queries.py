@@ -0,0 +1,103 @@
+"""Conversation page queries against a seeded message table.
+
+Seeds --messages messages spread over direct chats and groups, then times
+the queries behind direct_chat, group_detail and the unread counters in
+two forms: the original sender/recipient and group_id filters, and the
+conversation_key filters backed by the composite indexes. --drop-indexes
+removes the indexes added for conversation keys first, to see the
+original plans on the same data.
+
+    python bench/conversation_queries.py --messages 2000000
+    DATABASE_URL=postgresql://localhost/prochat_bench python bench/conversation_queries.py
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from common import boot, report, timed
+
+NEW_INDEXES = ('ix_message_conversation_timestamp', 'ix_message_conversation_id',
+               'ix_message_sender_timestamp', 'ix_message_recipient_read')
+PAGE_SIZE = 50
+
+def seed(db, User, Group, Message, users, groups, messages, batch_size=20000):
+    db.session.execute(db.insert(User), [
+        {'username': f'bench{i}', 'email': f'bench{i}@example.com', 'password_hash': '-'} for i in range(users)
+    ])
+    db.session.execute(db.insert(Group), [{'name': f'group {i}', 'created_by': 1} for i in range(groups)])
+    db.session.commit()
+
+    start = datetime.utcnow() - timedelta(days=365)
+    rows = []
+    for i in range(messages):
+        sender = random.randint(1, users)
+        row = {'content': f'message {i}', 'sender_id': sender, 'message_type': 'text',
+               'timestamp': start + timedelta(seconds=i * 10)}
+        if i % 3 == 0:
+            row['group_id'] = random.randint(1, groups)
+            row['conversation_key'] = f"group_{row['group_id']}"
+        else:
+            recipient = random.randint(1, users)
+            row['recipient_id'] = recipient
+            row['conversation_key'] = f'user_{min(sender, recipient)}_{max(sender, recipient)}'
+            row['read_at'] = row['timestamp'] if random.random() < 0.9 else None
+        rows.append(row)
+        if len(rows) == batch_size:
+            db.session.execute(db.insert(Message), rows)
+            db.session.commit()
+            rows = []
+    if rows:
+        db.session.execute(db.insert(Message), rows)
+        db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--drop-indexes', action='store_true', help='Drop the conversation key indexes first')
+    args = parser.parse_args()
+
+    app = boot()
+    from sqlalchemy import and_, desc, func, or_, text
+    from app import db
+    from models import User, Group, Message
+
+    with app.app_context():
+        print(f"Seeding {args.messages:,} messages ({db.engine.dialect.name})")
+        seed(db, User, Group, Message, args.users, args.groups, args.messages)
+        if args.drop_indexes:
+            for name in NEW_INDEXES:
+                db.session.execute(text(f'DROP INDEX IF EXISTS {name}'))
+            db.session.commit()
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+
+        a, b = 1, 2
+        group_id = 1
+        newest_first = (desc(Message.timestamp), desc(Message.id))
+        queries = {
+            'direct chat page, sender/recipient filter': lambda: Message.query.filter(or_(
+                and_(Message.sender_id == a, Message.recipient_id == b),
+                and_(Message.sender_id == b, Message.recipient_id == a)
+            )).order_by(*newest_first).limit(PAGE_SIZE).all(),
+            'direct chat page, conversation_key': lambda: Message.query.filter(
+                Message.conversation_key == f'user_{a}_{b}'
+            ).order_by(*newest_first).limit(PAGE_SIZE).all(),
+            'group page, group_id filter': lambda: Message.query.filter(
+                Message.group_id == group_id
+            ).order_by(*newest_first).limit(PAGE_SIZE).all(),
+            'group page, conversation_key': lambda: Message.query.filter(
+                Message.conversation_key == f'group_{group_id}'
+            ).order_by(*newest_first).limit(PAGE_SIZE).all(),
+            'unread count for a user': lambda: db.session.query(func.count(Message.id)).filter(
+                Message.recipient_id == a, Message.read_at.is_(None)
+            ).scalar(),
+        }
+        for label, query in queries.items():
+            query()
+            report(label, timed(query, args.repeat))
+
+if __name__ == '__main__':
+    main()
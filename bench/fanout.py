@@ -0,0 +1,82 @@
+"""Room broadcast fan-out to many local clients with stubbed transports.
+
+Registers --clients clients in one room of an in-process Socket.IO server
+and times a new_message broadcast through the stock client manager and
+through FanOutManager. It times both the inline path and the queued path,
+where the sender's emit returns once the broadcast is queued and a
+background task delivers it. Packets are counted, not sent.
+
+    python bench/fanout.py --clients 10000
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fanout import FanOutManager  # noqa: E402
+from common import report, timed  # noqa: E402
+
+MESSAGE = {'message_id': 1, 'content': 'hello everyone', 'sender_id': 1, 'sender_name': 'Alice',
+           'sender_image': '/static/img/alice.png', 'group_id': 1, 'timestamp': '2024-01-01T12:00:00',
+           'message_type': 'text'}
+
+class Transport:
+    """Counts the packets a broadcast would send."""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.sent = 0
+        self.done = threading.Event()
+        self.sockets = {}
+        idle = SimpleNamespace(qsize=lambda: 0)
+        for i in range(clients):
+            self.sockets[f'eio{i}'] = SimpleNamespace(queue=idle)
+
+    def send(self, eio_sid, packet):
+        self.sent += 1
+        if self.sent % self.clients == 0:
+            self.done.set()
+
+def create_server(manager, clients):
+    server = socketio.Server(client_manager=manager, async_mode='threading')
+    transport = Transport(clients)
+    server._send_eio_packet = transport.send
+    server.eio.sockets = transport.sockets
+    for eio_sid in transport.sockets:
+        sid = manager.connect(eio_sid, '/')
+        manager.enter_room(sid, '/', 'group_1')
+    return server, transport
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    server, _ = create_server(socketio.Manager(), args.clients)
+    emit = lambda: server.emit('new_message', MESSAGE, to='group_1')
+    report('stock manager', timed(emit, args.repeat))
+
+    server, _ = create_server(FanOutManager(queue_threshold=args.clients + 1), args.clients)
+    emit = lambda: server.emit('new_message', MESSAGE, to='group_1')
+    report('FanOutManager, inline', timed(emit, args.repeat))
+
+    server, transport = create_server(FanOutManager(), args.clients)
+    returned, delivered = [], []
+    for _ in range(args.repeat):
+        transport.done.clear()
+        start = time.perf_counter()
+        server.emit('new_message', MESSAGE, to='group_1')
+        returned.append(time.perf_counter() - start)
+        transport.done.wait()
+        delivered.append(time.perf_counter() - start)
+    report('FanOutManager, queued: emit returns', returned)
+    report('FanOutManager, queued: all delivered', delivered)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""send_message throughput and latency, synchronous against write-behind persistence.
+
+One Socket.IO test client sends --messages direct messages to another.
+Latency is measured per send until the recipient has the new_message event.
+Throughput counts until every message is stored, so in write-behind mode
+it includes draining the writer. Each mode runs in its own process, since
+MESSAGE_WRITE_BEHIND is read at startup.
+
+    python bench/send_message_load.py --messages 5000
+    python bench/send_message_load.py --mode write-behind
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+from common import boot, percentile
+
+MODES = {'sync': 'false', 'write-behind': 'true'}
+
+def run(mode, messages):
+    app = boot(MESSAGE_WRITE_BEHIND=MODES[mode])
+    from app import db, socketio
+    from message_writer import message_writer
+    from models import User, Message
+
+    with app.app_context():
+        for name in ('alice', 'bob'):
+            user = User(username=name, email=f'{name}@example.com')
+            user.set_password('password')
+            db.session.add(user)
+        db.session.commit()
+
+    clients = []
+    for name in ('alice', 'bob'):
+        client = app.test_client()
+        client.post('/auth/login', data={'username': name, 'password': 'password'})
+        clients.append(socketio.test_client(app, flask_test_client=client))
+    sender, recipient = clients
+    sender.get_received()
+    recipient.get_received()
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(messages):
+        sent_at = time.perf_counter()
+        sender.emit('send_message', {'content': f'message {i}', 'recipient_id': 2})
+        # Handlers run synchronously under the test client, so the event has arrived by now
+        if not any(packet['name'] == 'new_message' for packet in recipient.get_received()):
+            raise RuntimeError('new_message was not delivered')
+        latencies.append(time.perf_counter() - sent_at)
+    with app.app_context():
+        message_writer.flush()
+        # The writer's own task may still be committing the batch it took last
+        deadline = time.monotonic() + 30
+        while (stored := Message.query.count()) < messages and time.monotonic() < deadline:
+            db.session.rollback()
+            time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    print(f"{mode:<13} {messages / elapsed:10,.0f} messages/s  "
+          f"latency median {percentile(latencies, 50) * 1000:.2f}ms  p99 {percentile(latencies, 99) * 1000:.2f}ms  "
+          f"({stored} stored)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--mode', choices=MODES)
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.messages)
+        return
+    for mode in MODES:
+        subprocess.run([sys.executable, __file__, '--mode', mode, '--messages', str(args.messages)], check=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Typing indicator fan-out in a large group, per-event forwarding against digests.
+
+--typists members of a --members group send --events typing events,
+spread evenly over --seconds of simulated time, with a digest flush every
+TYPING_DIGEST_INTERVAL. Forwarding every event delivers it to every
+member. The aggregator delivers one digest per changed room per interval.
+Deliveries are counted, not sent; the cost reported is the aggregator's own
+time per event.
+
+    python bench/typing_digest.py --members 1000 --typists 50 --events 2500
+"""
+import argparse
+import random
+import time
+
+from common import boot
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--typists', type=int, default=50)
+    parser.add_argument('--events', type=int, default=2500)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    boot()
+    import typing_indicator
+    from app import app
+
+    deliveries = 0
+    def emit(event, data, to):
+        nonlocal deliveries
+        deliveries += args.members
+    typing_indicator.socketio.emit = emit
+
+    now = 0.0
+    aggregator = typing_indicator.TypingAggregator(interval=app.config['TYPING_DIGEST_INTERVAL'],
+                                                   ttl=app.config['TYPING_TTL'])
+    aggregator.clock = lambda: now
+    aggregator._started = True  # flushed below on the simulated clock
+
+    room = 'group_1'
+    step = args.seconds / args.events
+    next_flush = aggregator.interval
+    digests = 0
+    spent = 0.0
+    for i in range(args.events):
+        now = i * step
+        if now >= next_flush:
+            digests += aggregator.flush()
+            next_flush += aggregator.interval
+        typist = random.randint(1, args.typists)
+        start = time.perf_counter()
+        aggregator.update(room, typist, f'user {typist}', True)
+        spent += time.perf_counter() - start
+    digests += aggregator.flush()
+
+    print(f"forward every event    {args.events * args.members:12,} deliveries")
+    print(f"digests ({digests:4} sent)    {deliveries:12,} deliveries")
+    print(f"aggregator cost        {spent / args.events * 1_000_000:12.2f}us per event")
+
+if __name__ == '__main__':
+    main()
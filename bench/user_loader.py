@@ -0,0 +1,65 @@
+"""Socket.IO events per second with and without the identity cache behind current_user.
+
+A logged-in test client sends --events typing events, which resolve
+current_user on every event. The uncached run registers the original
+loader, a primary-key SELECT of the user per event.
+
+    python bench/user_loader.py --events 20000
+"""
+import argparse
+import time
+
+from common import boot
+
+def run(app, socketio, client, events):
+    from sqlalchemy import event
+    from app import db
+
+    statements = []
+    def record(*args):
+        statements.append(args[2])
+
+    with app.app_context():
+        engine = db.engine
+    socket = socketio.test_client(app, flask_test_client=client)
+    event.listen(engine, 'before_cursor_execute', record)
+    start = time.perf_counter()
+    for i in range(events):
+        socket.emit('typing', {'room': 'user_1_2', 'is_typing': i % 2 == 0})
+    elapsed = time.perf_counter() - start
+    event.remove(engine, 'before_cursor_execute', record)
+    socket.disconnect()
+    return events / elapsed, len(statements) / events
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=10000)
+    args = parser.parse_args()
+
+    app = boot()
+    from app import db, socketio
+    from local_auth import login_manager
+    from models import User
+
+    with app.app_context():
+        for name in ('alice', 'bob'):
+            user = User(username=name, email=f'{name}@example.com')
+            user.set_password('password')
+            db.session.add(user)
+        db.session.commit()
+
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'alice', 'password': 'password'})
+
+    rate, queries = run(app, socketio, client, args.events)
+    print(f"identity cache     {rate:10,.0f} events/s  {queries:.2f} queries/event")
+
+    @login_manager.user_loader
+    def load_user(user_id):
+        return db.session.get(User, int(user_id))
+
+    rate, queries = run(app, socketio, client, args.events)
+    print(f"SELECT per event   {rate:10,.0f} events/s  {queries:.2f} queries/event")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""User search over a seeded users table: the original five-way ILIKE scan against search_users().
+
+Seeds --users users with generated names and phone numbers, then times a
+few typical queries: a typeahead prefix, a full name, a phone number and a
+term nothing matches. The ILIKE scan stops after 20 hits, so it is only
+cheap when a term is common; rare terms read the whole table.
+
+    python bench/user_search.py --users 1000000
+    DATABASE_URL=postgresql://localhost/prochat_bench python bench/user_search.py
+"""
+import argparse
+import random
+from types import SimpleNamespace
+
+from common import boot, report, timed
+
+SYLLABLES = ['al', 'be', 'ca', 'da', 'el', 'fa', 'gi', 'ho', 'is', 'jo', 'ka', 'li', 'mo', 'na', 'or',
+             'pe', 'qu', 'ra', 'si', 'to', 'ul', 've', 'wi', 'xa', 'yo', 'ze']
+
+def random_name(length):
+    return ''.join(random.choice(SYLLABLES) for _ in range(length)).capitalize()
+
+def seed(db, User, build_search_text, users, batch_size=20000):
+    rows = []
+    for i in range(users):
+        row = {'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-',
+               'first_name': random_name(2), 'last_name': random_name(3),
+               'phone_number': f'+1 555 {i:07d}'}
+        row['search_text'] = build_search_text(SimpleNamespace(**row))
+        rows.append(row)
+        if len(rows) == batch_size:
+            db.session.execute(db.insert(User), rows)
+            db.session.commit()
+            rows = []
+    if rows:
+        db.session.execute(db.insert(User), rows)
+        db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(1)
+    app = boot()
+    from sqlalchemy import or_, text
+    from app import db
+    from models import User
+    from search import build_search_text, search_users
+
+    with app.app_context():
+        print(f"Seeding {args.users:,} users ({db.engine.dialect.name})")
+        seed(db, User, build_search_text, args.users)
+        if db.engine.dialect.name == 'sqlite':
+            # Same statement reindex_users() ends with; the seed bypasses the mapper events
+            db.session.execute(text(
+                "INSERT INTO user_search (rowid, search_text) SELECT id, coalesce(search_text, '') FROM users"
+            ))
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+
+        target = db.session.get(User, args.users // 2)
+        queries = {
+            'typeahead prefix': target.first_name[:3].lower(),
+            'full name': f'{target.first_name} {target.last_name}',
+            'phone number': target.phone_number[-7:],
+            'no match': 'zzqx',
+        }
+
+        def ilike_scan(query):
+            # The original used func.concat() for the full name, which older SQLite lacks
+            return User.query.filter(or_(
+                User.username.ilike(f'%{query}%'),
+                User.phone_number.ilike(f'%{query}%'),
+                User.first_name.ilike(f'%{query}%'),
+                User.last_name.ilike(f'%{query}%'),
+                (User.first_name + ' ' + User.last_name).ilike(f'%{query}%')
+            )).filter(User.id != 1).limit(20).all()
+
+        for label, query in queries.items():
+            report(f'{label}, ILIKE scan', timed(lambda: ilike_scan(query), args.repeat))
+            report(f'{label}, search_users', timed(lambda: search_users(query, exclude_user_id=1), args.repeat))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Bytes and build time per socket event, verbose against compact (SOCKET_COMPACT_EVENTS).
+
+Each payload is built by wire.py and encoded into the Socket.IO packet the
+server would send; the time covers both steps. online_users in the verbose
+form loads the listed users from the database, which is included.
+
+    python bench/wire_format.py --online-users 50
+"""
+import argparse
+from datetime import datetime
+
+from socketio import packet
+
+from common import boot, report, timed
+
+def encoded_size(event, payload):
+    return len(packet.Packet(packet.EVENT, namespace='/', data=[event, payload]).encode().encode())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--online-users', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=10000)
+    args = parser.parse_args()
+
+    app = boot()
+    from app import db
+    from models import User, Message
+    from wire import message_event, status_event, online_users_event
+
+    with app.app_context():
+        db.session.execute(db.insert(User), [
+            {'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-',
+             'first_name': 'User', 'last_name': str(i), 'profile_image_url': f'/static/uploads/profile_{i}.jpg'}
+            for i in range(args.online_users)
+        ])
+        db.session.commit()
+        sender = db.session.get(User, 1)
+        message = Message(id=123456, content='See you at the standup in five minutes', sender_id=1,
+                          recipient_id=2, message_type='text', timestamp=datetime.utcnow())
+        online_ids = set(range(1, args.online_users + 1))
+
+        events = {
+            'new_message': lambda: message_event(message, sender),
+            'status_update (offline)': lambda: status_event(1, False, datetime.utcnow()),
+            f'online_users ({args.online_users} users)': lambda: online_users_event(online_ids),
+        }
+        for label, build in events.items():
+            event = label.split()[0]
+            for compact in (False, True):
+                app.config['SOCKET_COMPACT_EVENTS'] = compact
+                size = encoded_size(event, build())
+                repeat = args.repeat if event != 'online_users' or compact else args.repeat // 10
+                durations = timed(lambda: encoded_size(event, build()), repeat)
+                report(f"{label}, {'compact' if compact else 'verbose'}: {size} bytes", durations, unit='us')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import click
+import logging
+import os
+import shutil
+import time
+import uuid
+from sqlalchemy import case, cast, func, inspect, literal, text
+
+from app import app, db
+from inbox import message_preview
+from media_store import MEDIA_REFERENCES, MEDIA_URL_PREFIX, collect_garbage, media_url, recount_references, store_file
+from search import init_search_index, reindex_users, reindex_messages
+from stories import rebuild_story_summaries, sweep_expired_stories
+from uploads import cleanup_stale_uploads
+from models import User, Group, Message, Conversation, GroupMembership, conversation_key
+
+def ensure_schema():
+    """Bring existing tables up to date with the models.
+
+    db.create_all() only creates missing tables, so columns and indexes added
+    to existing models are created here.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            db.session.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {column.name} {column_type}'))
+            logging.info(f"Added {table.name}.{column.name} column")
+        db.session.commit()
+
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    init_search_index()
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    """Add missing columns and indexes to existing tables."""
+    ensure_schema()
+    click.echo("Database schema is up to date")
+
+@app.cli.command('migrate-conversation-keys')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows updated per transaction.')
+def migrate_conversation_keys(batch_size):
+    """Upgrade the schema, then backfill message conversation keys in batches."""
+    ensure_schema()
+
+    # Same format as models.conversation_key(), computed in SQL so rows never leave the database
+    low_id = case((Message.sender_id < Message.recipient_id, Message.sender_id), else_=Message.recipient_id)
+    high_id = case((Message.sender_id < Message.recipient_id, Message.recipient_id), else_=Message.sender_id)
+    key = case(
+        (Message.group_id.isnot(None), literal('group_') + cast(Message.group_id, db.String)),
+        else_=literal('user_') + cast(low_id, db.String) + literal('_') + cast(high_id, db.String)
+    )
+
+    max_id = db.session.query(func.max(Message.id)).scalar() or 0
+    updated = 0
+    for start in range(0, max_id + 1, batch_size):
+        result = db.session.execute(
+            db.update(Message)
+            .where(Message.id >= start, Message.id < start + batch_size, Message.conversation_key.is_(None))
+            .where((Message.group_id.isnot(None)) | (Message.recipient_id.isnot(None)))
+            .values(conversation_key=key)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        updated += result.rowcount
+    click.echo(f"Backfilled conversation_key on {updated} messages")
+
+@app.cli.command('rebuild-conversations')
+def rebuild_conversations():
+    """Rebuild every user's inbox (Conversation rows) from the message history."""
+    Conversation.query.delete()
+
+    last_ids = db.session.query(func.max(Message.id)).filter(
+        Message.conversation_key.isnot(None)
+    ).group_by(Message.conversation_key)
+    last_messages = {m.conversation_key: m for m in Message.query.filter(Message.id.in_(last_ids))}
+
+    unread = dict(
+        ((user_id, key), count) for user_id, key, count in db.session.query(
+            Message.recipient_id, Message.conversation_key, func.count(Message.id)
+        ).filter(Message.recipient_id.isnot(None), Message.read_at.is_(None)).group_by(
+            Message.recipient_id, Message.conversation_key
+        )
+    )
+
+    def add(user_id, key, message, **kwargs):
+        conversation = Conversation(user_id=user_id, conversation_key=key,
+                                    unread_count=unread.get((user_id, key), 0), **kwargs)
+        if message:
+            conversation.last_message_id = message.id
+            conversation.last_sender_id = message.sender_id
+            conversation.last_message_preview = message_preview(message)
+            conversation.last_message_at = message.timestamp
+        db.session.add(conversation)
+
+    created = 0
+    for membership in GroupMembership.query:
+        key = conversation_key(group_id=membership.group_id)
+        add(membership.user_id, key, last_messages.get(key), group_id=membership.group_id)
+        created += 1
+
+    for key, message in last_messages.items():
+        if message.group_id or not message.recipient_id:
+            continue
+        add(message.sender_id, key, message, partner_id=message.recipient_id)
+        if message.recipient_id != message.sender_id:
+            add(message.recipient_id, key, message, partner_id=message.sender_id)
+            created += 1
+        created += 1
+
+    db.session.commit()
+    click.echo(f"Rebuilt {created} conversations")
+
+@app.cli.command('reindex-users')
+def reindex_users_command():
+    """Recompute the user search text and rebuild the search index."""
+    init_search_index()
+    count = reindex_users()
+    click.echo(f"Reindexed {count} users")
+
+@app.cli.command('reindex-messages')
+def reindex_messages_command():
+    """Rebuild the message search index (SQLite only; Postgres indexes content directly)."""
+    init_search_index()
+    count = reindex_messages()
+    click.echo(f"Reindexed {count} messages")
+
+@app.cli.command('cleanup-uploads')
+@click.option('--max-age', type=int, default=None, help='Seconds of inactivity (default UPLOAD_SESSION_TTL).')
+def cleanup_uploads_command(max_age):
+    """Delete abandoned partial uploads."""
+    removed = cleanup_stale_uploads(max_age)
+    click.echo(f"Removed {removed} stale uploads")
+
+@app.cli.command('gc-media')
+@click.option('--grace-period', type=int, default=None, help='Seconds a new blob is kept (default MEDIA_GC_GRACE_PERIOD).')
+def gc_media_command(grace_period):
+    """Recount media references and delete blobs nothing points at."""
+    removed = collect_garbage(grace_period)
+    click.echo(f"Removed {removed} unreferenced media blobs")
+
+@app.cli.command('import-media')
+@click.option('--delete-originals', is_flag=True, help='Remove the legacy files once imported.')
+def import_media_command(delete_originals):
+    """Move files saved under per-upload names into the deduplicating media store."""
+    keys = {}
+    for model, attribute in MEDIA_REFERENCES:
+        column = getattr(model, attribute)
+        urls = db.session.query(column).filter(
+            column.like('/uploads/%'), ~column.like(MEDIA_URL_PREFIX + '%')
+        ).distinct().all()
+        for url, in urls:
+            if url not in keys:
+                path = os.path.join(app.config['UPLOAD_FOLDER'], url[len('/uploads/'):])
+                if not os.path.isfile(path):
+                    continue
+                # store_file consumes its input, so hand it a copy
+                temp_path = os.path.join(app.config['UPLOAD_TMP_FOLDER'], f"{uuid.uuid4().hex}.part")
+                shutil.copyfile(path, temp_path)
+                keys[url] = store_file(temp_path, path, public=model in (User, Group))
+            db.session.execute(
+                db.update(model).where(column == url).values({attribute: media_url(keys[url])})
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+
+    # The bulk updates above bypass the reference-count events
+    recount_references()
+    if delete_originals:
+        for url in keys:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], url[len('/uploads/'):]))
+    click.echo(f"Imported {len(keys)} files into the media store")
+
+@app.cli.command('sweep-stories')
+@click.option('--batch-size', type=int, default=None, help='Stories deleted per transaction (default STORY_SWEEP_BATCH_SIZE).')
+@click.option('--interval', type=int, default=0, show_default=True,
+              help='Keep sweeping every this many seconds; 0 sweeps once.')
+def sweep_stories_command(batch_size, interval):
+    """Delete expired stories with their views and media.
+
+    Run it from cron, or as one long-running process with --interval.
+    """
+    batch_size = batch_size or app.config['STORY_SWEEP_BATCH_SIZE']
+    while True:
+        deleted = sweep_expired_stories(batch_size)
+        click.echo(f"Deleted {deleted} expired stories")
+        if interval <= 0:
+            return
+        time.sleep(interval)
+
+@app.cli.command('rebuild-story-feed')
+def rebuild_story_feed_command():
+    """Recompute each user's story feed summary from the story table."""
+    count = rebuild_story_summaries()
+    click.echo(f"Rebuilt story summaries for {count} users")
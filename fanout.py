@@ -0,0 +1,111 @@
+import logging
+import threading
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+# Events a slow client can miss without harm, since the next one supersedes them
+DROPPABLE_EVENTS = frozenset({'user_typing', 'status_update'})
+
+class FanOutManager(socketio.Manager):
+    """Socket.IO client manager that fans room broadcasts out in batches.
+
+    Each broadcast is encoded once and the same packets are handed to every
+    recipient. Broadcasts to at least queue_threshold clients are delivered
+    by one background task per worker, in order, batch_size recipients at a
+    time with a yield in between, so a large group neither blocks the sender
+    nor starves other clients of the worker.
+
+    A recipient with max_backlog packets already waiting in its engine.io
+    send queue is a slow consumer. It misses droppable events. For anything
+    else its connection is closed instead of letting the queue grow; the
+    client reconnects and fetches what it missed with the sync event.
+    """
+
+    def __init__(self, batch_size=500, queue_threshold=100, max_backlog=1000):
+        super().__init__()
+        self.batch_size = batch_size
+        self.queue_threshold = queue_threshold
+        self.max_backlog = max_backlog
+        self._broadcasts = None
+        self._lock = threading.Lock()
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if callback or namespace not in self.rooms:
+            # Acknowledged emits need a packet per recipient
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+
+        skip_sids = skip_sid if isinstance(skip_sid, list) else [skip_sid]
+        recipients = [eio_sid for sid, eio_sid in self.get_participants(namespace, room) if sid not in skip_sids]
+        if not recipients:
+            return
+        broadcast = (event, self._encode(event, data, namespace), recipients)
+        if len(recipients) < self.queue_threshold:
+            self._deliver(*broadcast)
+        else:
+            self._enqueue(broadcast)
+
+    def _encode(self, event, data, namespace):
+        if isinstance(data, tuple):
+            data = list(data)
+        elif data is not None:
+            data = [data]
+        else:
+            data = []
+        encoded = self.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + data).encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        return [eio_packet.Packet(eio_packet.MESSAGE, part) for part in encoded]
+
+    def _deliver(self, event, packets, recipients):
+        sockets = self.server.eio.sockets
+        send = self.server._send_eio_packet
+        slow = []
+        for position, eio_sid in enumerate(recipients, 1):
+            socket = sockets.get(eio_sid)
+            if socket is not None and socket.queue.qsize() >= self.max_backlog:
+                if event not in DROPPABLE_EVENTS:
+                    slow.append(eio_sid)
+                continue
+            for part in packets:
+                send(eio_sid, part)
+            if position % self.batch_size == 0:
+                self.server.sleep(0)
+
+        for eio_sid in slow:
+            # Closing the transport, not the Socket.IO session, makes the client reconnect
+            logging.warning(f"Disconnecting slow Socket.IO client {eio_sid}")
+            self.server.eio.disconnect(eio_sid)
+
+    def _enqueue(self, broadcast):
+        with self._lock:
+            if self._broadcasts is None:
+                self._broadcasts = self.server.eio.create_queue()
+                self.server.start_background_task(self._run)
+        self._broadcasts.put(broadcast)
+
+    def _run(self):
+        while True:
+            broadcast = self._broadcasts.get()
+            try:
+                self._deliver(*broadcast)
+            except Exception as e:
+                logging.error(f"Broadcast of {broadcast[0]} failed: {e}")
+
+class RedisFanOutManager(socketio.RedisManager, FanOutManager):
+    """FanOutManager for scale-out mode: broadcasts are relayed through Redis
+    and each worker fans them out to its own clients."""
+
+    def __init__(self, url, batch_size=500, queue_threshold=100, max_backlog=1000, **kwargs):
+        super().__init__(url, **kwargs)
+        self.batch_size = batch_size
+        self.queue_threshold = queue_threshold
+        self.max_backlog = max_backlog
+
+def create_client_manager(redis_url=None, **options):
+    """The Socket.IO client manager for this deployment, see FanOutManager for options."""
+    if redis_url:
+        return RedisFanOutManager(redis_url, channel='flask-socketio', **options)
+    return FanOutManager(**options)
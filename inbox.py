@@ -0,0 +1,230 @@
+from datetime import datetime
+from sqlalchemy import and_, case, func, or_, update
+from sqlalchemy.orm import joinedload
+
+from app import db, socketio
+from models import Conversation, GroupMembership, Message, conversation_key, parse_conversation_key
+from membership_cache import is_group_member
+from subscriptions import conversation_rooms
+from utils import truncate_text
+
+INBOX_PAGE_SIZE = 50
+# Reconnect sync: messages per emitted batch, and the most sent for one conversation
+SYNC_BATCH_SIZE = 100
+SYNC_CONVERSATION_LIMIT = 500
+# Conversations a client may send cursors for in one sync request
+SYNC_MAX_CONVERSATIONS = 200
+
+def message_preview(message):
+    """Short text shown for a message in the conversation list."""
+    if message.message_type != 'text' and not message.content:
+        return f"[{message.message_type}]"
+    return truncate_text(message.content or '', 97)
+
+def _get_or_create(user_id, key, partner_id=None, group_id=None):
+    conversation = Conversation.query.filter_by(user_id=user_id, conversation_key=key).first()
+    if conversation is None:
+        conversation = Conversation(
+            user_id=user_id,
+            conversation_key=key,
+            partner_id=partner_id,
+            group_id=group_id,
+            unread_count=0
+        )
+        db.session.add(conversation)
+    return conversation
+
+def add_group_conversation(user_id, group):
+    """Create the inbox entry for a new group member. Caller commits."""
+    return _get_or_create(user_id, conversation_key(group_id=group.id), group_id=group.id)
+
+def record_message(message):
+    """Update the inbox entries touched by a new message.
+
+    Must be called after the message is flushed and before the surrounding
+    transaction commits, so the inbox never disagrees with the message table.
+    """
+    values = {
+        'last_message_id': message.id,
+        'last_sender_id': message.sender_id,
+        'last_message_preview': message_preview(message),
+        'last_message_at': message.timestamp,
+    }
+
+    if message.group_id:
+        # One UPDATE for all members; rows are created when members join.
+        # Messages written behind (message_writer) may arrive out of order, so
+        # the last_* fields only move forward.
+        is_newer = func.coalesce(Conversation.last_message_id, 0) < message.id
+        db.session.execute(
+            update(Conversation)
+            .where(Conversation.conversation_key == message.conversation_key)
+            .values(
+                unread_count=Conversation.unread_count + case(
+                    (Conversation.user_id == message.sender_id, 0), else_=1
+                ),
+                **{name: case((is_newer, value), else_=getattr(Conversation, name)) for name, value in values.items()}
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return
+
+    for user_id, partner_id in ((message.sender_id, message.recipient_id), (message.recipient_id, message.sender_id)):
+        conversation = _get_or_create(user_id, message.conversation_key, partner_id=partner_id)
+        if (conversation.last_message_id or 0) < message.id:
+            for name, value in values.items():
+                setattr(conversation, name, value)
+        if user_id != message.sender_id:
+            if conversation in db.session.new:
+                conversation.unread_count = 1
+            else:
+                # Incremented in SQL so concurrent senders don't lose updates
+                conversation.unread_count = Conversation.unread_count + 1
+
+def mark_conversation_read(user_id, key, up_to_message_id):
+    """Mark everything in a conversation up to up_to_message_id as read by a user.
+
+    Direct messages get read_at set with one bulk UPDATE. Groups only move the
+    member's read high-water mark. The inbox unread counter is recomputed
+    from what remains unread. Returns the read time if the read position
+    moved, False if it did not (nothing to send a receipt for), or None if
+    the user is not part of the conversation. Caller commits.
+    """
+    parsed = parse_conversation_key(key)
+    if parsed is None:
+        return None
+    
+    read_at = datetime.utcnow()
+    kind, target = parsed
+    if kind == 'group':
+        if not is_group_member(user_id, target):
+            return None
+        # Bulk UPDATE so the cached membership is not invalidated on every read
+        member = and_(GroupMembership.user_id == user_id, GroupMembership.group_id == target)
+        result = db.session.execute(
+            update(GroupMembership)
+            .where(member, func.coalesce(GroupMembership.last_read_message_id, 0) < up_to_message_id)
+            .values(last_read_message_id=up_to_message_id)
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            return False
+        high_water_mark = db.session.query(
+            func.coalesce(GroupMembership.last_read_message_id, 0)
+        ).filter(member).scalar_subquery()
+        unread = db.session.query(func.count(Message.id)).filter(
+            Message.conversation_key == key,
+            Message.id > high_water_mark,
+            Message.sender_id != user_id
+        ).scalar()
+    else:
+        if user_id not in target:
+            return None
+        result = db.session.execute(
+            update(Message)
+            .where(
+                Message.conversation_key == key,
+                Message.recipient_id == user_id,
+                Message.read_at.is_(None),
+                Message.id <= up_to_message_id
+            )
+            .values(read_at=read_at)
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            return False
+        unread = db.session.query(func.count(Message.id)).filter(
+            Message.conversation_key == key,
+            Message.recipient_id == user_id,
+            Message.read_at.is_(None)
+        ).scalar()
+    
+    db.session.execute(
+        update(Conversation)
+        .where(Conversation.user_id == user_id, Conversation.conversation_key == key)
+        .values(unread_count=unread)
+        .execution_options(synchronize_session=False)
+    )
+    return read_at
+
+def newest_read_position(key, up_to_message_id):
+    """Cap a client-supplied read position at the conversation's newest message id."""
+    newest = db.session.query(func.max(Message.id)).filter(Message.conversation_key == key).scalar()
+    return min(up_to_message_id, newest or 0)
+
+def mark_conversation_delivered(user_id, key, up_to_message_id):
+    """Set delivered_at on a user's received direct messages up to up_to_message_id with one bulk UPDATE.
+
+    Group messages have no per-recipient delivery state and are left alone.
+    Returns the number of messages updated. Caller commits.
+    """
+    parsed = parse_conversation_key(key)
+    if parsed is None or parsed[0] != 'direct' or user_id not in parsed[1]:
+        return 0
+    result = db.session.execute(
+        update(Message)
+        .where(
+            Message.conversation_key == key,
+            Message.recipient_id == user_id,
+            Message.delivered_at.is_(None),
+            Message.id <= up_to_message_id
+        )
+        .values(delivered_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+def get_sync_cursors(user_id, cursors, since_id):
+    """Work out which conversations a reconnecting client has missed messages in.
+
+    cursors maps conversation keys to the last message id the client has;
+    conversations it has no cursor for start after since_id, the newest id
+    it has seen anywhere, or are skipped if since_id is None. One inbox query
+    finds the conversations whose last message is newer than the client's
+    cursor. Returns {key: cursor}.
+    """
+    requested = Conversation.conversation_key.in_(list(cursors))
+    changed = db.session.query(Conversation.conversation_key, Conversation.last_message_id).filter(
+        Conversation.user_id == user_id,
+        requested if since_id is None else or_(requested, Conversation.last_message_id > since_id)
+    )
+    return {
+        key: cursors.get(key, since_id)
+        for key, last_message_id in changed
+        if (last_message_id or 0) > cursors.get(key, since_id)
+    }
+
+def iter_missed_messages(key, after_id, limit=SYNC_CONVERSATION_LIMIT, batch_size=SYNC_BATCH_SIZE):
+    """Yield the messages of a conversation newer than after_id in batches, oldest first.
+
+    Each batch is one keyset query, so a large backlog is never loaded at
+    once. Stops after limit messages.
+    """
+    sent = 0
+    while sent < limit:
+        batch = Message.query.filter(
+            Message.conversation_key == key,
+            Message.id > after_id
+        ).options(joinedload(Message.sender)).order_by(Message.id).limit(min(batch_size, limit - sent)).all()
+        if not batch:
+            return
+        yield batch
+        sent += len(batch)
+        after_id = batch[-1].id
+
+def send_read_receipt(user, key, up_to_message_id, read_at):
+    """Emit one coalesced message_read event for everything up to up_to_message_id."""
+    if not user.read_receipts:
+        return
+    socketio.emit('message_read', {
+        'conversation': key,
+        'up_to_message_id': up_to_message_id,
+        'read_by': user.id,
+        'read_at': read_at.isoformat()
+    }, to=conversation_rooms(key))
+
+def get_inbox(user_id, limit=INBOX_PAGE_SIZE):
+    """Most recently active conversations of a user, newest first."""
+    return Conversation.query.filter_by(user_id=user_id).options(
+        joinedload(Conversation.partner), joinedload(Conversation.group)
+    ).order_by(Conversation.last_message_at.desc()).limit(limit).all()
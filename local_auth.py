@@ -3,6 +3,7 @@ from flask_login import LoginManager, login_user, logout_user, login_required, c
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import app, db
 from models import User
+from user_cache import load_cached_user, user_cache
 import logging
 
 # Initialize Flask-Login
@@ -13,7 +14,7 @@ login_manager.login_message = 'Please log in to access this page.'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return load_cached_user(int(user_id))
 
 # Create authentication blueprint
 auth = Blueprint('auth', __name__, url_prefix='/auth')
@@ -115,6 +116,7 @@ def register():
 def logout():
     current_user.is_online = False
     db.session.commit()
+    user_cache.invalidate(current_user.id)
     logout_user()
     flash('You have been logged out.')
     return redirect(url_for('index'))
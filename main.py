@@ -1,6 +1,52 @@
-from app import app, socketio
-import routes  # noqa: F401
-import socketio_events  # noqa: F401
+import os
+import argparse
+
+# Spawned worker processes (the media variant pool) import this module as __mp_main__
+# before running their task; they need none of the server start-up below
+SERVER_PROCESS = __name__ != '__mp_main__'
+
+# Cooperative async modes must patch the standard library before anything else is imported
+_async_mode = os.environ.get("SOCKETIO_ASYNC_MODE", "threading")
+if SERVER_PROCESS and _async_mode == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+elif SERVER_PROCESS and _async_mode == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+if SERVER_PROCESS:
+    import logging
+    from app import app, socketio
+    import routes  # noqa: F401
+    import socketio_events  # noqa: F401
+    import commands  # noqa: F401
+    from metrics import init_metrics
+    from search import init_search_index
+
+def check_scale_out_config():
+    """Log how this worker takes part in a multi-worker deployment."""
+    if not app.config['REDIS_URL']:
+        logging.info("Socket.IO running in single-process mode")
+        return
+
+    logging.info("Socket.IO scale-out mode using the Redis message queue")
+    if app.config['SOCKETIO_ASYNC_MODE'] == 'threading':
+        logging.warning("Scale-out mode with async_mode 'threading'; eventlet or gevent is recommended")
+    if not app.config['SOCKETIO_STICKY_SESSIONS']:
+        logging.info("No sticky sessions: long-polling disabled, clients must connect over WebSocket")
+
+if SERVER_PROCESS:
+    init_metrics()
+    with app.app_context():
+        init_search_index()
+    check_scale_out_config()
 
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5000, debug=True, use_reloader=True, log_output=True)
+    parser = argparse.ArgumentParser(description="Run the ProChat server")
+    parser.add_argument('--host', default="0.0.0.0")
+    parser.add_argument('--port', type=int, default=int(os.environ.get("PORT", 5000)))
+    parser.add_argument('--no-debug', action='store_true', help="Disable debug mode and the reloader")
+    args = parser.parse_args()
+
+    debug = not args.no_debug
+    socketio.run(app, host=args.host, port=args.port, debug=debug, use_reloader=debug, log_output=True)
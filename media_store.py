@@ -0,0 +1,431 @@
+import hashlib
+import logging
+import mimetypes
+import multiprocessing
+import os
+import re
+import shutil
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import abort, redirect, request, send_file
+from sqlalchemy import event, func, inspect
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import safe_join
+
+from app import app, db
+from models import User, Group, Message, Story, MediaBlob
+from utils import allowed_file
+from variant_worker import render_image_variants, strip_image_metadata
+
+# Every stored file is served from /uploads/media/<key>; the key is its SHA-256 plus extension
+MEDIA_SUBFOLDER = 'media'
+MEDIA_URL_PREFIX = f'/uploads/{MEDIA_SUBFOLDER}/'
+MEDIA_KEY_PATTERN = re.compile(r'^[0-9a-f]{64}(_\d+)?(\.[a-z0-9]{1,10})?$')
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Resized copies of uploaded images, keyed <sha256>_<size>.<format>. Sizes are the longest
+# side in pixels: small avatars, list avatars, profile pages and story viewers.
+VARIANT_SIZES = (64, 160, 320, 1080)
+VARIANT_FORMATS = ('webp', 'jpg')
+# GIFs keep their original so animation is preserved
+VARIANT_SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+# Content-addressed files never change, so browsers may keep them for a year without revalidating
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Originals served in place of a variant that is still being rendered
+FALLBACK_MAX_AGE = 60
+
+# Columns that hold media URLs; each one counts as a reference to its blob
+MEDIA_REFERENCES = (
+    (Message, 'file_url'),
+    (Story, 'media_url'),
+    (User, 'profile_image_url'),
+    (Group, 'group_image_url'),
+)
+
+class LocalBackend:
+    """Blobs on local disk, sharded by the first two hex digits of the key."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _relative_path(self, key):
+        return os.path.join(key[:2], key)
+
+    def local_path(self, key):
+        return os.path.join(self.root, self._relative_path(key))
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def put(self, key, source_path):
+        """Move a finished local file into the store."""
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(source_path, path)
+
+    def delete(self, key):
+        if self.exists(key):
+            os.remove(self.local_path(key))
+
+    def serve(self, key, **options):
+        return send_stored_file(self.root, self._relative_path(key), **options)
+
+class S3Backend:
+    """Blobs in an S3 bucket. endpoint_url selects a compatible server, e.g. MinIO for local testing."""
+
+    def __init__(self, bucket, endpoint_url=None, prefix=f'{MEDIA_SUBFOLDER}/'):
+        import boto3
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def local_path(self, key):
+        return None
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except ClientError:
+            return False
+
+    def put(self, key, source_path):
+        self._client.upload_file(source_path, self.bucket, self.prefix + key)
+        os.remove(source_path)
+
+    def delete(self, key):
+        self._client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def serve(self, key, **options):
+        # The bucket serves the bytes, including ranges; caching is configured on the bucket
+        url = self._client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.prefix + key}, ExpiresIn=3600
+        )
+        return redirect(url)
+
+def create_backend():
+    if app.config['MEDIA_BACKEND'] == 's3':
+        return S3Backend(app.config['MEDIA_S3_BUCKET'], endpoint_url=app.config['MEDIA_S3_ENDPOINT_URL'])
+    return LocalBackend(app.config['MEDIA_ROOT'])
+
+media_backend = create_backend()
+
+def media_url(key):
+    return MEDIA_URL_PREFIX + key
+
+def make_key(sha256, filename):
+    return sha256 + os.path.splitext(filename)[1].lower()
+
+def variant_key(key, size, fmt='webp'):
+    return f"{key[:64]}_{size}.{fmt}"
+
+def media_key(url):
+    """The blob key a media URL points at, or None for legacy and external URLs."""
+    if url and url.startswith(MEDIA_URL_PREFIX):
+        return url[len(MEDIA_URL_PREFIX):]
+    return None
+
+def hash_file(path):
+    """Return (sha256 hex digest, size) of a local file."""
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            hasher.update(block)
+            size += len(block)
+    return hasher.hexdigest(), size
+
+def store_file(path, filename, sha256=None, size=None, public=False):
+    """Add a local file to the store and return its key.
+
+    The file is consumed: it is moved into the backend, or deleted if the same
+    content is already stored. Pass sha256 and size when they were computed
+    while receiving the file to avoid reading it again. public marks content
+    that anyone may see, such as profile and group images, so shared caches
+    may keep it; see serve_media.
+    """
+    if sha256 is None:
+        sha256, size = hash_file(path)
+    key = make_key(sha256, filename)
+
+    blob = db.session.get(MediaBlob, key)
+    if blob is not None and media_backend.exists(key):
+        # Refresh the grace period so the collector does not race this new reference
+        blob.stored_at = datetime.utcnow()
+        if public:
+            blob.public = True
+        os.remove(path)
+        return key
+
+    media_backend.put(key, path)
+    if blob is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(MediaBlob(key=key, size=size, public=public))
+        except IntegrityError:
+            # Stored concurrently by another request
+            if public:
+                db.session.execute(db.update(MediaBlob).where(MediaBlob.key == key).values(public=True))
+    elif public:
+        blob.public = True
+    return key
+
+def save_uploaded_file(file, file_type='image', public=False):
+    """Store an uploaded file and return its media URL, or None if the file type is not allowed.
+
+    Pass public for profile and group images; see store_file.
+    """
+    if not file or not allowed_file(file.filename, file_type):
+        return None
+
+    temp_path = os.path.join(app.config['UPLOAD_TMP_FOLDER'], f"{uuid.uuid4().hex}.part")
+    hasher = hashlib.sha256()
+    size = 0
+    with open(temp_path, 'wb') as out:
+        for block in iter(lambda: file.stream.read(COPY_BUFFER_SIZE), b''):
+            out.write(block)
+            hasher.update(block)
+            size += len(block)
+    sha256 = hasher.hexdigest()
+
+    # Clients open the original in full, so camera EXIF (location, device) is removed before it is keyed
+    if os.path.splitext(file.filename)[1].lower() in VARIANT_SOURCE_EXTENSIONS and strip_image_metadata(temp_path):
+        sha256, size = hash_file(temp_path)
+
+    key = make_key(sha256, file.filename)
+    variant_source = None
+    if key.endswith(VARIANT_SOURCE_EXTENSIONS) and not media_backend.exists(variant_key(key, VARIANT_SIZES[0])):
+        # Keep a link to the upload for the variant workers; store_file consumes the original
+        variant_source = temp_path + '.src'
+        try:
+            os.link(temp_path, variant_source)
+        except OSError:
+            shutil.copyfile(temp_path, variant_source)
+
+    store_file(temp_path, file.filename, sha256, size, public=public)
+    if variant_source:
+        schedule_variants(key, variant_source)
+    return media_url(key)
+
+_variant_pool = None
+
+def schedule_variants(key, source_path):
+    """Render the resized variants of an image in the worker pool and store them.
+
+    The request returns immediately. Until the variants exist, their URLs
+    serve the original image (see serve_media).
+
+    Workers are spawned, not forked, so they do not inherit the server's
+    threads and sockets. They only run render_image_variants, which imports
+    nothing from the app; main.py skips the server start-up when a worker
+    imports it as __mp_main__.
+    """
+    global _variant_pool
+    if app.config['MEDIA_VARIANT_WORKERS'] <= 0:
+        os.remove(source_path)
+        return
+    if _variant_pool is None:
+        _variant_pool = ProcessPoolExecutor(max_workers=app.config['MEDIA_VARIANT_WORKERS'],
+                                            mp_context=multiprocessing.get_context('spawn'))
+    future = _variant_pool.submit(render_image_variants, source_path, VARIANT_SIZES, VARIANT_FORMATS)
+    future.add_done_callback(lambda done: _store_variants(key, source_path, done))
+
+def _store_variants(key, source_path, future):
+    os.remove(source_path)
+    try:
+        variants = future.result()
+    except Exception as e:
+        logging.error(f"Could not render variants of {key}: {e}")
+        return
+    for size, fmt, data in variants:
+        temp_path = os.path.join(app.config['UPLOAD_TMP_FOLDER'], f"{uuid.uuid4().hex}.part")
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        media_backend.put(variant_key(key, size, fmt), temp_path)
+
+def thumbnail(url, size, fmt='webp'):
+    """URL of the smallest stored variant at least size pixels wide, or url itself for non-variant media."""
+    key = media_key(url)
+    if not key or not key.endswith(VARIANT_SOURCE_EXTENSIONS):
+        return url
+    size = next((s for s in VARIANT_SIZES if s >= size), VARIANT_SIZES[-1])
+    return media_url(variant_key(key, size, fmt))
+
+app.add_template_filter(thumbnail)
+
+def send_stored_file(directory, relative_path, etag=True, max_age=None, immutable=False, public=False):
+    """Send a local file with validators, Range support and caching headers.
+
+    etag is a strong ETag string, or True for Werkzeug's mtime-based one.
+    Files are cached by the browser only, unless public allows shared caches
+    such as proxies and CDNs to keep them too. With
+    MEDIA_ACCEL_MODE set, only headers are sent and the front proxy serves the
+    bytes: "nginx" uses X-Accel-Redirect to MEDIA_ACCEL_PREFIX plus the path
+    below UPLOAD_FOLDER, "sendfile" uses X-Sendfile with the absolute path.
+    """
+    path = safe_join(directory, relative_path)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    path = os.path.abspath(path)
+
+    mode = app.config['MEDIA_ACCEL_MODE']
+    accel_path = None
+    if mode == 'nginx':
+        accel_path = os.path.relpath(path, os.path.abspath(app.config['UPLOAD_FOLDER']))
+        if accel_path.startswith('..'):
+            accel_path = None  # Outside the proxied folder; send it ourselves
+
+    if accel_path or mode == 'sendfile':
+        response = app.response_class(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        if accel_path:
+            response.headers['X-Accel-Redirect'] = app.config['MEDIA_ACCEL_PREFIX'].rstrip('/') + '/' + accel_path
+        else:
+            response.headers['X-Sendfile'] = path
+        if isinstance(etag, str):
+            response.set_etag(etag)
+        response.last_modified = int(os.path.getmtime(path))
+        response.make_conditional(request)
+    else:
+        response = send_file(path, etag=etag, conditional=True, max_age=max_age)
+
+    # send_file marks every cacheable response public
+    response.cache_control.public = True if public else None
+    response.cache_control.private = None if public else True
+    if max_age is not None:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = max_age
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+def serve_media(key):
+    if not MEDIA_KEY_PATTERN.match(key):
+        abort(404)
+    if '_' in key:
+        # Variants share the blob of their original
+        blob = MediaBlob.query.filter(MediaBlob.key.like(key[:64] + '%')).first()
+    else:
+        blob = db.session.get(MediaBlob, key)
+    # Attachments and story media stay out of shared caches; only public blobs may be kept there
+    public = blob is not None and blob.public
+    if '_' in key and not media_backend.exists(key):
+        # Variant not rendered (yet): fall back to the original upload, briefly cached
+        if blob is None:
+            abort(404)
+        return media_backend.serve(blob.key, etag=blob.key, max_age=FALLBACK_MAX_AGE, public=public)
+    # The key is derived from the content, so it is a strong validator and the URL never changes
+    return media_backend.serve(key, etag=key, max_age=IMMUTABLE_MAX_AGE, immutable=True, public=public)
+
+def recount_references():
+    """Recompute every blob's ref_count from the referencing columns.
+
+    Reference counts are maintained by mapper events, so bulk UPDATE/DELETE
+    statements bypass them; the collector recounts first to correct any drift.
+    """
+    counts = Counter()
+    for model, attribute in MEDIA_REFERENCES:
+        column = getattr(model, attribute)
+        for url, count in db.session.query(column, func.count()).filter(
+            column.like(MEDIA_URL_PREFIX + '%')
+        ).group_by(column):
+            counts[media_key(url)] += count
+
+    for blob in MediaBlob.query.yield_per(1000):
+        blob.ref_count = counts.get(blob.key, 0)
+    db.session.commit()
+
+def _delete_orphans(query, cutoff):
+    removed = 0
+    for blob in query.filter(MediaBlob.ref_count <= 0, MediaBlob.stored_at < cutoff).all():
+        try:
+            media_backend.delete(blob.key)
+            if blob.key.endswith(VARIANT_SOURCE_EXTENSIONS):
+                for size in VARIANT_SIZES:
+                    for fmt in VARIANT_FORMATS:
+                        media_backend.delete(variant_key(blob.key, size, fmt))
+        except Exception as e:
+            logging.error(f"Could not delete media blob {blob.key}: {e}")
+            continue
+        db.session.delete(blob)
+        removed += 1
+    return removed
+
+def _grace_cutoff(grace_period=None):
+    grace_period = app.config['MEDIA_GC_GRACE_PERIOD'] if grace_period is None else grace_period
+    return datetime.utcnow() - timedelta(seconds=grace_period)
+
+def collect_garbage(grace_period=None, recount=True):
+    """Delete unreferenced blobs stored more than grace_period seconds ago. Returns the number removed."""
+    if recount:
+        recount_references()
+    removed = _delete_orphans(MediaBlob.query, _grace_cutoff(grace_period))
+    db.session.commit()
+    return removed
+
+def release_media(urls):
+    """Drop one reference per URL for rows removed with bulk statements.
+
+    Bulk deletes bypass the reference-count events, so callers pass the URLs
+    of the rows they deleted. Files nothing refers to any more are deleted
+    right away; files saved before the media store are always unique to
+    their row and are deleted too. The caller commits.
+    """
+    counts = Counter(media_key(url) for url in urls if media_key(url))
+    for key, count in counts.items():
+        db.session.execute(
+            MediaBlob.__table__.update()
+            .where(MediaBlob.key == key)
+            .values(ref_count=MediaBlob.ref_count - count)
+        )
+    removed = _delete_orphans(MediaBlob.query.filter(MediaBlob.key.in_(counts)), _grace_cutoff()) if counts else 0
+
+    for url in urls:
+        if url and url.startswith('/uploads/') and not media_key(url):
+            path = safe_join(app.config['UPLOAD_FOLDER'], url[len('/uploads/'):])
+            if path and os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+    return removed
+
+def _adjust_reference(connection, url, delta):
+    key = media_key(url)
+    if key:
+        connection.execute(
+            MediaBlob.__table__.update()
+            .where(MediaBlob.key == key)
+            .values(ref_count=MediaBlob.ref_count + delta)
+        )
+
+def _track_references(model, attribute):
+    # Without active history, assigning an attribute that is not loaded (e.g. after a commit)
+    # records no old value, and the reference to the old URL would never be released
+    @event.listens_for(getattr(model, attribute), 'set', active_history=True)
+    def load_old_value(target, value, oldvalue, initiator):
+        pass
+
+    @event.listens_for(model, 'after_insert')
+    def add_reference(mapper, connection, target):
+        _adjust_reference(connection, getattr(target, attribute), 1)
+
+    @event.listens_for(model, 'after_delete')
+    def remove_reference(mapper, connection, target):
+        _adjust_reference(connection, getattr(target, attribute), -1)
+
+    @event.listens_for(model, 'after_update')
+    def move_reference(mapper, connection, target):
+        history = inspect(target).attrs[attribute].history
+        if not history.has_changes():
+            return
+        for url in history.deleted:
+            _adjust_reference(connection, url, -1)
+        for url in history.added:
+            _adjust_reference(connection, url, 1)
+
+for model, attribute in MEDIA_REFERENCES:
+    _track_references(model, attribute)
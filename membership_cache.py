@@ -0,0 +1,53 @@
+from sqlalchemy import event
+
+from app import app, db
+from models import GroupMembership, parse_conversation_key
+from user_cache import UserCache, RedisUserCache
+
+class RedisMembershipCache(RedisUserCache):
+    KEY = 'prochat:membership:{}'
+
+if app.config['REDIS_URL']:
+    membership_cache = RedisMembershipCache(app.config['REDIS_URL'], ttl=app.config['MEMBERSHIP_CACHE_TTL'])
+else:
+    membership_cache = UserCache(ttl=app.config['MEMBERSHIP_CACHE_TTL'], max_size=100000)
+
+def _key(user_id, group_id):
+    return f"{int(user_id)}:{int(group_id)}"
+
+def _lookup(user_id, group_id):
+    key = _key(user_id, group_id)
+    entry = membership_cache.get(key)
+    if entry is None:
+        row = db.session.query(GroupMembership.role).filter_by(
+            user_id=user_id,
+            group_id=group_id
+        ).first()
+        entry = {'member': row is not None, 'role': row.role if row else None}
+        membership_cache.set(key, entry)
+    return entry
+
+def get_group_role(user_id, group_id):
+    """Role of a user in a group, or None if they are not a member. Cached, including misses."""
+    return _lookup(user_id, group_id)['role']
+
+def is_group_member(user_id, group_id):
+    return _lookup(user_id, group_id)['member']
+
+def is_room_member(user_id, room):
+    """Whether a user belongs to a conversation room ('user_{a}_{b}' or 'group_{id}')."""
+    parsed = parse_conversation_key(room)
+    if parsed is None:
+        return False
+    kind, target = parsed
+    return is_group_member(user_id, target) if kind == 'group' else user_id in target
+
+def invalidate_membership(user_id, group_id):
+    """Drop a cached membership; call after joining, leaving, kicking or role changes."""
+    membership_cache.invalidate(_key(user_id, group_id))
+
+@event.listens_for(GroupMembership, 'after_insert')
+@event.listens_for(GroupMembership, 'after_update')
+@event.listens_for(GroupMembership, 'after_delete')
+def invalidate_changed_membership(mapper, connection, membership):
+    invalidate_membership(membership.user_id, membership.group_id)
@@ -0,0 +1,158 @@
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import event, func, select, text
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app import app, db, socketio
+from inbox import record_message
+from models import Message
+
+class MessageIdAllocator:
+    """Hands out message ids before the row is written.
+
+    On Postgres ids are taken from the message id sequence, so they never
+    collide with rows inserted synchronously or by other workers. Read
+    positions and reconnect sync treat ids as the order messages were sent
+    in, so by default each id is one nextval; a block_size above 1 reserves
+    ids per worker and is only safe with a single worker. Other databases
+    (SQLite for local testing) continue from max(id) in process, which is
+    only safe with a single worker.
+    """
+
+    def __init__(self, block_size=1):
+        self.block_size = block_size
+        self._ids = []
+        self._next = None
+        self._lock = threading.Lock()
+
+    def next_id(self, connection=None):
+        """The next message id, read through connection when called inside a flush."""
+        executor = db.session if connection is None else connection
+        with self._lock:
+            if db.engine.dialect.name == 'postgresql':
+                if not self._ids:
+                    self._ids = [row[0] for row in executor.execute(
+                        text("SELECT nextval(pg_get_serial_sequence('message', 'id')) "
+                             "FROM generate_series(1, :n)"),
+                        {'n': self.block_size}
+                    )]
+                return self._ids.pop(0)
+
+            if self._next is None:
+                self._next = (executor.execute(select(func.max(Message.id))).scalar() or 0) + 1
+            self._next += 1
+            return self._next - 1
+
+class MessageWriter:
+    """Write-behind queue for messages that have already been broadcast.
+
+    Rows are inserted in batches of up to batch_size, one transaction per
+    batch together with their inbox updates. Once a batch commits, each
+    sender gets a message_ack with status 'persisted'. A batch that is
+    rejected, or still fails after max_retries attempts, is written one row
+    at a time, so only the rows that fail on their own are acked 'failed'.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=0.05, max_retries=3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = []
+        self._lock = threading.Lock()
+        self._started = False
+
+    def submit(self, row, sid=None):
+        with self._lock:
+            self._queue.append((row, sid))
+            if not self._started:
+                self._started = True
+                socketio.start_background_task(self._run)
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue)
+
+    def flush(self):
+        """Write everything queued so far. Must run inside an app context."""
+        written = 0
+        while True:
+            with self._lock:
+                batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+            if not batch:
+                return written
+            self._write_batch(batch)
+            written += len(batch)
+
+    def _write_batch(self, batch):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self._insert(batch)
+                self._acknowledge(batch, 'persisted')
+                return
+            except (IntegrityError, DataError) as e:
+                # A bad row fails the whole batch on every attempt, so isolate it instead
+                db.session.rollback()
+                logging.error(f"Message batch rejected, writing its rows one at a time: {e}")
+                break
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Message batch write failed (attempt {attempt}/{self.max_retries}): {e}")
+                time.sleep(0.1 * 2 ** attempt)
+        self._write_rows(batch)
+
+    def _write_rows(self, batch):
+        persisted, failed = [], []
+        for item in batch:
+            try:
+                self._insert([item])
+                persisted.append(item)
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Message {item[0]['id']} could not be written: {e}")
+                failed.append(item)
+        self._acknowledge(persisted, 'persisted')
+        self._acknowledge(failed, 'failed')
+
+    def _insert(self, batch):
+        messages = [Message(**row) for row, sid in batch]
+        db.session.add_all(messages)
+        db.session.flush()
+        for message in messages:
+            record_message(message)
+        db.session.commit()
+
+    def _acknowledge(self, batch, status):
+        by_sid = defaultdict(list)
+        for row, sid in batch:
+            if sid:
+                by_sid[sid].append(row['id'])
+        for sid, message_ids in by_sid.items():
+            socketio.emit('message_ack', {'message_ids': message_ids, 'status': status}, to=sid)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            with app.app_context():
+                self.flush()
+
+message_id_allocator = MessageIdAllocator(block_size=app.config['MESSAGE_ID_BLOCK_SIZE'])
+message_writer = MessageWriter(
+    batch_size=app.config['MESSAGE_WRITE_BATCH_SIZE'],
+    flush_interval=app.config['MESSAGE_WRITE_INTERVAL']
+)
+
+if app.config['MESSAGE_WRITE_BEHIND']:
+    @event.listens_for(Message, 'before_insert')
+    def allocate_message_id(mapper, connection, message):
+        # Synchronous inserts must not reuse ids already handed out by the allocator
+        if message.id is None:
+            message.id = message_id_allocator.next_id(connection)
+
+    @atexit.register
+    def flush_on_exit():
+        with app.app_context():
+            message_writer.flush()
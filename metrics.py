@@ -0,0 +1,165 @@
+import heapq
+import random
+import threading
+import time
+from functools import wraps
+
+from flask import request
+from sqlalchemy import event
+
+from app import app, db, socketio
+
+# Latency histogram bucket upper bounds in seconds, Prometheus style
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_STATEMENT_LIMIT = 20
+
+class HandlerStats:
+    """Aggregated cost of one route or Socket.IO event."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.query_count = 0
+        self.db_time = 0.0
+
+    def observe(self, duration, query_count, db_time):
+        self.count += 1
+        self.total_time += duration
+        self.query_count += query_count
+        self.db_time += db_time
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_time': round(self.total_time, 6),
+            'avg_time': round(self.total_time / self.count, 6) if self.count else 0,
+            'query_count': self.query_count,
+            'db_time': round(self.db_time, 6),
+            'histogram': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], self.buckets))
+        }
+
+class MetricsRegistry:
+    """Collects sampled per-handler latency and SQL statistics."""
+
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.handlers = {}
+        self.slow_statements = []  # min-heap of (duration, statement, handler)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self, name):
+        """Begin recording a handler invocation if it is sampled."""
+        if random.random() >= self.sample_rate:
+            self._local.current = None
+            return
+        self._local.current = {'name': name, 'start': time.perf_counter(), 'queries': 0, 'db_time': 0.0}
+
+    def finish(self):
+        current = getattr(self._local, 'current', None)
+        if current is None:
+            return
+        self._local.current = None
+        duration = time.perf_counter() - current['start']
+        with self._lock:
+            stats = self.handlers.setdefault(current['name'], HandlerStats())
+            stats.observe(duration, current['queries'], current['db_time'])
+
+    def record_statement(self, statement, duration):
+        current = getattr(self._local, 'current', None)
+        if current is None:
+            return
+        current['queries'] += 1
+        current['db_time'] += duration
+        entry = (duration, statement[:500], current['name'])
+        with self._lock:
+            if len(self.slow_statements) < SLOW_STATEMENT_LIMIT:
+                heapq.heappush(self.slow_statements, entry)
+            elif duration > self.slow_statements[0][0]:
+                heapq.heapreplace(self.slow_statements, entry)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'handlers': {name: stats.to_dict() for name, stats in sorted(self.handlers.items())},
+                'slow_statements': [
+                    {'duration': round(duration, 6), 'statement': statement, 'handler': name}
+                    for duration, statement, name in sorted(self.slow_statements, reverse=True)
+                ]
+            }
+
+    def to_prometheus(self):
+        """Render handler statistics in the Prometheus text exposition format."""
+        lines = [
+            '# TYPE prochat_handler_latency_seconds histogram',
+        ]
+        with self._lock:
+            items = sorted(self.handlers.items())
+            for name, stats in items:
+                cumulative = 0
+                for bound, count in zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], stats.buckets):
+                    cumulative += count
+                    lines.append(f'prochat_handler_latency_seconds_bucket{{handler="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'prochat_handler_latency_seconds_sum{{handler="{name}"}} {stats.total_time}')
+                lines.append(f'prochat_handler_latency_seconds_count{{handler="{name}"}} {stats.count}')
+            lines.append('# TYPE prochat_handler_queries_total counter')
+            for name, stats in items:
+                lines.append(f'prochat_handler_queries_total{{handler="{name}"}} {stats.query_count}')
+            lines.append('# TYPE prochat_handler_db_seconds_total counter')
+            for name, stats in items:
+                lines.append(f'prochat_handler_db_seconds_total{{handler="{name}"}} {stats.db_time}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry(sample_rate=app.config['METRICS_SAMPLE_RATE'])
+
+def _instrument_socketio_handler(name, handler):
+    @wraps(handler)
+    def instrumented(*args, **kwargs):
+        metrics.start(f'socket:{name}')
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            metrics.finish()
+    return instrumented
+
+def init_metrics():
+    """Install the instrumentation hooks when METRICS_ENABLED is set.
+
+    Must be called after all routes and Socket.IO handlers are registered.
+    """
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start_time'].pop()
+        metrics.record_statement(statement, time.perf_counter() - start)
+
+    def start_request_metrics():
+        metrics.start(f'route:{request.endpoint}')
+
+    # Run ahead of the other before_request hooks so their queries are counted too
+    app.before_request_funcs.setdefault(None, []).insert(0, start_request_metrics)
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        metrics.finish()
+
+    for namespace_handlers in socketio.server.handlers.values():
+        for name, handler in list(namespace_handlers.items()):
+            namespace_handlers[name] = _instrument_socketio_handler(name, handler)
@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta
 from app import db
 from flask_login import UserMixin
-from sqlalchemy import UniqueConstraint, func
+from sqlalchemy import UniqueConstraint, func, event
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # User model for local authentication
@@ -28,6 +28,13 @@ class User(UserMixin, db.Model):
     show_bio = db.Column(db.String(20), default='everyone')
     read_receipts = db.Column(db.Boolean, default=True)
     
+    # Normalized text maintained by search.py for user search
+    search_text = db.Column(db.Text)
+    
+    # Story feed summary maintained by stories.py: newest story and when the last one expires
+    last_story_at = db.Column(db.DateTime)
+    stories_expire_at = db.Column(db.DateTime)
+    
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -37,6 +44,8 @@ class User(UserMixin, db.Model):
     stories = db.relationship('Story', backref='author', lazy='dynamic')
     blocked_users = db.relationship('BlockedUser', foreign_keys='BlockedUser.blocker_id', backref='blocker', lazy='dynamic')
     
+    __table_args__ = (db.Index('ix_users_last_story', 'last_story_at', 'id'),)
+    
     def get_display_name(self):
         if self.first_name and self.last_name:
             return f"{self.first_name} {self.last_name}"
@@ -75,17 +84,43 @@ class GroupMembership(db.Model):
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_paid = db.Column(db.Boolean, default=False)
     payment_expires_at = db.Column(db.DateTime)
+    last_read_message_id = db.Column(db.Integer)  # Read high-water mark for this member
+
+def conversation_key(sender_id=None, recipient_id=None, group_id=None):
+    """Canonical key of a conversation, identical to its Socket.IO room name."""
+    if group_id:
+        return f"group_{int(group_id)}"
+    if sender_id and recipient_id:
+        sender_id, recipient_id = int(sender_id), int(recipient_id)
+        return f"user_{min(sender_id, recipient_id)}_{max(sender_id, recipient_id)}"
+    return None
+
+def parse_conversation_key(key):
+    """Inverse of conversation_key(): ('group', group_id), ('direct', (user_id, user_id)) or None."""
+    try:
+        kind, *ids = str(key).split('_')
+        ids = tuple(int(i) for i in ids)
+    except ValueError:
+        return None
+    if kind == 'group' and len(ids) == 1:
+        return 'group', ids[0]
+    if kind == 'user' and len(ids) == 2:
+        return 'direct', ids
+    return None
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text)
-    message_type = db.Column(db.String(20), default='text')  # text, image, document, voice
+    message_type = db.Column(db.String(20), default='text')  # text, image, document, video, audio
     file_url = db.Column(db.String(255))
     file_name = db.Column(db.String(255))
+    file_size = db.Column(db.BigInteger)
+    file_hash = db.Column(db.String(64))  # SHA-256 of the attachment, computed while uploading
     
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     recipient_id = db.Column(db.Integer, db.ForeignKey('users.id'))  # For direct messages
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'))  # For group messages
+    conversation_key = db.Column(db.String(64))  # user_{min}_{max} or group_{id}, see conversation_key()
     
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     is_edited = db.Column(db.Boolean, default=False)
@@ -95,6 +130,64 @@ class Message(db.Model):
     delivered_at = db.Column(db.DateTime)
     read_at = db.Column(db.DateTime)
     
+    recipient = db.relationship('User', foreign_keys=[recipient_id])
+    
+    __table_args__ = (
+        db.Index('ix_message_conversation_timestamp', 'conversation_key', 'timestamp', 'id'),
+        db.Index('ix_message_conversation_id', 'conversation_key', 'id'),  # reconnect sync, see inbox.py
+        db.Index('ix_message_sender_timestamp', 'sender_id', 'timestamp'),
+        db.Index('ix_message_recipient_read', 'recipient_id', 'read_at'),
+    )
+    
+    def to_dict(self, sender=None):
+        """Serialize the message in the same shape as the new_message event.
+
+        sender can be passed for messages not loaded through the session.
+        """
+        sender = sender or self.sender
+        return {
+            'message_id': self.id,
+            'content': self.content,
+            'sender_id': self.sender_id,
+            'sender_name': sender.get_display_name(),
+            'sender_image': sender.profile_image_url,
+            'recipient_id': self.recipient_id,
+            'group_id': self.group_id,
+            'timestamp': self.timestamp.isoformat(),
+            'message_type': self.message_type,
+            'file_url': self.file_url,
+            'file_name': self.file_name,
+            'file_size': self.file_size,
+            'read_at': self.read_at.isoformat() if self.read_at else None
+        }
+    
+@event.listens_for(Message, 'before_insert')
+def set_conversation_key(mapper, connection, message):
+    if not message.conversation_key:
+        message.conversation_key = conversation_key(message.sender_id, message.recipient_id, message.group_id)
+
+class Conversation(db.Model):
+    """Per-user inbox entry for one direct chat or group, maintained by inbox.record_message()."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    conversation_key = db.Column(db.String(64), nullable=False)
+    partner_id = db.Column(db.Integer, db.ForeignKey('users.id'))  # For direct conversations
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'))  # For group conversations
+    
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+    last_sender_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    last_message_preview = db.Column(db.String(100))
+    last_message_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    partner = db.relationship('User', foreign_keys=[partner_id])
+    group = db.relationship('Group')
+    
+    __table_args__ = (
+        UniqueConstraint('user_id', 'conversation_key'),
+        db.Index('ix_conversation_user_last_message', 'user_id', 'last_message_at'),
+    )
+
 class Story(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -111,6 +204,11 @@ class Story(db.Model):
     # Relationships
     views = db.relationship('StoryView', backref='story', lazy='dynamic', cascade='all, delete-orphan')
     
+    __table_args__ = (
+        db.Index('ix_story_expires_at', 'expires_at'),
+        db.Index('ix_story_user_expires', 'user_id', 'expires_at'),
+    )
+    
     @property
     def is_expired(self):
         return datetime.utcnow() > self.expires_at
@@ -118,6 +216,24 @@ class Story(db.Model):
     @property
     def view_count(self):
         return self.views.count()
+    
+    def to_dict(self, view_count=None):
+        """Serialize the story for the story feed API; view_count is only sent to the author."""
+        data = {
+            'id': self.id,
+            'author_id': self.user_id,
+            'author_name': self.author.get_display_name(),
+            'author_image': self.author.profile_image_url,
+            'content': self.content,
+            'media_url': self.media_url,
+            'media_type': self.media_type,
+            'visibility': self.visibility,
+            'created_at': self.created_at.isoformat(),
+            'expires_at': self.expires_at.isoformat()
+        }
+        if view_count is not None:
+            data['view_count'] = view_count
+        return data
 
 class StoryView(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -152,4 +268,14 @@ class UserSession(db.Model):
     last_activity = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
     
-    user = db.relationship('User', backref='sessions')
\ No newline at end of file
+    user = db.relationship('User', backref='sessions')
+
+class MediaBlob(db.Model):
+    """A stored file keyed by its content hash, shared by every URL that points at it. See media_store.py."""
+    key = db.Column(db.String(80), primary_key=True)  # SHA-256 hex digest + lower-case extension
+    size = db.Column(db.BigInteger)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    stored_at = db.Column(db.DateTime, default=datetime.utcnow)  # Last upload of this content, for the GC grace period
+    public = db.Column(db.Boolean, default=False)  # Also a profile or group image, so shared caches may keep it
+    
+    __table_args__ = (db.Index('ix_media_blob_ref_count', 'ref_count', 'stored_at'),)
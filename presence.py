@@ -0,0 +1,219 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from app import app, db, socketio
+from models import User, Contact, GroupMembership, conversation_key
+from subscriptions import personal_room
+
+class LastSeenWriter:
+    """Buffers last-seen updates in memory and writes them to the database in bulk.
+
+    Requests only record the user id; a background task flushes all pending
+    users with a single bulk UPDATE every flush_interval seconds. A user is
+    queued at most once per min_change seconds: the writer remembers when it
+    last queued each user, since the cached user's last_seen is not refreshed
+    by the bulk UPDATE.
+
+    Only last_seen is written. is_online belongs to the Socket.IO connect and
+    disconnect handlers and to logout; writing it here would mark users
+    online again after they left.
+    """
+
+    def __init__(self, flush_interval=15, min_change=60):
+        self.flush_interval = flush_interval
+        self.min_change = min_change
+        self._pending = {}
+        self._queued_at = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def touch(self, user):
+        now = datetime.utcnow()
+        with self._lock:
+            last = self._queued_at.get(user.id) or user.last_seen
+            if last and (now - last).total_seconds() < self.min_change:
+                return
+
+            self._pending[user.id] = now
+            self._queued_at[user.id] = now
+            if not self._started:
+                self._started = True
+                socketio.start_background_task(self._run)
+
+    def flush(self):
+        """Write all pending last-seen values. Must run inside an app context."""
+        now = datetime.utcnow()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # Entries this old no longer suppress anything
+            self._queued_at = {
+                user_id: queued_at for user_id, queued_at in self._queued_at.items()
+                if (now - queued_at).total_seconds() < self.min_change
+            }
+
+        if not pending:
+            return 0
+
+        try:
+            db.session.execute(db.update(User), [
+                {'id': user_id, 'last_seen': seen}
+                for user_id, seen in pending.items()
+            ])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Presence flush failed: {e}")
+            # Keep the values for the next attempt unless a newer one arrived meanwhile
+            with self._lock:
+                for user_id, seen in pending.items():
+                    self._pending.setdefault(user_id, seen)
+            return 0
+        return len(pending)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            with app.app_context():
+                self.flush()
+
+last_seen_writer = LastSeenWriter(
+    flush_interval=app.config['PRESENCE_FLUSH_INTERVAL'],
+    min_change=app.config['PRESENCE_MIN_CHANGE']
+)
+
+@atexit.register
+def flush_on_exit():
+    with app.app_context():
+        last_seen_writer.flush()
+
+class PresenceRegistry:
+    """Tracks open Socket.IO connections per user in process memory.
+
+    A user is online while at least one of their connections is open, so
+    connect() and disconnect() only report True on the first connection and
+    on the last disconnection respectively.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def connect(self, user_id):
+        """Register a connection. Returns True if the user just came online."""
+        with self._lock:
+            count = self._connections.get(user_id, 0) + 1
+            self._connections[user_id] = count
+        return count == 1
+
+    def disconnect(self, user_id):
+        """Unregister a connection. Returns True if the user just went offline."""
+        with self._lock:
+            count = self._connections.get(user_id, 0) - 1
+            if count > 0:
+                self._connections[user_id] = count
+            else:
+                self._connections.pop(user_id, None)
+        return count <= 0
+
+    def is_online(self, user_id):
+        with self._lock:
+            return user_id in self._connections
+
+    def online_user_ids(self):
+        with self._lock:
+            return set(self._connections)
+
+class RedisPresenceRegistry(PresenceRegistry):
+    """PresenceRegistry shared by all workers through Redis.
+
+    Each worker keeps its connection counts in its own hash and heartbeats
+    every ttl / 3 seconds. The hash expires after ttl seconds without a
+    heartbeat, so the users of a worker that died are not online forever.
+    A user is online while any live worker has a connection for them.
+    """
+
+    WORKERS_KEY = 'prochat:presence:workers'
+    CONNECTIONS_KEY = 'prochat:presence:connections:{}'
+
+    def __init__(self, url, ttl=30):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.worker_id = uuid.uuid4().hex
+        self._key = self.CONNECTIONS_KEY.format(self.worker_id)
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _ensure_started(self):
+        with self._lock:
+            if not self._started:
+                self._started = True
+                self.heartbeat()
+                socketio.start_background_task(self._run)
+
+    def heartbeat(self):
+        now = time.time()
+        pipe = self._redis.pipeline()
+        pipe.zadd(self.WORKERS_KEY, {self.worker_id: now})
+        pipe.zremrangebyscore(self.WORKERS_KEY, '-inf', now - self.ttl)
+        pipe.expire(self._key, self.ttl)
+        pipe.execute()
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.ttl / 3)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logging.error(f"Presence heartbeat failed: {e}")
+
+    def _live_keys(self):
+        workers = self._redis.zrangebyscore(self.WORKERS_KEY, time.time() - self.ttl, '+inf')
+        return [self.CONNECTIONS_KEY.format(worker.decode()) for worker in workers]
+
+    def _connection_count(self, user_id):
+        pipe = self._redis.pipeline()
+        for key in self._live_keys():
+            pipe.hget(key, user_id)
+        return sum(int(count or 0) for count in pipe.execute())
+
+    def connect(self, user_id):
+        self._ensure_started()
+        pipe = self._redis.pipeline()
+        pipe.hincrby(self._key, user_id, 1)
+        pipe.expire(self._key, self.ttl)
+        pipe.execute()
+        return self._connection_count(user_id) == 1
+
+    def disconnect(self, user_id):
+        if self._redis.hincrby(self._key, user_id, -1) <= 0:
+            self._redis.hdel(self._key, user_id)
+        return self._connection_count(user_id) <= 0
+
+    def is_online(self, user_id):
+        return self._connection_count(user_id) > 0
+
+    def online_user_ids(self):
+        pipe = self._redis.pipeline()
+        for key in self._live_keys():
+            pipe.hkeys(key)
+        return {int(user_id) for user_ids in pipe.execute() for user_id in user_ids}
+
+def get_presence_rooms(user_id):
+    """Rooms that should hear about a user's status: their groups and the personal rooms of their contacts."""
+    group_ids = db.session.query(GroupMembership.group_id).filter(GroupMembership.user_id == user_id)
+    contact_ids = db.session.query(Contact.user_id).filter(Contact.contact_id == user_id).union(
+        db.session.query(Contact.contact_id).filter(Contact.user_id == user_id)
+    )
+    rooms = [conversation_key(group_id=group_id) for group_id, in group_ids]
+    rooms.extend(personal_room(contact_id) for contact_id, in contact_ids)
+    return rooms
+
+if app.config['REDIS_URL']:
+    presence_registry = RedisPresenceRegistry(app.config['REDIS_URL'], ttl=app.config['PRESENCE_WORKER_TTL'])
+else:
+    presence_registry = PresenceRegistry()
@@ -1,6 +1,6 @@
 import os
 from datetime import datetime, timedelta
-from flask import session, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from flask import session, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import current_user, login_required
 from werkzeug.utils import secure_filename
 from sqlalchemy import or_, and_, desc, func
@@ -8,11 +8,60 @@ from sqlalchemy.orm import joinedload
 
 from app import app, db, socketio
 from local_auth import auth
-from models import User, Group, GroupMembership, Message, Story, StoryView, Contact, BlockedUser, UserSession
-from utils import allowed_file, save_uploaded_file
+from models import User, Group, GroupMembership, Message, Story, StoryView, Contact, BlockedUser, UserSession, conversation_key
+from inbox import (add_group_conversation, record_message, mark_conversation_read, newest_read_position,
+                   send_read_receipt, get_inbox)
+from membership_cache import is_group_member, is_room_member, invalidate_membership
+from metrics import metrics
+from presence import last_seen_writer
+from search import search_users, search_messages, SEARCH_RESULT_LIMIT, MESSAGE_SEARCH_PAGE_SIZE
+from stories import (get_story_feed, stories_with_view_counts, story_feed_cache,
+                     invalidate_story_feeds, serialize_feed_groups, get_feed_snapshot, get_feed_changes)
+from subscriptions import conversation_rooms, subscribe_user
+from typing_indicator import typing_aggregator
+from user_cache import user_cache
+from wire import message_event
+from media_store import MEDIA_SUBFOLDER, media_url, save_uploaded_file, send_stored_file, serve_media, store_file
+from uploads import UploadSession, parse_streamed_upload, discard_files
+from utils import allowed_file, attachment_type, encode_cursor, decode_cursor
 
 app.register_blueprint(auth)
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+LEGACY_UPLOAD_MAX_AGE = 24 * 3600
+# User directory lookups for compact socket events
+USER_DIRECTORY_MAX_IDS = 100
+USER_DIRECTORY_MAX_AGE = 300
+
+def direct_conversation_filter(user_id, other_user_id):
+    """Filter matching every message exchanged between two users."""
+    return Message.conversation_key == conversation_key(user_id, other_user_id)
+
+def get_message_page(query, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """Return one page of messages older than cursor using (timestamp, id) keyset pagination.
+
+    Messages are returned oldest first together with the cursor for the next
+    (older) page, or None when the start of the conversation has been reached.
+    """
+    if cursor:
+        before_timestamp, before_id = cursor
+        query = query.filter(or_(
+            Message.timestamp < before_timestamp,
+            and_(Message.timestamp == before_timestamp, Message.id < before_id)
+        ))
+    
+    page = query.options(joinedload(Message.sender)).order_by(
+        desc(Message.timestamp), desc(Message.id)
+    ).limit(limit + 1).all()
+    
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    
+    next_cursor = encode_cursor(page[0].timestamp, page[0].id) if has_more else None
+    return page, next_cursor
+
 @app.before_request
 def make_session_permanent():
     session.permanent = True
@@ -20,9 +69,26 @@ def make_session_permanent():
 @app.before_request
 def update_last_seen():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        current_user.is_online = True
+        last_seen_writer.touch(current_user)
+
+def mark_read_on_view(key, up_to_message_id):
+    """Mark a conversation read up to the newest rendered message and notify the room."""
+    read_at = mark_conversation_read(current_user.id, key, up_to_message_id)
+    if read_at:
+        # Repeat views of an already read conversation change nothing and send nothing
         db.session.commit()
+        send_read_receipt(current_user, key, up_to_message_id, read_at)
+
+def groups_with_member_counts(query):
+    """Turn a Group query into (group, member_count) rows with one grouped subquery."""
+    member_counts = db.session.query(
+        GroupMembership.group_id,
+        func.count(GroupMembership.id).label('member_count')
+    ).group_by(GroupMembership.group_id).subquery()
+    
+    return query.outerjoin(
+        member_counts, member_counts.c.group_id == Group.id
+    ).add_columns(func.coalesce(member_counts.c.member_count, 0))
 
 @app.route('/')
 def index():
@@ -34,28 +100,15 @@ def index():
 @app.route('/chat')
 @login_required
 def chat():
-    # Get recent conversations
-    recent_messages = db.session.query(Message).filter(
-        or_(
-            Message.sender_id == current_user.id,
-            Message.recipient_id == current_user.id
-        )
-    ).order_by(desc(Message.timestamp)).limit(50).all()
+    # Get recent conversations, direct and group, from the inbox table
+    conversations = get_inbox(current_user.id)
     
-    # Get user's groups
-    user_groups = db.session.query(Group).join(GroupMembership).filter(
-        GroupMembership.user_id == current_user.id
-    ).all()
-    
-    # Get active stories
-    active_stories = db.session.query(Story).filter(
-        Story.expires_at > datetime.utcnow()
-    ).order_by(desc(Story.created_at)).limit(20).all()
+    # Latest page of the story feed, one entry per author
+    story_groups, _ = get_story_feed(current_user.id)
     
     return render_template('chat.html', 
-                         recent_messages=recent_messages,
-                         user_groups=user_groups,
-                         active_stories=active_stories)
+                         conversations=conversations,
+                         story_groups=story_groups)
 
 @app.route('/profile')
 @login_required
@@ -82,11 +135,12 @@ def edit_profile():
         if 'profile_image' in request.files:
             file = request.files['profile_image']
             if file and allowed_file(file.filename):
-                filename = save_uploaded_file(file, 'profiles')
-                if filename:
-                    current_user.profile_image_url = url_for('uploaded_file', filename=f'profiles/{filename}')
+                file_url = save_uploaded_file(file, public=True)
+                if file_url:
+                    current_user.profile_image_url = file_url
         
         db.session.commit()
+        user_cache.invalidate(current_user.id)
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('profile'))
     
@@ -95,12 +149,14 @@ def edit_profile():
 @app.route('/groups')
 @login_required
 def groups():
-    user_groups = db.session.query(Group).join(GroupMembership).filter(
-        GroupMembership.user_id == current_user.id
+    user_groups = groups_with_member_counts(
+        db.session.query(Group).join(GroupMembership).filter(
+            GroupMembership.user_id == current_user.id
+        )
     ).all()
     
-    public_groups = db.session.query(Group).filter(
-        Group.is_premium == False
+    public_groups = groups_with_member_counts(
+        db.session.query(Group).filter(Group.is_premium == False)
     ).limit(20).all()
     
     return render_template('groups.html', user_groups=user_groups, public_groups=public_groups)
@@ -121,9 +177,9 @@ def create_group():
         if 'group_image' in request.files:
             file = request.files['group_image']
             if file and allowed_file(file.filename):
-                filename = save_uploaded_file(file, 'groups')
-                if filename:
-                    group.group_image_url = url_for('uploaded_file', filename=f'groups/{filename}')
+                file_url = save_uploaded_file(file, public=True)
+                if file_url:
+                    group.group_image_url = file_url
         
         db.session.add(group)
         db.session.flush()
@@ -136,7 +192,10 @@ def create_group():
             is_paid=True
         )
         db.session.add(membership)
+        add_group_conversation(current_user.id, group)
         db.session.commit()
+        invalidate_membership(current_user.id, group.id)
+        subscribe_user(current_user.id, group.id)
         
         flash('Group created successfully!', 'success')
         return redirect(url_for('group_detail', group_id=group.id))
@@ -156,16 +215,26 @@ def group_detail(group_id):
         flash('You are not a member of this group.', 'error')
         return redirect(url_for('groups'))
     
-    messages = Message.query.filter_by(group_id=group_id).order_by(
-        desc(Message.timestamp)
+    messages = Message.query.filter_by(
+        conversation_key=conversation_key(group_id=group_id)
+    ).options(joinedload(Message.sender)).order_by(
+        desc(Message.timestamp), desc(Message.id)
     ).limit(50).all()
     
-    members = db.session.query(User).join(GroupMembership).filter(
-        GroupMembership.group_id == group_id
-    ).all()
+    # (user, role) rows so the template does not look up each membership
+    members = db.session.query(User, GroupMembership.role).join(
+        GroupMembership, GroupMembership.user_id == User.id
+    ).filter(GroupMembership.group_id == group_id).all()
     
-    return render_template('groups.html', group=group, messages=messages, 
+    page = render_template('groups.html', group=group, messages=messages, 
                          members=members, membership=membership, viewing=True)
+    
+    # Rendering the latest page counts as reading it. This may commit, so it runs
+    # after rendering to avoid reloading every expired message in the template.
+    if messages:
+        mark_read_on_view(conversation_key(group_id=group_id), messages[0].id)
+    
+    return page
 
 @app.route('/groups/<int:group_id>/join', methods=['POST'])
 @login_required
@@ -192,7 +261,10 @@ def join_group(group_id):
         is_paid=not group.is_premium
     )
     db.session.add(membership)
+    add_group_conversation(current_user.id, group)
     db.session.commit()
+    invalidate_membership(current_user.id, group_id)
+    subscribe_user(current_user.id, group_id)
     
     flash('Successfully joined the group!', 'success')
     return redirect(url_for('group_detail', group_id=group_id))
@@ -200,18 +272,20 @@ def join_group(group_id):
 @app.route('/stories')
 @login_required
 def stories():
-    # Get active stories from contacts or public
-    active_stories = db.session.query(Story).filter(
-        Story.expires_at > datetime.utcnow()
-    ).order_by(desc(Story.created_at)).all()
-    
-    # Get user's own stories
-    my_stories = db.session.query(Story).filter(
-        Story.user_id == current_user.id,
-        Story.expires_at > datetime.utcnow()
+    # One page of visible stories from other users, grouped by author
+    cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    story_groups, next_cursor = get_story_feed(current_user.id, cursor=cursor)
+    
+    # Get user's own stories as (story, view_count) rows
+    my_stories = stories_with_view_counts(
+        db.session.query(Story).filter(
+            Story.user_id == current_user.id,
+            Story.expires_at > datetime.utcnow()
+        )
     ).order_by(desc(Story.created_at)).all()
     
-    return render_template('stories.html', active_stories=active_stories, my_stories=my_stories)
+    return render_template('stories.html', story_groups=story_groups, next_cursor=next_cursor,
+                         my_stories=my_stories, now=datetime.utcnow())
 
 @app.route('/stories/create', methods=['GET', 'POST'])
 @login_required
@@ -227,9 +301,9 @@ def create_story():
         if 'media' in request.files:
             file = request.files['media']
             if file and allowed_file(file.filename):
-                filename = save_uploaded_file(file, 'stories')
-                if filename:
-                    story.media_url = url_for('uploaded_file', filename=f'stories/{filename}')
+                file_url = save_uploaded_file(file)
+                if file_url:
+                    story.media_url = file_url
                     # Determine media type
                     if file.filename and file.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
                         story.media_type = 'image'
@@ -238,18 +312,21 @@ def create_story():
         
         db.session.add(story)
         db.session.commit()
+        invalidate_story_feeds(story)
         
         flash('Story created successfully!', 'success')
         return redirect(url_for('stories'))
     
     return render_template('stories.html', creating=True)
 
-@app.route('/stories/<int:story_id>/view')
+@app.route('/stories/<int:story_id>/view', methods=['GET', 'POST'])
 @login_required
 def view_story(story_id):
     story = Story.query.get_or_404(story_id)
     
     if story.is_expired:
+        if request.method == 'POST':
+            return jsonify({'status': 'error', 'message': 'This story has expired'}), 410
         flash('This story has expired.', 'error')
         return redirect(url_for('stories'))
     
@@ -263,9 +340,38 @@ def view_story(story_id):
         view = StoryView(story_id=story_id, viewer_id=current_user.id)
         db.session.add(view)
         db.session.commit()
+        # The author's cached feed carries view counts of their own stories
+        story_feed_cache.invalidate(story.user_id)
     
+    if request.method == 'POST':
+        return jsonify({'status': 'success'})
     return render_template('stories.html', viewing_story=story)
 
+@app.route('/api/stories')
+@login_required
+def api_stories():
+    """Story feed as JSON.
+
+    Without parameters this returns the cached first page and the viewer's own
+    stories together with a 'since' token. Passing since=<token> returns only
+    stories created and view counts changed after it, plus a fresh token.
+    cursor=<next_cursor> returns an older page of the feed.
+    """
+    if request.args.get('since'):
+        since = decode_cursor(request.args['since'])
+        if since is None:
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+        return jsonify(get_feed_changes(current_user.id, request.args['since'], since))
+    
+    if request.args.get('cursor'):
+        cursor = decode_cursor(request.args['cursor'])
+        if cursor is None:
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+        story_groups, next_cursor = get_story_feed(current_user.id, cursor=cursor)
+        return jsonify({'groups': serialize_feed_groups(story_groups), 'next_cursor': next_cursor})
+    
+    return jsonify(get_feed_snapshot(current_user.id))
+
 @app.route('/search')
 @login_required
 def search():
@@ -274,18 +380,77 @@ def search():
     
     if query:
         # Search by username, phone number, or name
-        results = User.query.filter(
-            or_(
-                User.username.ilike(f'%{query}%'),
-                User.phone_number.ilike(f'%{query}%'),
-                User.first_name.ilike(f'%{query}%'),
-                User.last_name.ilike(f'%{query}%'),
-                func.concat(User.first_name, ' ', User.last_name).ilike(f'%{query}%')
-            )
-        ).filter(User.id != current_user.id).limit(20).all()
+        results = search_users(query, exclude_user_id=current_user.id)
     
     return render_template('search.html', query=query, results=results)
 
+@app.route('/api/search/users')
+@login_required
+def api_search_users():
+    query = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', 10, type=int), SEARCH_RESULT_LIMIT)
+    
+    users = search_users(query, exclude_user_id=current_user.id, limit=max(limit, 1)) if query else []
+    return jsonify({
+        'status': 'success',
+        'users': [
+            {
+                'id': user.id,
+                'username': user.username,
+                'name': user.get_display_name(),
+                'image': user.profile_image_url
+            } for user in users
+        ]
+    })
+
+@app.route('/api/users/directory')
+@login_required
+def api_user_directory():
+    """Names and images for a list of user ids, used by clients of compact socket events."""
+    try:
+        user_ids = {int(user_id) for user_id in request.args.get('ids', '').split(',') if user_id}
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid user id'}), 400
+    if len(user_ids) > USER_DIRECTORY_MAX_IDS:
+        return jsonify({'status': 'error', 'message': f'At most {USER_DIRECTORY_MAX_IDS} ids per request'}), 400
+    
+    users = User.query.filter(User.id.in_(user_ids)).all() if user_ids else []
+    response = jsonify({
+        'status': 'success',
+        'users': {
+            user.id: {
+                'name': user.get_display_name(),
+                'image': user.profile_image_url
+            } for user in users
+        }
+    })
+    response.cache_control.private = True
+    response.cache_control.max_age = USER_DIRECTORY_MAX_AGE
+    return response
+
+@app.route('/api/search/messages')
+@login_required
+def api_search_messages():
+    query = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', MESSAGE_SEARCH_PAGE_SIZE, type=int), SEARCH_RESULT_LIMIT * 5)
+    
+    results, next_cursor = search_messages(
+        current_user.id,
+        query,
+        before_id=request.args.get('before', type=int),
+        conversation=request.args.get('conversation'),
+        limit=max(limit, 1)
+    )
+    
+    return jsonify({
+        'status': 'success',
+        'results': [
+            dict(message.to_dict(), conversation=message.conversation_key, snippet=snippet)
+            for message, snippet in results
+        ],
+        'next_cursor': next_cursor
+    })
+
 @app.route('/chat/<user_id>')
 @login_required
 def direct_chat(user_id):
@@ -301,15 +466,52 @@ def direct_chat(user_id):
         flash('You cannot message this user.', 'error')
         return redirect(url_for('index'))
     
-    # Get conversation history
-    messages = Message.query.filter(
-        or_(
-            and_(Message.sender_id == current_user.id, Message.recipient_id == user_id),
-            and_(Message.sender_id == user_id, Message.recipient_id == current_user.id)
-        )
-    ).order_by(Message.timestamp).all()
+    # Only the latest page is rendered; older pages are fetched from the history API
+    messages, history_cursor = get_message_page(
+        Message.query.filter(direct_conversation_filter(current_user.id, other_user.id))
+    )
+    
+    page = render_template('chat.html', other_user=other_user, messages=messages,
+                         history_cursor=history_cursor, direct_chat=True)
+    
+    # Rendering the latest page counts as reading it (after rendering, see group_detail)
+    if messages:
+        mark_read_on_view(conversation_key(current_user.id, other_user.id), messages[-1].id)
     
-    return render_template('chat.html', other_user=other_user, messages=messages, direct_chat=True)
+    return page
+
+@app.route('/api/chat/<int:user_id>/history')
+@login_required
+def api_direct_history(user_id):
+    other_user = User.query.get_or_404(user_id)
+    
+    # Same check as direct_chat: a blocked user cannot page through the conversation either
+    blocked = BlockedUser.query.filter_by(
+        blocker_id=other_user.id,
+        blocked_id=current_user.id
+    ).first()
+    
+    if blocked:
+        return jsonify({'status': 'error', 'message': 'You cannot message this user'}), 403
+    
+    cursor = None
+    if request.args.get('before'):
+        cursor = decode_cursor(request.args['before'])
+        if cursor is None:
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+    
+    limit = min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_MAX_PAGE_SIZE)
+    messages, next_cursor = get_message_page(
+        Message.query.filter(direct_conversation_filter(current_user.id, other_user.id)),
+        cursor=cursor,
+        limit=max(limit, 1)
+    )
+    
+    return jsonify({
+        'status': 'success',
+        'messages': [message.to_dict() for message in messages],
+        'next_cursor': next_cursor
+    })
 
 @app.route('/settings')
 @login_required
@@ -351,9 +553,26 @@ def admin():
                          recent_users=recent_users,
                          recent_groups=recent_groups)
 
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if not current_user.is_admin:
+        return jsonify({'status': 'error', 'message': 'Admin privileges required'}), 403
+    
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({'status': 'error', 'message': 'Metrics are disabled'}), 404
+    
+    if request.args.get('format') == 'prometheus':
+        return metrics.to_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+    
+    return jsonify({'status': 'success', 'metrics': metrics.snapshot()})
+
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    if filename.startswith(MEDIA_SUBFOLDER + '/'):
+        return serve_media(filename[len(MEDIA_SUBFOLDER) + 1:])
+    # Files saved before the media store; their names are unique but not content-derived
+    return send_stored_file(app.config['UPLOAD_FOLDER'], filename, max_age=LEGACY_UPLOAD_MAX_AGE)
 
 # API endpoints for AJAX requests
 @app.route('/api/send_message', methods=['POST'])
@@ -361,6 +580,10 @@ def uploaded_file(filename):
 def api_send_message():
     data = request.get_json()
     
+    error = check_attachment_target(data.get('recipient_id'), data.get('group_id'))
+    if error:
+        return error
+    
     message = Message(
         content=data.get('content'),
         sender_id=current_user.id,
@@ -370,44 +593,171 @@ def api_send_message():
     )
     
     db.session.add(message)
+    db.session.flush()
+    record_message(message)
     db.session.commit()
     
     # Emit to relevant users via WebSocket
-    socketio.emit('new_message', {
-        'message_id': message.id,
-        'content': message.content,
-        'sender': current_user.get_display_name(),
-        'timestamp': message.timestamp.isoformat()
-    }, to=data.get('room'))
+    socketio.emit('new_message', message_event(message, current_user), to=conversation_rooms(message.conversation_key))
     
     return jsonify({'status': 'success', 'message_id': message.id})
 
-@app.route('/api/mark_read', methods=['POST'])
+def check_attachment_target(recipient_id, group_id):
+    """Return an error response if the current user may not send to this destination, else None."""
+    if group_id:
+        if not is_group_member(current_user.id, group_id):
+            return jsonify({'status': 'error', 'message': 'Not a member of this group'}), 403
+    elif not recipient_id or not db.session.get(User, recipient_id):
+        return jsonify({'status': 'error', 'message': 'Invalid message destination'}), 400
+    return None
+
+def send_attachment_message(key, filename, file_size, file_hash, caption=None,
+                            recipient_id=None, group_id=None):
+    """Create, record and broadcast the message for a finished attachment upload."""
+    message = Message(
+        content=caption or None,
+        sender_id=current_user.id,
+        recipient_id=None if group_id else recipient_id,
+        group_id=group_id,
+        message_type=attachment_type(filename),
+        file_url=media_url(key),
+        file_name=secure_filename(filename),
+        file_size=file_size,
+        file_hash=file_hash
+    )
+    
+    db.session.add(message)
+    db.session.flush()
+    record_message(message)
+    db.session.commit()
+    
+    socketio.emit('new_message', message_event(message), to=conversation_rooms(message.conversation_key))
+    return message
+
+@app.route('/api/send_attachment', methods=['POST'])
 @login_required
-def api_mark_read():
+def api_send_attachment():
+    # Parse the body ourselves so the file streams to disk instead of being buffered
+    form, files, streams = parse_streamed_upload(request.environ, app.config['ATTACHMENT_MAX_SIZE'])
+    
+    file = files.get('file')
+    recipient_id = form.get('recipient_id', type=int)
+    group_id = form.get('group_id', type=int)
+    
+    error = check_attachment_target(recipient_id, group_id)
+    if error is None and (not file or not file.filename or not attachment_type(file.filename)):
+        error = jsonify({'status': 'error', 'message': 'File type not allowed'}), 400
+    if error is not None:
+        discard_files(streams)
+        return error
+    
+    upload = file.stream
+    discard_files([stream for stream in streams if stream is not upload])
+    key = store_file(upload.path, file.filename, upload.hexdigest, upload.size)
+    message = send_attachment_message(key, file.filename, upload.size, upload.hexdigest,
+                                      form.get('caption'), recipient_id, group_id)
+    
+    return jsonify({'status': 'success', 'message': message.to_dict()})
+
+def upload_status(upload, status_code=200, **extra):
+    response = jsonify(dict(extra, status='success', upload_id=upload.upload_id,
+                            offset=upload.offset, size=upload.size))
+    response.status_code = status_code
+    response.headers['Upload-Offset'] = str(upload.offset)
+    response.headers['Upload-Length'] = str(upload.size)
+    return response
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def api_create_upload():
+    """Start a resumable upload; chunks are then sent with PATCH /api/uploads/<upload_id>."""
     data = request.get_json()
-    message_id = data.get('message_id')
+    filename = data.get('filename') or ''
+    size = data.get('size')
+    recipient_id = data.get('recipient_id') and int(data['recipient_id'])
+    group_id = data.get('group_id') and int(data['group_id'])
+    
+    error = check_attachment_target(recipient_id, group_id)
+    if error is not None:
+        return error
+    if not attachment_type(filename):
+        return jsonify({'status': 'error', 'message': 'File type not allowed'}), 400
+    if not isinstance(size, int) or not 0 < size <= app.config['ATTACHMENT_MAX_SIZE']:
+        return jsonify({'status': 'error', 'message': 'Invalid file size'}), 413
+    
+    upload = UploadSession.create(current_user.id, filename, size, recipient_id=recipient_id,
+                                  group_id=group_id, caption=data.get('caption'))
+    response = upload_status(upload, 201, chunk_size=app.config['UPLOAD_CHUNK_MAX_SIZE'])
+    response.headers['Location'] = url_for('api_upload', upload_id=upload.upload_id)
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'HEAD', 'PATCH', 'DELETE'])
+@login_required
+def api_upload(upload_id):
+    upload = UploadSession.load(upload_id, current_user.id)
+    if upload is None:
+        return jsonify({'status': 'error', 'message': 'Upload not found'}), 404
     
-    message = Message.query.get(message_id)
-    if message and (message.recipient_id == current_user.id or 
-                   (message.group_id and current_user.id in [m.user_id for m in message.group.memberships])):
-        message.read_at = datetime.utcnow()
-        db.session.commit()
+    if request.method == 'DELETE':
+        upload.discard()
         return jsonify({'status': 'success'})
     
-    return jsonify({'status': 'error'}), 403
+    if request.method == 'PATCH':
+        request.max_content_length = app.config['UPLOAD_CHUNK_MAX_SIZE']
+        offset = upload.append(request.stream, request.headers.get('Upload-Offset', type=int),
+                               app.config['UPLOAD_CHUNK_MAX_SIZE'])
+        if offset is None:
+            # The client resumes by asking for the current offset
+            return upload_status(upload, 409)
+        
+        if upload.is_complete:
+            meta = upload.meta
+            key, file_hash = upload.finish()
+            message = send_attachment_message(key, meta['filename'], meta['size'], file_hash,
+                                              meta.get('caption'), meta.get('recipient_id'), meta.get('group_id'))
+            response = jsonify({'status': 'success', 'upload_id': upload_id, 'offset': meta['size'],
+                                'size': meta['size'], 'message': message.to_dict()})
+            response.headers['Upload-Offset'] = str(meta['size'])
+            return response
+    
+    return upload_status(upload)
+
+@app.route('/api/mark_read', methods=['POST'])
+@login_required
+def api_mark_read():
+    data = request.get_json(silent=True) or {}
+    key = data.get('conversation')
+    try:
+        message_id = int(data.get('message_id') or 0)
+        up_to = int(data.get('up_to_message_id') or message_id)
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Invalid message id'}), 400
+    
+    if not key and message_id:
+        # Single-message form: read the conversation up to that message
+        message = Message.query.get(message_id)
+        key = message.conversation_key if message else None
+    
+    up_to = newest_read_position(key, up_to) if key and up_to else None
+    read_at = mark_conversation_read(current_user.id, key, up_to) if up_to else None
+    if read_at is None:
+        return jsonify({'status': 'error'}), 403
+    
+    if read_at:
+        db.session.commit()
+        send_read_receipt(current_user, key, up_to, read_at)
+    return jsonify({'status': 'success'})
 
 @app.route('/api/typing', methods=['POST'])
 @login_required
 def api_typing():
     data = request.get_json()
     room = data.get('room')
-    is_typing = data.get('is_typing', False)
+    if not is_room_member(current_user.id, room):
+        return jsonify({'status': 'error', 'message': 'Access denied'}), 403
     
-    socketio.emit('typing_status', {
-        'user': current_user.get_display_name(),
-        'is_typing': is_typing
-    }, to=room, include_self=False)
+    typing_aggregator.update(room, current_user.id, current_user.get_display_name(),
+                             bool(data.get('is_typing', False)))
     
     return jsonify({'status': 'success'})
 
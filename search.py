@@ -0,0 +1,209 @@
+import logging
+import re
+
+from markupsafe import escape
+from sqlalchemy import event, func, or_, text
+from sqlalchemy.orm import joinedload
+
+from app import db
+from models import User, Message, Conversation
+
+SEARCH_RESULT_LIMIT = 20
+MESSAGE_SEARCH_PAGE_SIZE = 20
+
+# Highlight markers used inside database snippets; replaced by <mark> after HTML-escaping
+HIGHLIGHT_START = '\ue000'
+HIGHLIGHT_STOP = '\ue001'
+
+# Postgres: trigram index for substring matches plus a tsvector index for ranked prefix matches
+POSTGRES_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_search_trgm ON users USING gin (search_text gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_search_tsv ON users "
+    "USING gin (to_tsvector('simple', coalesce(search_text, '')))",
+    "CREATE INDEX IF NOT EXISTS ix_message_content_tsv ON message "
+    "USING gin (to_tsvector('simple', coalesce(content, '')))",
+)
+# SQLite (local testing): a standalone FTS5 table keyed by user id
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(search_text)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(content, conversation_key UNINDEXED)",
+)
+
+def build_search_text(user):
+    """Lower-cased text a user can be found by: username, names and phone number."""
+    parts = [user.username, user.first_name, user.last_name, user.phone_number]
+    if user.phone_number:
+        parts.append(re.sub(r'\D', '', user.phone_number))
+    return ' '.join(p for p in parts if p).lower()
+
+def _tokens(query):
+    return re.findall(r'\w+', query.lower())
+
+def init_search_index():
+    """Create the dialect-specific search indexes. Safe to run repeatedly."""
+    dialect = db.engine.dialect.name
+    statements = POSTGRES_DDL if dialect == 'postgresql' else SQLITE_DDL if dialect == 'sqlite' else ()
+    try:
+        with db.engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+    except Exception as e:
+        logging.error(f"Could not create the user search index: {e}")
+
+def reindex_users(batch_size=1000):
+    """Recompute search_text for every user and rebuild the SQLite FTS table."""
+    count = 0
+    last_id = 0
+    while True:
+        users = User.query.filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+        if not users:
+            break
+        for user in users:
+            user.search_text = build_search_text(user)
+        db.session.commit()
+        last_id = users[-1].id
+        count += len(users)
+
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(text("DELETE FROM user_search"))
+        db.session.execute(text(
+            "INSERT INTO user_search (rowid, search_text) SELECT id, coalesce(search_text, '') FROM users"
+        ))
+        db.session.commit()
+    return count
+
+def search_users(query, exclude_user_id=None, limit=SEARCH_RESULT_LIMIT):
+    """Ranked user search. Every term is matched as a prefix, so this also serves typeahead."""
+    tokens = _tokens(query)
+    if not tokens:
+        return []
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        sql = "SELECT rowid FROM user_search WHERE user_search MATCH :match ORDER BY rank LIMIT :limit"
+        ids = [row[0] for row in db.session.execute(text(sql), {'match': match, 'limit': limit + 1})]
+        ids = [user_id for user_id in ids if user_id != exclude_user_id][:limit]
+        users = {user.id: user for user in User.query.filter(User.id.in_(ids))} if ids else {}
+        return [users[user_id] for user_id in ids if user_id in users]
+
+    needle = query.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    results = User.query
+    if exclude_user_id is not None:
+        results = results.filter(User.id != exclude_user_id)
+
+    if dialect == 'postgresql':
+        vector = func.to_tsvector('simple', func.coalesce(User.search_text, ''))
+        ts_query = func.to_tsquery('simple', ' & '.join(f'{token}:*' for token in tokens))
+        results = results.filter(or_(
+            vector.op('@@')(ts_query),
+            User.search_text.ilike(f'%{needle}%', escape='\\')
+        )).order_by((func.ts_rank(vector, ts_query) + func.similarity(User.search_text, query.lower())).desc())
+    else:
+        results = results.filter(User.search_text.ilike(f'%{needle}%', escape='\\'))
+
+    return results.limit(limit).all()
+
+def reindex_messages():
+    """Rebuild the SQLite FTS message table. Postgres indexes message content directly."""
+    if db.engine.dialect.name != 'sqlite':
+        return 0
+    db.session.execute(text("DELETE FROM message_search"))
+    result = db.session.execute(text(
+        "INSERT INTO message_search (rowid, content, conversation_key) "
+        "SELECT id, coalesce(content, ''), conversation_key FROM message WHERE content IS NOT NULL"
+    ))
+    db.session.commit()
+    return result.rowcount
+
+def highlight(snippet):
+    """HTML-escape a database snippet and turn its highlight markers into <mark> tags."""
+    return str(escape(snippet)).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+
+def search_messages(user_id, query, before_id=None, conversation=None, limit=MESSAGE_SEARCH_PAGE_SIZE):
+    """Search message content in the conversations a user belongs to, newest first.
+
+    Returns (message, snippet) pairs and the cursor (a message id) of the
+    next page, or None when there are no more results.
+    """
+    tokens = _tokens(query)
+    if not tokens:
+        return [], None
+
+    # A user's conversations are exactly the keys in their inbox
+    keys = db.session.query(Conversation.conversation_key).filter(Conversation.user_id == user_id)
+    if conversation:
+        keys = keys.filter(Conversation.conversation_key == conversation)
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        sql = (
+            "SELECT rowid, snippet(message_search, 0, :start, :stop, '…', 12) FROM message_search "
+            "WHERE message_search MATCH :match AND conversation_key IN "
+            "(SELECT conversation_key FROM conversation WHERE user_id = :user_id"
+            + (" AND conversation_key = :conversation)" if conversation else ")")
+            + (" AND rowid < :before_id" if before_id else "")
+            + " ORDER BY rowid DESC LIMIT :limit"
+        )
+        rows = db.session.execute(text(sql), {
+            'start': HIGHLIGHT_START, 'stop': HIGHLIGHT_STOP,
+            'match': 'content : ' + ' '.join(f'"{token}"*' for token in tokens),
+            'user_id': user_id, 'conversation': conversation,
+            'before_id': before_id, 'limit': limit + 1
+        }).all()
+        messages = {m.id: m for m in Message.query.filter(
+            Message.id.in_([row[0] for row in rows])
+        ).options(joinedload(Message.sender))} if rows else {}
+        results = [(messages[row[0]], row[1]) for row in rows if row[0] in messages]
+    else:
+        results = Message.query.filter(Message.conversation_key.in_(keys))
+        if dialect == 'postgresql':
+            vector = func.to_tsvector('simple', func.coalesce(Message.content, ''))
+            ts_query = func.to_tsquery('simple', ' & '.join(f'{token}:*' for token in tokens))
+            snippet = func.ts_headline('simple', Message.content, ts_query,
+                                       f'StartSel={HIGHLIGHT_START},StopSel={HIGHLIGHT_STOP},MaxWords=20,MinWords=5')
+            results = results.filter(vector.op('@@')(ts_query))
+        else:
+            snippet = Message.content
+            for token in tokens:
+                results = results.filter(Message.content.ilike(f'%{token}%'))
+        if before_id:
+            results = results.filter(Message.id < before_id)
+        results = results.options(joinedload(Message.sender)).add_columns(snippet).order_by(
+            Message.id.desc()
+        ).limit(limit + 1).all()
+
+    next_cursor = results[limit - 1][0].id if len(results) > limit else None
+    return [(message, highlight(snippet or '')) for message, snippet in results[:limit]], next_cursor
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+def update_search_text(mapper, connection, user):
+    user.search_text = build_search_text(user)
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def sync_sqlite_index(mapper, connection, user):
+    if connection.dialect.name != 'sqlite':
+        return
+    connection.execute(text("DELETE FROM user_search WHERE rowid = :id"), {'id': user.id})
+    connection.execute(text("INSERT INTO user_search (rowid, search_text) VALUES (:id, :search_text)"),
+                       {'id': user.id, 'search_text': user.search_text or ''})
+
+@event.listens_for(User, 'after_delete')
+def remove_from_sqlite_index(mapper, connection, user):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text("DELETE FROM user_search WHERE rowid = :id"), {'id': user.id})
+
+@event.listens_for(Message, 'after_insert')
+@event.listens_for(Message, 'after_update')
+def sync_sqlite_message_index(mapper, connection, message):
+    if connection.dialect.name != 'sqlite':
+        return
+    connection.execute(text("DELETE FROM message_search WHERE rowid = :id"), {'id': message.id})
+    if message.content:
+        connection.execute(
+            text("INSERT INTO message_search (rowid, content, conversation_key) VALUES (:id, :content, :key)"),
+            {'id': message.id, 'content': message.content, 'key': message.conversation_key}
+        )
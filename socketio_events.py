@@ -1,37 +1,52 @@
-from flask_socketio import emit, join_room, leave_room, rooms
+from flask_socketio import emit, join_room, leave_room
 from flask_login import current_user
 from datetime import datetime
-from app import socketio, db
-from models import User, Message, Group, GroupMembership
+from flask import request
+from app import app, socketio, db
+from models import Message, conversation_key
+from inbox import (record_message, mark_conversation_read, newest_read_position, mark_conversation_delivered,
+                   send_read_receipt, get_sync_cursors, iter_missed_messages,
+                   SYNC_CONVERSATION_LIMIT, SYNC_MAX_CONVERSATIONS)
+from membership_cache import is_group_member, is_room_member
+from message_writer import message_id_allocator, message_writer
+from presence import presence_registry, get_presence_rooms
+from subscriptions import conversation_rooms, subscribe_current_socket, unsubscribe_socket
+from typing_indicator import typing_aggregator
+from user_cache import load_cached_user
+from wire import message_event, status_event, online_users_event
 
 @socketio.on('connect')
 def on_connect():
     if current_user.is_authenticated:
-        # Update user status to online
-        current_user.is_online = True
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        # Personal and group rooms are joined here, so clients never join per conversation
+        subscribe_current_socket(current_user.id, request.sid)
         
-        emit('status_update', {
-            'user_id': current_user.id,
-            'status': 'online'
-        }, broadcast=True)
+        # Only the first connection of a user is a status change
+        if presence_registry.connect(current_user.id):
+            current_user.is_online = True
+            current_user.last_seen = datetime.utcnow()
+            db.session.commit()
+            
+            presence_rooms = get_presence_rooms(current_user.id)
+            if presence_rooms:
+                emit('status_update', status_event(current_user.id, True), to=presence_rooms)
         
         print(f"User {current_user.get_display_name()} connected")
 
 @socketio.on('disconnect')
-def on_disconnect():
+def on_disconnect(reason=None):
     if current_user.is_authenticated:
-        # Update user status to offline
-        current_user.is_online = False
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        unsubscribe_socket(current_user.id, request.sid)
         
-        emit('status_update', {
-            'user_id': current_user.id,
-            'status': 'offline',
-            'last_seen': current_user.last_seen.isoformat()
-        }, broadcast=True)
+        # Other tabs or devices may still be connected
+        if presence_registry.disconnect(current_user.id):
+            current_user.is_online = False
+            current_user.last_seen = datetime.utcnow()
+            db.session.commit()
+            
+            presence_rooms = get_presence_rooms(current_user.id)
+            if presence_rooms:
+                emit('status_update', status_event(current_user.id, False, current_user.last_seen), to=presence_rooms)
         
         print(f"User {current_user.get_display_name()} disconnected")
 
@@ -40,21 +55,13 @@ def on_join_room(data):
     if not current_user.is_authenticated:
         return
     
-    room = data['room']
-    room_type = data.get('type', 'direct')  # direct or group
-    
-    if room_type == 'group':
-        # Verify user is a member of the group
-        group_id = int(room.split('_')[1])  # Format: group_123
-        membership = GroupMembership.query.filter_by(
-            user_id=current_user.id,
-            group_id=group_id
-        ).first()
-        
-        if not membership:
-            emit('error', {'message': 'Not authorized to join this room'})
-            return
-    
+    room = data.get('room')
+
+    # Whatever type the client claims; personal rooms ('user_{id}') are never joinable
+    if not is_room_member(current_user.id, room):
+        emit('error', {'message': 'Not authorized to join this room'})
+        return
+
     join_room(room)
     emit('joined_room', {'room': room})
     print(f"User {current_user.get_display_name()} joined room {room}")
@@ -83,38 +90,46 @@ def on_send_message(data):
     
     # Set recipient or group
     if data.get('recipient_id'):
-        message.recipient_id = data['recipient_id']
-        room = f"user_{min(current_user.id, data['recipient_id'])}_{max(current_user.id, data['recipient_id'])}"
-    elif data.get('group_id'):
-        message.group_id = data['group_id']
-        room = f"group_{data['group_id']}"
+        message.recipient_id = int(data['recipient_id'])
+        room = conversation_key(current_user.id, message.recipient_id)
         
-        # Verify user is a member
-        membership = GroupMembership.query.filter_by(
-            user_id=current_user.id,
-            group_id=data['group_id']
-        ).first()
+        # Checked before broadcasting; an unknown id would also fail the writer's whole batch
+        if load_cached_user(message.recipient_id) is None:
+            emit('error', {'message': 'Invalid message destination'})
+            return
+    elif data.get('group_id'):
+        message.group_id = int(data['group_id'])
+        room = conversation_key(group_id=message.group_id)
         
-        if not membership:
+        # Verify user is a member (cached, no SQL on the hot path)
+        if not is_group_member(current_user.id, message.group_id):
             emit('error', {'message': 'Not authorized to send messages to this group'})
             return
     else:
         emit('error', {'message': 'Invalid message destination'})
         return
     
-    db.session.add(message)
-    db.session.commit()
+    if app.config['MESSAGE_WRITE_BEHIND']:
+        # Broadcast first; the row is inserted by the background writer and acked later
+        message.id = message_id_allocator.next_id()
+        message.timestamp = datetime.utcnow()
+        message_writer.submit({
+            'id': message.id,
+            'content': message.content,
+            'sender_id': message.sender_id,
+            'recipient_id': message.recipient_id,
+            'group_id': message.group_id,
+            'message_type': message.message_type,
+            'timestamp': message.timestamp
+        }, sid=request.sid)
+    else:
+        db.session.add(message)
+        db.session.flush()
+        record_message(message)
+        db.session.commit()
     
     # Broadcast message to room
-    emit('new_message', {
-        'message_id': message.id,
-        'content': message.content,
-        'sender_id': current_user.id,
-        'sender_name': current_user.get_display_name(),
-        'sender_image': current_user.profile_image_url,
-        'timestamp': message.timestamp.isoformat(),
-        'message_type': message.message_type
-    }, to=room)
+    emit('new_message', message_event(message, current_user), to=conversation_rooms(room))
     
     print(f"Message sent by {current_user.get_display_name()} to room {room}")
 
@@ -123,49 +138,96 @@ def on_typing(data):
     if not current_user.is_authenticated:
         return
     
-    room = data['room']
-    is_typing = data.get('is_typing', False)
+    room = data.get('room')
+    if not is_room_member(current_user.id, room):
+        return
     
-    emit('user_typing', {
-        'user_id': current_user.id,
-        'user_name': current_user.get_display_name(),
-        'is_typing': is_typing
-    }, to=room, include_self=False)
+    # Coalesced into the room's next user_typing digest
+    typing_aggregator.update(room, current_user.id, current_user.get_display_name(),
+                             bool(data.get('is_typing', False)))
 
 @socketio.on('mark_read')
 def on_mark_read(data):
     if not current_user.is_authenticated:
         return
     
-    message_id = data.get('message_id')
-    message = Message.query.get(message_id)
+    key = data.get('conversation')
+    try:
+        message_id = int(data.get('message_id') or 0)
+        up_to = int(data.get('up_to_message_id') or message_id)
+    except (TypeError, ValueError):
+        return
+    
+    if not key and message_id:
+        # Single-message form: read the conversation up to that message
+        message = Message.query.get(message_id)
+        key = message.conversation_key if message else None
     
-    if message and (message.recipient_id == current_user.id):
-        message.read_at = datetime.utcnow()
+    up_to = newest_read_position(key, up_to) if key and up_to else None
+    read_at = mark_conversation_read(current_user.id, key, up_to) if up_to else None
+    if not read_at:
+        return
+    
+    db.session.commit()
+    
+    # One receipt covers every message up to up_to
+    send_read_receipt(current_user, key, up_to, read_at)
+
+@socketio.on('sync')
+def on_sync(data):
+    """Send a reconnecting client the messages it missed while disconnected.
+
+    The client passes the last message id it has per conversation and
+    since_id, the newest id it has seen in any conversation. Missed messages
+    arrive as sync_messages batches per conversation, followed by one
+    sync_complete listing conversations with more than SYNC_CONVERSATION_LIMIT
+    missed messages, which the client should reload instead.
+    """
+    if not current_user.is_authenticated:
+        return
+    
+    try:
+        since_id = int(data['since_id']) if data.get('since_id') else None
+        requested = list((data.get('conversations') or {}).items())[:SYNC_MAX_CONVERSATIONS]
+        cursors = {key: int(last_id or 0) for key, last_id in requested if is_room_member(current_user.id, key)}
+    except (AttributeError, TypeError, ValueError):
+        emit('error', {'message': 'Invalid sync request'})
+        return
+    
+    truncated = []
+    for key, after_id in get_sync_cursors(current_user.id, cursors, since_id).items():
+        sent = 0
+        for batch in iter_missed_messages(key, after_id):
+            emit('sync_messages', {'conversation': key, 'messages': [message_event(message) for message in batch]})
+            sent += len(batch)
+            # Let other events through between batches
+            socketio.sleep(0)
+        if sent >= SYNC_CONVERSATION_LIMIT:
+            truncated.append(key)
+    
+    emit('sync_complete', {'truncated': truncated})
+
+@socketio.on('messages_delivered')
+def on_messages_delivered(data):
+    if not current_user.is_authenticated:
+        return
+    
+    key = data.get('conversation')
+    try:
+        up_to = int(data.get('up_to_message_id') or 0)
+    except (TypeError, ValueError):
+        return
+    if key and up_to and mark_conversation_delivered(current_user.id, key, up_to):
         db.session.commit()
-        
-        # Notify sender about read receipt
-        emit('message_read', {
-            'message_id': message_id,
-            'read_by': current_user.id,
-            'read_at': message.read_at.isoformat()
-        }, to=f"user_{message.sender_id}")
 
 @socketio.on('get_online_users')
 def on_get_online_users():
     if not current_user.is_authenticated:
         return
     
-    online_users = User.query.filter_by(is_online=True).all()
-    emit('online_users', {
-        'users': [
-            {
-                'id': user.id,
-                'name': user.get_display_name(),
-                'image': user.profile_image_url
-            } for user in online_users if user.id != current_user.id
-        ]
-    })
+    online_ids = presence_registry.online_user_ids()
+    online_ids.discard(current_user.id)
+    emit('online_users', online_users_event(online_ids))
 
 @socketio.on_error_default
 def default_error_handler(e):
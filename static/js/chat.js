@@ -2,13 +2,26 @@
 class ChatApp {
     constructor() {
         this.socket = null;
-        this.currentRoom = null;
         this.currentUser = null;
         this.isTyping = false;
         this.typingTimeout = null;
+        this.typingSentAt = 0;
         this.messageContainer = null;
         this.messageInput = null;
         this.messageForm = null;
+        this.historyUrl = null;
+        this.historyCursor = null;
+        this.isLoadingHistory = false;
+        this.pendingReadUpTo = 0;
+        this.readTimeout = null;
+        this.lastMessageId = 0;
+        this.pendingDelivered = {};
+        this.deliveredTimeout = null;
+        this.uploadChunkSize = 8 * 1024 * 1024;
+        this.compactEvents = window.SOCKET_COMPACT_EVENTS || false;
+        this.userDirectory = new Map();
+        this.userDirectoryBatchSize = 100;  // USER_DIRECTORY_MAX_IDS in routes.py
+        this.inboundEvents = Promise.resolve();
         
         this.init();
     }
@@ -22,7 +35,9 @@ class ChatApp {
     
     setupSocketConnection() {
         if (typeof io !== 'undefined') {
-            this.socket = io();
+            this.socket = io({
+                transports: window.SOCKETIO_TRANSPORTS || ['polling', 'websocket']
+            });
             this.setupSocketEvents();
         }
     }
@@ -32,6 +47,8 @@ class ChatApp {
         this.socket.on('connect', () => {
             console.log('Connected to server');
             this.updateConnectionStatus(true);
+            // Fetch whatever was sent while this socket was down
+            this.syncMissedMessages();
         });
         
         this.socket.on('disconnect', () => {
@@ -41,7 +58,25 @@ class ChatApp {
         
         // Message events
         this.socket.on('new_message', (data) => {
-            this.handleNewMessage(data);
+            this.receive(data, message => this.expandMessages([message]), messages => {
+                this.handleNewMessage(messages[0]);
+            });
+        });
+        
+        this.socket.on('sync_messages', (data) => {
+            this.receive(data, batch => this.expandMessages(batch.messages).then(messages => ({
+                conversation: batch.conversation,
+                messages: messages
+            })), batch => this.handleSyncedMessages(batch));
+        });
+        
+        this.socket.on('sync_complete', (data) => {
+            this.receive(data, complete => complete, complete => {
+                // Too much was missed in the open conversation to patch in; reload it
+                if (complete.truncated.includes(this.getCurrentConversation())) {
+                    window.location.reload();
+                }
+            });
         });
         
         this.socket.on('user_typing', (data) => {
@@ -52,12 +87,16 @@ class ChatApp {
             this.handleMessageRead(data);
         });
         
+        this.socket.on('message_ack', (data) => {
+            this.handleMessageAck(data);
+        });
+        
         this.socket.on('status_update', (data) => {
-            this.handleUserStatusUpdate(data);
+            this.receive(data, status => this.expandStatus(status), status => this.handleUserStatusUpdate(status));
         });
         
         this.socket.on('online_users', (data) => {
-            this.updateOnlineUsers(data.users);
+            this.receive(data, online => this.expandOnlineUsers(online), online => this.updateOnlineUsers(online.users));
         });
         
         // Error handling
@@ -67,6 +106,72 @@ class ChatApp {
         });
     }
     
+    receive(data, expand, handler) {
+        if (!this.compactEvents) {
+            handler(data);
+            return;
+        }
+        // Compact events may need a directory lookup; handle them in arrival order regardless
+        this.inboundEvents = this.inboundEvents
+            .then(() => expand(data))
+            .then(handler)
+            .catch(error => console.error('Error handling socket event:', error));
+    }
+    
+    resolveUsers(userIds) {
+        const missing = [...new Set(userIds)].filter(userId => userId && !this.userDirectory.has(userId));
+        if (missing.length === 0) return Promise.resolve();
+        
+        // The server accepts a limited number of ids per request
+        const requests = [];
+        for (let i = 0; i < missing.length; i += this.userDirectoryBatchSize) {
+            const ids = missing.slice(i, i + this.userDirectoryBatchSize);
+            requests.push(fetch(`/api/users/directory?ids=${ids.join(',')}`)
+                .then(response => response.json())
+                .then(data => {
+                    Object.entries(data.users || {}).forEach(([userId, user]) => {
+                        this.userDirectory.set(parseInt(userId, 10), user);
+                    });
+                }));
+        }
+        return Promise.all(requests);
+    }
+    
+    expandMessages(messages) {
+        // Compact messages (see wire.py) use short keys and epoch timestamps, and name the sender by id only
+        return this.resolveUsers(messages.map(message => message.s)).then(() => messages.map(message => {
+            const sender = this.userDirectory.get(message.s) || {};
+            return {
+                message_id: message.i,
+                content: message.c || '',
+                sender_id: message.s,
+                sender_name: sender.name || 'Unknown',
+                sender_image: sender.image || null,
+                recipient_id: message.r || null,
+                group_id: message.g || null,
+                timestamp: new Date(message.t).toISOString(),
+                message_type: message.y || 'text',
+                file_url: message.f || null,
+                file_name: message.n || null,
+                file_size: message.z || null
+            };
+        }));
+    }
+    
+    expandStatus(status) {
+        return {
+            user_id: status.u,
+            status: status.o ? 'online' : 'offline',
+            last_seen: status.l ? new Date(status.l).toISOString() : undefined
+        };
+    }
+    
+    expandOnlineUsers(online) {
+        return this.resolveUsers(online.u).then(() => ({
+            users: online.u.map(userId => Object.assign({ id: userId }, this.userDirectory.get(userId)))
+        }));
+    }
+    
     setupEventListeners() {
         // Message form submission
         this.messageForm = document.getElementById('messageForm');
@@ -138,16 +243,96 @@ class ChatApp {
             this.scrollToBottom();
         }
         
+        // Older history is fetched page by page as the user scrolls up
+        this.setupHistoryLoading();
+        
         // Setup message observer for read receipts
         this.setupMessageObserver();
     }
     
+    setupHistoryLoading() {
+        if (!this.messageContainer || !this.messageContainer.dataset.historyUrl) return;
+        
+        this.historyUrl = this.messageContainer.dataset.historyUrl;
+        this.historyCursor = this.messageContainer.dataset.historyCursor || null;
+        
+        const loadOlderBtn = document.querySelector('#loadOlderMessages button');
+        if (loadOlderBtn) {
+            loadOlderBtn.addEventListener('click', () => {
+                this.loadOlderMessages();
+            });
+        }
+        
+        this.messageContainer.addEventListener('scroll', () => {
+            if (this.messageContainer.scrollTop < 100) {
+                this.loadOlderMessages();
+            }
+        });
+    }
+    
+    loadOlderMessages() {
+        if (!this.historyCursor || this.isLoadingHistory) return;
+        
+        this.isLoadingHistory = true;
+        const url = `${this.historyUrl}?before=${encodeURIComponent(this.historyCursor)}`;
+        
+        fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            if (data.status !== 'success') {
+                throw new Error(data.message || 'Failed to load history');
+            }
+            this.prependMessages(data.messages);
+            this.historyCursor = data.next_cursor;
+            
+            if (!this.historyCursor) {
+                const loadOlder = document.getElementById('loadOlderMessages');
+                if (loadOlder) {
+                    loadOlder.remove();
+                }
+            }
+        })
+        .catch(error => {
+            console.error('Error loading older messages:', error);
+            this.showNotification('Could not load older messages', 'error');
+        })
+        .finally(() => {
+            this.isLoadingHistory = false;
+        });
+    }
+    
+    prependMessages(messages) {
+        if (!this.messageContainer || !messages.length) return;
+        
+        // Keep the current viewport anchored while content is inserted above it
+        const previousHeight = this.messageContainer.scrollHeight;
+        const loadOlder = document.getElementById('loadOlderMessages');
+        const anchor = loadOlder ? loadOlder.nextSibling : this.messageContainer.firstChild;
+        
+        const fragment = document.createDocumentFragment();
+        messages.forEach(messageData => {
+            const messageElement = this.createMessageElement(messageData);
+            messageElement.style.opacity = '1';
+            messageElement.style.transform = 'none';
+            fragment.appendChild(messageElement);
+        });
+        
+        this.messageContainer.insertBefore(fragment, anchor);
+        this.messageContainer.scrollTop += this.messageContainer.scrollHeight - previousHeight;
+    }
+    
     loadCurrentUser() {
         // Get current user info from the page
         const userElement = document.querySelector('[data-current-user]');
         if (userElement) {
             this.currentUser = JSON.parse(userElement.dataset.currentUser);
         }
+        
+        // Newest message id the page was rendered with, from the inbox and the open conversation
+        document.querySelectorAll('[data-last-message-id], .message[data-message-id]').forEach(element => {
+            const messageId = parseInt(element.dataset.lastMessageId || element.dataset.messageId, 10) || 0;
+            this.lastMessageId = Math.max(this.lastMessageId, messageId);
+        });
     }
     
     sendMessage() {
@@ -187,37 +372,36 @@ class ChatApp {
     sendAttachment() {
         const fileInput = document.getElementById('attachmentFile');
         const captionInput = document.getElementById('attachmentCaption');
+        const file = fileInput.files[0];
         
-        if (!fileInput.files[0]) {
+        if (!file) {
             this.showNotification('Please select a file', 'warning');
             return;
         }
         
-        const formData = new FormData();
-        formData.append('file', fileInput.files[0]);
-        formData.append('caption', captionInput.value || '');
-        
         // Determine recipient
+        const target = {};
         const chatContainer = document.querySelector('[data-chat-type]');
         if (chatContainer) {
             const chatType = chatContainer.dataset.chatType;
             const chatId = chatContainer.dataset.chatId;
             
             if (chatType === 'direct') {
-                formData.append('recipient_id', chatId);
+                target.recipient_id = chatId;
             } else if (chatType === 'group') {
-                formData.append('group_id', chatId);
+                target.group_id = chatId;
             }
         }
         
         // Show upload progress
         this.showLoading();
         
-        fetch('/api/send_attachment', {
-            method: 'POST',
-            body: formData
-        })
-        .then(response => response.json())
+        // Large files go through a resumable upload so a dropped connection does not restart them
+        const upload = file.size > this.uploadChunkSize
+            ? this.uploadResumable(file, target, captionInput.value || '')
+            : this.uploadSingle(file, target, captionInput.value || '');
+        
+        upload
         .then(data => {
             this.hideLoading();
             if (data.status === 'success') {
@@ -229,7 +413,7 @@ class ChatApp {
                 fileInput.value = '';
                 captionInput.value = '';
             } else {
-                this.showNotification('Failed to send attachment', 'error');
+                this.showNotification(data.message || 'Failed to send attachment', 'error');
             }
         })
         .catch(error => {
@@ -239,8 +423,73 @@ class ChatApp {
         });
     }
     
+    uploadSingle(file, target, caption) {
+        const formData = new FormData();
+        Object.entries(target).forEach(([key, value]) => formData.append(key, value));
+        formData.append('caption', caption);
+        formData.append('file', file);
+        
+        return fetch('/api/send_attachment', {
+            method: 'POST',
+            body: formData
+        }).then(response => response.json());
+    }
+    
+    uploadResumable(file, target, caption) {
+        // Remember the upload id so a retry of the same file continues where it stopped
+        const storageKey = `upload:${file.name}:${file.size}:${file.lastModified}:${JSON.stringify(target)}`;
+        const savedId = localStorage.getItem(storageKey);
+        
+        const start = savedId
+            ? fetch(`/api/uploads/${savedId}`).then(response => response.ok ? response.json() : null)
+            : Promise.resolve(null);
+        
+        return start
+        .then(status => status || fetch('/api/uploads', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({...target, caption: caption, filename: file.name, size: file.size})
+        }).then(response => response.json()))
+        .then(status => {
+            if (status.status !== 'success') return status;
+            localStorage.setItem(storageKey, status.upload_id);
+            return this.sendUploadChunks(file, status.upload_id, status.offset, status.chunk_size || this.uploadChunkSize);
+        })
+        .then(result => {
+            if (result.status === 'success') {
+                localStorage.removeItem(storageKey);
+            }
+            return result;
+        });
+    }
+    
+    sendUploadChunks(file, uploadId, offset, chunkSize) {
+        return fetch(`/api/uploads/${uploadId}`, {
+            method: 'PATCH',
+            headers: {'Upload-Offset': String(offset)},
+            body: file.slice(offset, offset + chunkSize)
+        })
+        .then(response => response.json())
+        .then(data => {
+            // A 409 carries the server's offset; continue from there
+            if (data.message || data.offset >= file.size || data.status !== 'success') {
+                return data;
+            }
+            return this.sendUploadChunks(file, uploadId, data.offset, chunkSize);
+        });
+    }
+    
     handleNewMessage(data) {
-        this.addMessageToChat(data);
+        this.lastMessageId = Math.max(this.lastMessageId, data.message_id);
+        if (this.currentUser && data.recipient_id === this.currentUser.id) {
+            this.markMessageDelivered(this.getMessageConversation(data), data.message_id);
+        }
+        
+        // Sockets receive every conversation of the user, not only the open one
+        const isOpenConversation = this.getMessageConversation(data) === this.getCurrentConversation();
+        if (isOpenConversation) {
+            this.addMessageToChat(data);
+        }
         this.updateConversationPreview(data);
         this.playNotificationSound();
         
@@ -249,12 +498,63 @@ class ChatApp {
             this.showDesktopNotification(data);
         }
         
-        // Mark as read if visible
-        if (!document.hidden) {
+        // Mark as read if visible and part of the open conversation
+        if (!document.hidden && isOpenConversation) {
             this.markMessageAsRead(data.message_id);
         }
     }
     
+    syncMissedMessages() {
+        const conversations = {};
+        const current = this.getCurrentConversation();
+        if (current && this.messageContainer) {
+            const ids = Array.from(this.messageContainer.querySelectorAll('.message[data-message-id]'))
+                .map(element => parseInt(element.dataset.messageId, 10) || 0);
+            conversations[current] = Math.max(0, ...ids);
+        }
+        
+        this.socket.emit('sync', {
+            conversations: conversations,
+            since_id: this.lastMessageId || null
+        });
+    }
+    
+    handleSyncedMessages(data) {
+        const isOpenConversation = data.conversation === this.getCurrentConversation();
+        data.messages.forEach(message => {
+            this.lastMessageId = Math.max(this.lastMessageId, message.message_id);
+            const rendered = this.messageContainer &&
+                this.messageContainer.querySelector(`.message[data-message-id="${message.message_id}"]`);
+            if (isOpenConversation && !rendered) {
+                this.addMessageToChat(message);
+            }
+            this.updateConversationPreview(message);
+        });
+        
+        // Acknowledge the whole batch at once; the server ignores group conversations
+        const last = data.messages[data.messages.length - 1];
+        if (last) {
+            this.markMessageDelivered(data.conversation, last.message_id);
+        }
+    }
+    
+    markMessageDelivered(conversation, messageId) {
+        if (!this.socket) return;
+        
+        // Coalesce deliveries into one "delivered up to" event per conversation and burst
+        this.pendingDelivered[conversation] = Math.max(this.pendingDelivered[conversation] || 0, messageId);
+        clearTimeout(this.deliveredTimeout);
+        this.deliveredTimeout = setTimeout(() => {
+            Object.entries(this.pendingDelivered).forEach(([key, upTo]) => {
+                this.socket.emit('messages_delivered', {
+                    conversation: key,
+                    up_to_message_id: upTo
+                });
+            });
+            this.pendingDelivered = {};
+        }, 500);
+    }
+    
     addMessageToChat(messageData) {
         if (!this.messageContainer) return;
         
@@ -312,6 +612,16 @@ class ChatApp {
                     </div>
                     ${data.content ? `<p class="mt-2">${this.escapeHtml(data.content)}</p>` : ''}
                 `;
+            case 'video':
+                return `
+                    <video src="${data.file_url}" class="message-image" controls preload="metadata"></video>
+                    ${data.content ? `<p class="mt-2">${this.escapeHtml(data.content)}</p>` : ''}
+                `;
+            case 'audio':
+                return `
+                    <audio src="${data.file_url}" controls preload="metadata"></audio>
+                    ${data.content ? `<p class="mt-2">${this.escapeHtml(data.content)}</p>` : ''}
+                `;
             default:
                 return this.escapeHtml(data.content);
         }
@@ -319,25 +629,41 @@ class ChatApp {
     
     handleTypingIndicator(data) {
         const typingIndicator = document.getElementById('typingIndicator');
-        if (!typingIndicator) return;
+        if (!typingIndicator || data.room !== this.getCurrentConversation()) return;
         
         const typingText = typingIndicator.querySelector('.typing-text');
         
-        if (data.is_typing && data.user_id !== this.currentUser.id) {
-            typingText.textContent = `${data.user_name} is typing...`;
-            typingIndicator.style.display = 'block';
-        } else {
+        // Each digest lists everyone currently typing in the room
+        const names = data.typing
+            .filter(typist => typist.user_id !== this.currentUser.id)
+            .map(typist => typist.user_name);
+        
+        if (names.length === 0) {
             typingIndicator.style.display = 'none';
+            return;
+        }
+        
+        if (names.length === 1) {
+            typingText.textContent = `${names[0]} is typing...`;
+        } else if (names.length <= 3) {
+            typingText.textContent = `${names.slice(0, -1).join(', ')} and ${names[names.length - 1]} are typing...`;
+        } else {
+            typingText.textContent = `${names.length} people are typing...`;
         }
+        typingIndicator.style.display = 'block';
     }
     
     handleTyping() {
-        if (!this.socket || !this.currentRoom) return;
+        const room = this.getCurrentConversation();
+        if (!this.socket || !room) return;
         
-        if (!this.isTyping) {
+        // The server expires typing state after a few seconds, so refresh it while typing continues
+        const now = Date.now();
+        if (!this.isTyping || now - this.typingSentAt > 3000) {
             this.isTyping = true;
+            this.typingSentAt = now;
             this.socket.emit('typing', {
-                room: this.currentRoom,
+                room: room,
                 is_typing: true
             });
         }
@@ -352,10 +678,11 @@ class ChatApp {
     }
     
     stopTyping() {
-        if (this.isTyping && this.socket && this.currentRoom) {
+        const room = this.getCurrentConversation();
+        if (this.isTyping && this.socket && room) {
             this.isTyping = false;
             this.socket.emit('typing', {
-                room: this.currentRoom,
+                room: room,
                 is_typing: false
             });
         }
@@ -364,21 +691,77 @@ class ChatApp {
     }
     
     handleMessageRead(data) {
-        const messageElement = document.querySelector(`[data-message-id="${data.message_id}"]`);
-        if (messageElement) {
-            const checkIcon = messageElement.querySelector('.fa-check');
-            if (checkIcon) {
-                checkIcon.className = 'fas fa-check-double text-primary ms-1';
+        if (!this.messageContainer || data.conversation !== this.getCurrentConversation()) return;
+        if (this.currentUser && data.read_by === this.currentUser.id) return;
+        
+        // One receipt covers every outgoing message up to up_to_message_id
+        this.messageContainer.querySelectorAll('.message.outgoing[data-message-id]').forEach(messageElement => {
+            if (parseInt(messageElement.dataset.messageId, 10) <= data.up_to_message_id) {
+                const checkIcon = messageElement.querySelector('.fa-check');
+                if (checkIcon) {
+                    checkIcon.className = 'fas fa-check-double text-primary ms-1';
+                }
             }
-        }
+        });
+    }
+    
+    handleMessageAck(data) {
+        // Messages are broadcast before they are stored; only failures need attention
+        if (data.status !== 'failed') return;
+        
+        data.message_ids.forEach(messageId => {
+            const messageElement = this.messageContainer &&
+                this.messageContainer.querySelector(`.message.outgoing[data-message-id="${messageId}"]`);
+            if (messageElement) {
+                messageElement.classList.add('message-failed');
+                const checkIcon = messageElement.querySelector('.fa-check, .fa-check-double');
+                if (checkIcon) {
+                    checkIcon.className = 'fas fa-exclamation-circle text-danger ms-1';
+                    checkIcon.title = 'Not saved';
+                }
+            }
+        });
+        this.showNotification('A message could not be saved. Please send it again.', 'error');
     }
     
     markMessageAsRead(messageId) {
         if (!this.socket) return;
         
+        // Coalesce reads into a single "read up to" event per burst
+        this.pendingReadUpTo = Math.max(this.pendingReadUpTo, parseInt(messageId, 10) || 0);
+        clearTimeout(this.readTimeout);
+        this.readTimeout = setTimeout(() => {
+            this.flushReadReceipts();
+        }, 500);
+    }
+    
+    flushReadReceipts() {
+        const conversation = this.getCurrentConversation();
+        if (!conversation || !this.pendingReadUpTo) return;
+        
         this.socket.emit('mark_read', {
-            message_id: messageId
+            conversation: conversation,
+            up_to_message_id: this.pendingReadUpTo
         });
+        this.pendingReadUpTo = 0;
+    }
+    
+    getCurrentConversation() {
+        const chatContainer = document.querySelector('[data-chat-type]');
+        if (!chatContainer || !this.currentUser) return null;
+        
+        const chatId = chatContainer.dataset.chatId;
+        if (chatContainer.dataset.chatType === 'group') {
+            return `group_${chatId}`;
+        }
+        return this.getDirectChatRoom(this.currentUser.id, chatId);
+    }
+    
+    getMessageConversation(messageData) {
+        if (messageData.group_id) {
+            return `group_${messageData.group_id}`;
+        }
+        return this.getDirectChatRoom(messageData.sender_id, messageData.recipient_id);
     }
     
     markVisibleMessagesAsRead() {
@@ -432,37 +815,17 @@ class ChatApp {
     }
     
     openDirectChat(userId) {
-        if (this.currentRoom) {
-            this.socket.emit('leave_room', { room: this.currentRoom });
-        }
-        
-        this.currentRoom = this.getDirectChatRoom(this.currentUser.id, userId);
-        this.socket.emit('join_room', {
-            room: this.currentRoom,
-            type: 'direct'
-        });
-        
-        // Navigate to chat
+        // No join_room needed: the server subscribes each socket to all of the user's conversations
         window.location.href = `/chat/${userId}`;
     }
     
     openGroupChat(groupId) {
-        if (this.currentRoom) {
-            this.socket.emit('leave_room', { room: this.currentRoom });
-        }
-        
-        this.currentRoom = `group_${groupId}`;
-        this.socket.emit('join_room', {
-            room: this.currentRoom,
-            type: 'group'
-        });
-        
-        // Navigate to group
+        // No join_room needed: the server subscribes each socket to all of the user's conversations
         window.location.href = `/groups/${groupId}`;
     }
     
     getDirectChatRoom(userId1, userId2) {
-        const sortedIds = [userId1, userId2].sort();
+        const sortedIds = [parseInt(userId1, 10), parseInt(userId2, 10)].sort((a, b) => a - b);
         return `user_${sortedIds[0]}_${sortedIds[1]}`;
     }
     
@@ -504,10 +867,19 @@ class ChatApp {
     }
     
     updateConversationPreview(messageData) {
-        const conversationItem = document.querySelector(`[data-user-id="${messageData.sender_id}"]`);
+        let selector;
+        if (messageData.group_id) {
+            selector = `.conversation-item[data-group-id="${messageData.group_id}"]`;
+        } else {
+            const partnerId = messageData.sender_id === this.currentUser.id ?
+                messageData.recipient_id : messageData.sender_id;
+            selector = `.conversation-item[data-user-id="${partnerId}"]`;
+        }
+        
+        const conversationItem = document.querySelector(selector);
         if (conversationItem) {
             const previewElement = conversationItem.querySelector('.conversation-preview');
-            if (previewElement) {
+            if (previewElement && messageData.content) {
                 previewElement.textContent = messageData.content.substring(0, 30) + '...';
             }
             
@@ -368,8 +368,13 @@ class StoriesManager {
         fetch('/api/stories')
             .then(response => response.json())
             .then(data => {
-                if (data.stories) {
-                    this.stories = data.stories;
+                if (data.groups) {
+                    this.stories = [];
+                    data.groups.forEach(group => {
+                        group.stories.forEach(story => this.stories.push(this.toViewerStory(story)));
+                    });
+                    data.my_stories.forEach(story => this.stories.push(this.toViewerStory(story)));
+                    this.since = data.since;
                 }
             })
             .catch(error => {
@@ -377,6 +382,48 @@ class StoriesManager {
             });
     }
     
+    loadStoryChanges() {
+        // Only stories and view counts changed since the last response are sent
+        fetch(`/api/stories?since=${encodeURIComponent(this.since)}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.reset) {
+                    this.loadStoriesFromAPI();
+                    return;
+                }
+                // The sync token is taken before the feed is read, so a story can arrive twice
+                const known = new Set(this.stories.map(story => parseInt(story.id)));
+                data.stories.forEach(story => {
+                    if (!known.has(story.id)) {
+                        known.add(story.id);
+                        this.stories.push(this.toViewerStory(story));
+                    }
+                });
+                this.stories.forEach(story => {
+                    if (data.view_counts[story.id] !== undefined) {
+                        story.viewCount = data.view_counts[story.id];
+                    }
+                });
+                this.since = data.since;
+            })
+            .catch(error => {
+                console.error('Error loading story updates:', error);
+            });
+    }
+    
+    toViewerStory(story) {
+        return {
+            id: story.id,
+            authorName: story.author_name,
+            authorAvatar: story.author_image || '',
+            timestamp: new Date(story.created_at + 'Z').toLocaleString(),
+            mediaUrl: story.media_url || '',
+            mediaType: story.media_type || 'image',
+            caption: story.content || '',
+            viewCount: story.view_count || 0
+        };
+    }
+    
     openStory(storyId) {
         const storyIndex = this.stories.findIndex(story => 
             parseInt(story.id) === parseInt(storyId)
@@ -666,7 +713,11 @@ class StoriesManager {
     }
     
     refreshStories() {
-        this.loadStoriesFromAPI();
+        if (this.since) {
+            this.loadStoryChanges();
+        } else {
+            this.loadStoriesFromAPI();
+        }
         
         // Refresh story elements
         setTimeout(() => {
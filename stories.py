@@ -0,0 +1,335 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import and_, case, delete, desc, event, func, or_
+from sqlalchemy.orm import joinedload
+
+from app import app, db
+from media_store import release_media
+from models import User, Story, StoryView, Contact, BlockedUser
+from user_cache import UserCache, RedisUserCache
+from utils import encode_cursor
+
+STORY_FEED_PAGE_SIZE = 20
+# New stories returned by one incremental poll; beyond that the client reloads the feed
+STORY_CHANGES_LIMIT = 200
+
+def visible_story_filter(viewer_id, author_ids=None):
+    """Stories the viewer may see by each story's visibility setting, optionally only of author_ids."""
+    viewer_is_contact = db.session.query(Contact.user_id).filter(Contact.contact_id == viewer_id)
+    if author_ids is not None:
+        viewer_is_contact = viewer_is_contact.filter(Contact.user_id.in_(author_ids))
+    return or_(
+        Story.user_id == viewer_id,
+        Story.visibility == 'everyone',
+        and_(Story.visibility == 'contacts', Story.user_id.in_(viewer_is_contact))
+    )
+
+def stories_with_view_counts(query):
+    """Turn a Story query into (story, view_count) rows with the author eagerly loaded."""
+    view_counts = db.session.query(
+        StoryView.story_id,
+        func.count(StoryView.id).label('view_count')
+    ).group_by(StoryView.story_id).subquery()
+    
+    return query.outerjoin(
+        view_counts, view_counts.c.story_id == Story.id
+    ).add_columns(func.coalesce(view_counts.c.view_count, 0)).options(joinedload(Story.author))
+
+def get_story_feed(viewer_id, cursor=None, limit=STORY_FEED_PAGE_SIZE):
+    """Return one page of the viewer's story feed, grouped by author.
+
+    Authors are read from the users table in order of their newest story
+    (see update_story_summary), so a page costs O(authors shown) no matter
+    how many stories are active. Each author's visible, unexpired stories
+    are then loaded for the page in one query. Returns (author, [stories])
+    groups, newest author first, and the cursor of the next page or None.
+    """
+    now = datetime.utcnow()
+    blocked_by = db.session.query(BlockedUser.blocker_id).filter(BlockedUser.blocked_id == viewer_id)
+    groups = []
+
+    while len(groups) <= limit:
+        authors = User.query.filter(
+            User.stories_expire_at > now,
+            User.id != viewer_id,
+            User.id.notin_(blocked_by)
+        )
+        if cursor:
+            last_story_at, author_id = cursor
+            authors = authors.filter(or_(
+                User.last_story_at < last_story_at,
+                and_(User.last_story_at == last_story_at, User.id < author_id)
+            ))
+        authors = authors.order_by(desc(User.last_story_at), desc(User.id)).limit(limit + 1).all()
+        if not authors:
+            break
+        cursor = (authors[-1].last_story_at, authors[-1].id)
+
+        author_ids = [author.id for author in authors]
+        stories_by_author = {}
+        for story in Story.query.filter(
+            Story.user_id.in_(author_ids),
+            Story.expires_at > now,
+            visible_story_filter(viewer_id, author_ids)
+        ).order_by(Story.created_at, Story.id):
+            stories_by_author.setdefault(story.user_id, []).append(story)
+
+        # Authors whose stories are all hidden from this viewer are skipped
+        groups.extend((author, stories_by_author[author.id]) for author in authors if author.id in stories_by_author)
+        if len(authors) <= limit:
+            break
+
+    next_cursor = None
+    if len(groups) > limit:
+        groups = groups[:limit]
+        author = groups[-1][0]
+        next_cursor = encode_cursor(author.last_story_at, author.id)
+    return groups, next_cursor
+
+class RedisStoryFeedCache(RedisUserCache):
+    KEY = 'prochat:story-feed:{}'
+
+class RedisStorySyncTokens(RedisUserCache):
+    KEY = 'prochat:story-feed:sync:{}'
+
+class StoryFeedCache:
+    """Per-viewer cache of the serialized first page of the story feed.
+
+    Entries are dropped for the viewers a new story or view affects. A story
+    visible to everyone affects every viewer, so instead of deleting entries
+    it bumps a generation number that makes all of them stale at once.
+
+    Each viewer also has a version number that invalidate() bumps. The sync
+    token a viewer was last answered with is stored together with the
+    generation and version read before answering, so it stays valid exactly
+    as long as neither has moved since.
+    """
+
+    GENERATION_KEY = 'prochat:story-feed:generation'
+    VERSIONS_KEY = 'prochat:story-feed:versions'
+
+    def __init__(self, ttl=60, redis_url=None):
+        self._generation = 0
+        self._versions = {}
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url)
+            self._entries = RedisStoryFeedCache(redis_url, ttl=ttl)
+            self._sync_tokens = RedisStorySyncTokens(redis_url, ttl=ttl)
+        else:
+            self._entries = UserCache(ttl=ttl)
+            self._sync_tokens = UserCache(ttl=ttl)
+
+    def generation(self):
+        if self._redis is not None:
+            return int(self._redis.get(self.GENERATION_KEY) or 0)
+        return self._generation
+
+    def state(self, viewer_id):
+        """[generation, viewer version]; read it before querying what a sync token covers."""
+        if self._redis is not None:
+            pipe = self._redis.pipeline()
+            pipe.get(self.GENERATION_KEY)
+            pipe.hget(self.VERSIONS_KEY, viewer_id)
+            return [int(value or 0) for value in pipe.execute()]
+        return [self._generation, self._versions.get(viewer_id, 0)]
+
+    def get(self, viewer_id):
+        entry = self._entries.get(viewer_id)
+        if entry is None or entry['generation'] != self.generation():
+            return None
+        return entry['feed']
+
+    def set(self, viewer_id, feed, generation):
+        self._entries.set(viewer_id, {'generation': generation, 'feed': feed})
+
+    def get_sync_token(self, viewer_id, state):
+        entry = self._sync_tokens.get(viewer_id)
+        if entry is None or entry['state'] != state:
+            return None
+        return entry['since']
+
+    def set_sync_token(self, viewer_id, since, state):
+        self._sync_tokens.set(viewer_id, {'state': state, 'since': since})
+
+    def invalidate(self, *viewer_ids):
+        for viewer_id in viewer_ids:
+            self._entries.invalidate(viewer_id)
+            if self._redis is not None:
+                self._redis.hincrby(self.VERSIONS_KEY, viewer_id)
+            else:
+                self._versions[viewer_id] = self._versions.get(viewer_id, 0) + 1
+
+    def invalidate_all(self):
+        if self._redis is not None:
+            self._redis.incr(self.GENERATION_KEY)
+        else:
+            self._generation += 1
+
+story_feed_cache = StoryFeedCache(ttl=app.config['STORY_FEED_CACHE_TTL'], redis_url=app.config['REDIS_URL'])
+
+def invalidate_story_feeds(story):
+    """Drop the cached feeds a new story shows up in."""
+    if story.visibility == 'everyone':
+        story_feed_cache.invalidate_all()
+        return
+    viewers = [story.user_id]
+    if story.visibility == 'contacts':
+        viewers += [contact_id for contact_id, in db.session.query(Contact.contact_id).filter(
+            Contact.user_id == story.user_id
+        )]
+    story_feed_cache.invalidate(*viewers)
+
+def serialize_feed_groups(groups):
+    return [
+        {
+            'author': {
+                'id': author.id,
+                'name': author.get_display_name(),
+                'image': author.profile_image_url
+            },
+            'stories': [story.to_dict() for story in stories]
+        }
+        for author, stories in groups
+    ]
+
+def _sync_token():
+    # Taken before the feed is read, so a story created meanwhile is sent again rather than missed
+    return encode_cursor(datetime.utcnow(), db.session.query(func.max(Story.id)).scalar() or 0)
+
+def get_feed_snapshot(viewer_id):
+    """The viewer's first feed page and own stories, served from the feed cache when possible.
+
+    The returned 'since' token is passed back to get_feed_changes to poll for updates.
+    """
+    feed = story_feed_cache.get(viewer_id)
+    if feed is not None:
+        return feed
+
+    state = story_feed_cache.state(viewer_id)
+    generation = state[0]
+    since = _sync_token()
+    groups, next_cursor = get_story_feed(viewer_id)
+    my_stories = stories_with_view_counts(Story.query.filter(
+        Story.user_id == viewer_id,
+        Story.expires_at > datetime.utcnow()
+    )).order_by(desc(Story.created_at)).all()
+
+    feed = {
+        'groups': serialize_feed_groups(groups),
+        'my_stories': [story.to_dict(view_count) for story, view_count in my_stories],
+        'next_cursor': next_cursor,
+        'since': since
+    }
+    story_feed_cache.set(viewer_id, feed, generation)
+    story_feed_cache.set_sync_token(viewer_id, since, state)
+    return feed
+
+def get_feed_changes(viewer_id, since_token, since):
+    """Stories created and own-story view counts changed after a 'since' token.
+
+    since is the decoded (timestamp, last story id) of since_token. If
+    since_token is the last token the viewer was answered with and nothing
+    has invalidated the viewer's feed since, the answer is empty without
+    touching the database, so polls stay free while nothing changes. 'reset'
+    is set when there are too many new stories and the client should reload
+    the feed.
+    """
+    state = story_feed_cache.state(viewer_id)
+    if story_feed_cache.get_sync_token(viewer_id, state) == since_token:
+        # Extends the token's TTL; it is still void as soon as the state moves
+        story_feed_cache.set_sync_token(viewer_id, since_token, state)
+        return {'stories': [], 'view_counts': {}, 'reset': False, 'since': since_token}
+
+    since_at, last_story_id = since
+    now = datetime.utcnow()
+    token = _sync_token()
+    blocked_by = db.session.query(BlockedUser.blocker_id).filter(BlockedUser.blocked_id == viewer_id)
+    stories = Story.query.filter(
+        Story.id > last_story_id,
+        Story.expires_at > now,
+        Story.user_id.notin_(blocked_by),
+        visible_story_filter(viewer_id)
+    ).options(joinedload(Story.author)).order_by(Story.id).limit(STORY_CHANGES_LIMIT + 1).all()
+
+    view_counts = db.session.query(StoryView.story_id, func.count(StoryView.id)).join(Story).filter(
+        Story.user_id == viewer_id,
+        Story.expires_at > now
+    ).group_by(StoryView.story_id).having(func.max(StoryView.viewed_at) > since_at)
+
+    changes = {
+        'stories': [story.to_dict() for story in stories[:STORY_CHANGES_LIMIT]],
+        'view_counts': {str(story_id): count for story_id, count in view_counts},
+        'reset': len(stories) > STORY_CHANGES_LIMIT,
+        'since': token
+    }
+    story_feed_cache.set_sync_token(viewer_id, token, state)
+    return changes
+
+def delete_stories(story_ids):
+    """Delete stories with their views and release their media. Returns the number deleted.
+
+    Media is released only for the rows this DELETE returned, so a
+    concurrent sweep of the same stories does not drop the references twice.
+    The caller commits.
+    """
+    db.session.execute(delete(StoryView).where(StoryView.story_id.in_(story_ids)))
+    media_urls = db.session.execute(
+        delete(Story).where(Story.id.in_(story_ids)).returning(Story.media_url)
+    ).scalars().all()
+    release_media([media_url for media_url in media_urls if media_url])
+    return len(media_urls)
+
+def sweep_expired_stories(batch_size=500):
+    """Delete expired stories, their views and their media in batches. Returns the number deleted."""
+    deleted = 0
+    now = datetime.utcnow()
+    while True:
+        story_ids = [story_id for story_id, in db.session.query(Story.id).filter(
+            Story.expires_at <= now
+        ).order_by(Story.expires_at).limit(batch_size)]
+        if not story_ids:
+            return deleted
+
+        try:
+            deleted += delete_stories(story_ids)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Story sweep failed: {e}")
+            return deleted
+
+def rebuild_story_summaries():
+    """Recompute every user's last_story_at and stories_expire_at from the story table."""
+    latest = db.session.query(
+        Story.user_id,
+        db.func.max(Story.created_at),
+        db.func.max(Story.expires_at)
+    ).group_by(Story.user_id).all()
+    db.session.execute(db.update(User).values(last_story_at=None, stories_expire_at=None))
+    if latest:
+        db.session.execute(db.update(User), [
+            {'id': user_id, 'last_story_at': created_at, 'stories_expire_at': expires_at}
+            for user_id, created_at, expires_at in latest
+        ])
+    db.session.commit()
+    return len(latest)
+
+@event.listens_for(Story, 'after_insert')
+def update_story_summary(mapper, connection, story):
+    users = User.__table__
+    connection.execute(
+        users.update().where(users.c.id == story.user_id).values(
+            last_story_at=case(
+                (or_(users.c.last_story_at.is_(None), users.c.last_story_at < story.created_at), story.created_at),
+                else_=users.c.last_story_at
+            ),
+            stories_expire_at=case(
+                (or_(users.c.stories_expire_at.is_(None), users.c.stories_expire_at < story.expires_at),
+                 story.expires_at),
+                else_=users.c.stories_expire_at
+            )
+        )
+    )
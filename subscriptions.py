@@ -0,0 +1,94 @@
+import threading
+
+from flask_socketio import join_room
+
+from app import app, db, socketio
+from models import GroupMembership, conversation_key
+
+def personal_room(user_id):
+    """Room every socket of a user is in; direct messages and receipts are delivered here."""
+    return f"user_{int(user_id)}"
+
+def conversation_rooms(key):
+    """Socket rooms that reach the members of a conversation.
+
+    A group conversation has its own room. A direct conversation
+    ('user_{a}_{b}') is delivered to both participants' personal rooms, so
+    nobody has to join it first.
+    """
+    kind, _, ids = key.partition('_')
+    if kind == 'user':
+        return [personal_room(user_id) for user_id in ids.split('_')]
+    return [key]
+
+class SocketRegistry:
+    """Open socket ids per user, so subscriptions can follow membership changes."""
+
+    def __init__(self):
+        self._sids = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id, sid):
+        with self._lock:
+            self._sids.setdefault(user_id, set()).add(sid)
+
+    def remove(self, user_id, sid):
+        with self._lock:
+            sids = self._sids.get(user_id)
+            if sids:
+                sids.discard(sid)
+                if not sids:
+                    del self._sids[user_id]
+
+    def sids(self, user_id):
+        with self._lock:
+            return set(self._sids.get(user_id, ()))
+
+class RedisSocketRegistry(SocketRegistry):
+    """SocketRegistry shared by all workers; rooms of remote sockets change through the message queue."""
+
+    KEY = 'prochat:sockets:{}'
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def add(self, user_id, sid):
+        self._redis.sadd(self.KEY.format(user_id), sid)
+
+    def remove(self, user_id, sid):
+        self._redis.srem(self.KEY.format(user_id), sid)
+
+    def sids(self, user_id):
+        return self._redis.smembers(self.KEY.format(user_id))
+
+if app.config['REDIS_URL']:
+    socket_registry = RedisSocketRegistry(app.config['REDIS_URL'])
+else:
+    socket_registry = SocketRegistry()
+
+def subscribe_current_socket(user_id, sid):
+    """Join a newly connected socket to its personal room and all of the user's group rooms.
+
+    Runs in the connect handler. Group rooms come from a single query.
+    """
+    socket_registry.add(user_id, sid)
+    join_room(personal_room(user_id))
+    for group_id, in db.session.query(GroupMembership.group_id).filter(GroupMembership.user_id == user_id):
+        join_room(conversation_key(group_id=group_id))
+
+def unsubscribe_socket(user_id, sid):
+    # Socket.IO drops the rooms of a closed socket by itself
+    socket_registry.remove(user_id, sid)
+
+def subscribe_user(user_id, group_id):
+    """Add every open socket of a user to a group room; call after the membership is committed."""
+    room = conversation_key(group_id=group_id)
+    for sid in socket_registry.sids(user_id):
+        socketio.server.enter_room(sid, room, namespace='/')
+
+def unsubscribe_user(user_id, group_id):
+    """Remove every open socket of a user from a group room; call after leaving or being removed."""
+    room = conversation_key(group_id=group_id)
+    for sid in socket_registry.sids(user_id):
+        socketio.server.leave_room(sid, room, namespace='/')
@@ -0,0 +1,114 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+
+# The app reads its configuration from the environment when it is imported
+_tmp_dir = tempfile.mkdtemp(prefix='prochat-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmp_dir, 'prochat.db')
+os.environ['SESSION_SECRET'] = 'test'
+os.environ['UPLOAD_TMP_FOLDER'] = os.path.join(_tmp_dir, 'uploads_tmp')
+os.environ['MEDIA_ROOT'] = os.path.join(_tmp_dir, 'media')
+os.environ.pop('REDIS_URL', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+from main import app as flask_app  # noqa: E402
+from app import db  # noqa: E402
+from inbox import add_group_conversation, record_message  # noqa: E402
+from media_store import store_file  # noqa: E402
+from models import User, Message, Group, GroupMembership, Contact, Story, MediaBlob  # noqa: E402
+
+CONTACTS = 8
+GROUPS = 3
+GROUP_MESSAGES = 20
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        seed()
+    return flask_app
+
+def seed():
+    """User 'alice' with contacts, direct chats, groups and a story from every contact."""
+    alice = User(username='alice', email='alice@example.com')
+    alice.set_password('password')
+    db.session.add(alice)
+    contacts = []
+    for i in range(CONTACTS):
+        user = User(username=f'user{i}', email=f'user{i}@example.com', first_name=f'User {i}')
+        user.set_password('password')
+        contacts.append(user)
+    db.session.add_all(contacts)
+    db.session.flush()
+
+    now = datetime.utcnow()
+    for i, user in enumerate(contacts):
+        db.session.add(Contact(user_id=alice.id, contact_id=user.id))
+        db.session.add(Contact(user_id=user.id, contact_id=alice.id))
+        for j in range(3):
+            sender, recipient = (alice, user) if j % 2 else (user, alice)
+            message = Message(content=f'hello {j}', sender_id=sender.id, recipient_id=recipient.id,
+                              timestamp=now - timedelta(minutes=i * 10 + j))
+            db.session.add(message)
+            db.session.flush()
+            record_message(message)
+        db.session.add(Story(user_id=user.id, content=f'story {i}', created_at=now - timedelta(minutes=i)))
+
+    for i in range(GROUPS):
+        group = Group(name=f'group {i}', created_by=alice.id)
+        db.session.add(group)
+        db.session.flush()
+        db.session.add(GroupMembership(user_id=alice.id, group_id=group.id, role='admin'))
+        db.session.add_all(GroupMembership(user_id=user.id, group_id=group.id) for user in contacts)
+        for user in [alice] + contacts:
+            add_group_conversation(user.id, group)
+        for j in range(GROUP_MESSAGES):
+            message = Message(content=f'group message {j}', sender_id=contacts[j % CONTACTS].id,
+                              group_id=group.id, timestamp=now - timedelta(minutes=j))
+            db.session.add(message)
+            db.session.flush()
+            record_message(message)
+    db.session.commit()
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    response = client.post('/auth/login', data={'username': 'alice', 'password': 'password'})
+    assert response.status_code == 302
+    return client
+
+@pytest.fixture
+def count_queries(app):
+    """Context manager collecting the SQL statements executed inside it."""
+    @contextmanager
+    def counter():
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+    return counter
+
+@pytest.fixture
+def store_media(app):
+    """Store content in the media store as filename and return its key, past the GC grace period."""
+    def store(content, filename='photo.jpg'):
+        path = os.path.join(app.config['UPLOAD_TMP_FOLDER'], f'{os.urandom(8).hex()}.part')
+        with open(path, 'wb') as f:
+            f.write(content)
+        key = store_file(path, filename)
+        db.session.get(MediaBlob, key).stored_at = datetime.utcnow() - timedelta(days=1)
+        db.session.commit()
+        return key
+    return store
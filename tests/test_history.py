@@ -0,0 +1,27 @@
+"""The JSON history endpoint of direct chats."""
+from app import db
+from models import User, BlockedUser
+
+def test_direct_history_pages_through_the_conversation(app, client):
+    with app.app_context():
+        partner_id = User.query.filter_by(username='user0').one().id
+
+    response = client.get(f'/api/chat/{partner_id}/history?limit=2')
+    assert response.status_code == 200
+    page = response.get_json()
+    assert len(page['messages']) == 2
+
+    response = client.get(f'/api/chat/{partner_id}/history?limit=2&before={page["next_cursor"]}')
+    assert [m['content'] for m in response.get_json()['messages']] == ['hello 2']
+
+def test_direct_history_refused_when_blocked(app, client):
+    with app.app_context():
+        alice = User.query.filter_by(username='alice').one()
+        blocker = User.query.filter_by(username='user7').one()
+        db.session.add(BlockedUser(blocker_id=blocker.id, blocked_id=alice.id))
+        db.session.commit()
+        blocker_id = blocker.id
+
+    response = client.get(f'/api/chat/{blocker_id}/history')
+    assert response.status_code == 403
+    assert 'messages' not in response.get_json()
@@ -0,0 +1,57 @@
+"""Inbox entries kept by inbox.record_message()."""
+from app import db
+from inbox import add_group_conversation, get_inbox, record_message
+from models import User, Message, Group, GroupMembership, Conversation
+
+def send(**fields):
+    message = Message(content='hi', **fields)
+    db.session.add(message)
+    db.session.flush()
+    record_message(message)
+    db.session.commit()
+    return message
+
+def entry(user, message):
+    return Conversation.query.filter_by(user_id=user.id, conversation_key=message.conversation_key).one()
+
+def test_direct_message_creates_and_updates_both_entries(app):
+    with app.app_context():
+        sender, recipient = (User.query.filter_by(username=name).one() for name in ('user5', 'user6'))
+        first = send(sender_id=sender.id, recipient_id=recipient.id)
+        second = send(sender_id=sender.id, recipient_id=recipient.id)
+
+        assert (entry(sender, first).unread_count, entry(recipient, first).unread_count) == (0, 2)
+        assert entry(recipient, first).partner_id == sender.id
+        assert entry(recipient, first).last_message_id == second.id
+        assert get_inbox(recipient.id)[0].conversation_key == second.conversation_key
+
+def test_group_message_counts_unread_for_everyone_but_the_sender(app):
+    with app.app_context():
+        members = [User.query.filter_by(username=name).one() for name in ('user5', 'user6', 'user7')]
+        group = Group(name='inbox test', created_by=members[0].id)
+        db.session.add(group)
+        db.session.flush()
+        for user in members:
+            db.session.add(GroupMembership(user_id=user.id, group_id=group.id))
+            add_group_conversation(user.id, group)
+        db.session.commit()
+
+        message = send(sender_id=members[0].id, group_id=group.id)
+
+        assert [entry(user, message).unread_count for user in members] == [0, 1, 1]
+        assert {entry(user, message).last_message_id for user in members} == {message.id}
+
+def test_late_older_message_does_not_move_the_last_message(app):
+    with app.app_context():
+        sender, recipient = (User.query.filter_by(username=name).one() for name in ('user6', 'user7'))
+        older = Message(content='written behind', sender_id=sender.id, recipient_id=recipient.id)
+        db.session.add(older)
+        db.session.flush()
+        newer = send(sender_id=sender.id, recipient_id=recipient.id)
+
+        # The write-behind flusher records the older message after the newer one
+        record_message(older)
+        db.session.commit()
+
+        assert entry(recipient, newer).last_message_id == newer.id
+        assert entry(recipient, newer).unread_count == 2
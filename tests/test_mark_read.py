@@ -0,0 +1,63 @@
+"""Read positions: bulk read_at for direct chats, the group high-water mark and read receipts."""
+import pytest
+
+import inbox
+from app import db
+from models import User, Message, Conversation, GroupMembership, conversation_key
+
+@pytest.fixture
+def receipts(monkeypatch):
+    """message_read events sent, as payloads."""
+    sent = []
+    monkeypatch.setattr(inbox.socketio, 'emit',
+                        lambda event, data, to=None: sent.append(data) if event == 'message_read' else None)
+    return sent
+
+def unread_count(user_id, key):
+    db.session.expire_all()
+    return Conversation.query.filter_by(user_id=user_id, conversation_key=key).one().unread_count
+
+def test_direct_chat_read_up_to_a_message(app, client, receipts):
+    with app.app_context():
+        alice = User.query.filter_by(username='alice').one()
+        partner = User.query.filter_by(username='user5').one()
+        key = conversation_key(alice.id, partner.id)
+        received = [m.id for m in Message.query.filter_by(conversation_key=key, recipient_id=alice.id).order_by(Message.id)]
+        assert unread_count(alice.id, key) == 2
+
+        response = client.post('/api/mark_read', json={'conversation': key, 'up_to_message_id': received[0]})
+        assert response.status_code == 200
+        assert unread_count(alice.id, key) == 1
+        assert [m.read_at is not None for m in Message.query.filter(Message.id.in_(received)).order_by(Message.id)] == [True, False]
+
+        # A position past the newest message is capped, so the receipt never runs ahead
+        client.post('/api/mark_read', json={'conversation': key, 'up_to_message_id': received[-1] + 10_000})
+        assert unread_count(alice.id, key) == 0
+        assert [receipt['up_to_message_id'] for receipt in receipts] == [received[0], received[-1]]
+
+        # Nothing moved, so nothing is sent
+        client.post('/api/mark_read', json={'conversation': key, 'up_to_message_id': received[-1]})
+        assert len(receipts) == 2
+
+def test_group_read_high_water_mark_only_moves_forward(app, client, receipts):
+    with app.app_context():
+        alice = User.query.filter_by(username='alice').one()
+        key = conversation_key(group_id=3)
+        ids = [m.id for m in Message.query.filter_by(conversation_key=key).order_by(Message.id)]
+        assert unread_count(alice.id, key) == len(ids)
+
+        client.post('/api/mark_read', json={'conversation': key, 'up_to_message_id': ids[9]})
+        membership = GroupMembership.query.filter_by(user_id=alice.id, group_id=3).one()
+        assert membership.last_read_message_id == ids[9]
+        assert unread_count(alice.id, key) == len(ids) - 10
+
+        # An older position does not move the mark back
+        client.post('/api/mark_read', json={'conversation': key, 'up_to_message_id': ids[2]})
+        db.session.expire_all()
+        assert GroupMembership.query.filter_by(user_id=alice.id, group_id=3).one().last_read_message_id == ids[9]
+        assert [receipt['up_to_message_id'] for receipt in receipts] == [ids[9]]
+
+def test_mark_read_rejects_bad_input(client):
+    response = client.post('/api/mark_read', json={'conversation': 'group_3', 'up_to_message_id': 'latest'})
+    assert response.status_code == 400
+    assert client.post('/api/mark_read', json={'conversation': 'group_99', 'up_to_message_id': 1}).status_code == 403
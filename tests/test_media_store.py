@@ -0,0 +1,93 @@
+"""The content-addressed media store: metadata stripping, reference counts and garbage collection."""
+import io
+from datetime import datetime
+
+from PIL import ExifTags, Image
+from werkzeug.datastructures import FileStorage
+
+from app import db
+from media_store import collect_garbage, media_backend, media_key, media_url, save_uploaded_file
+from models import User, Message, Story, MediaBlob
+
+def jpeg_with_exif(orientation=1):
+    exif = Image.Exif()
+    exif[ExifTags.Base.Make] = 'PhoneMaker'
+    exif[ExifTags.Base.Orientation] = orientation
+    output = io.BytesIO()
+    Image.new('RGB', (40, 20), (200, 10, 10)).save(output, 'JPEG', exif=exif.tobytes())
+    return output.getvalue()
+
+def test_uploaded_image_is_stored_without_metadata(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'MEDIA_VARIANT_WORKERS', 0)
+    with app.app_context():
+        url = save_uploaded_file(FileStorage(io.BytesIO(jpeg_with_exif(orientation=6)), 'photo.jpg'))
+
+        with open(media_backend.local_path(media_key(url)), 'rb') as f:
+            stored = f.read()
+        assert b'PhoneMaker' not in stored
+        with Image.open(io.BytesIO(stored)) as image:
+            assert not image.getexif()
+            # Rotated as the EXIF orientation asked, since the tag is gone
+            assert image.size == (20, 40)
+
+def test_attachments_stay_out_of_shared_caches(app, client, store_media, monkeypatch):
+    monkeypatch.setitem(app.config, 'MEDIA_VARIANT_WORKERS', 0)
+    with app.app_context():
+        attachment = store_media(b'private attachment', 'notes.pdf')
+        avatar = save_uploaded_file(FileStorage(io.BytesIO(jpeg_with_exif()), 'me.jpg'), public=True)
+
+    response = client.get(f'/uploads/media/{attachment}')
+    assert response.status_code == 200
+    assert response.cache_control.private and not response.cache_control.public
+    assert response.cache_control.immutable
+
+    response = client.get(avatar)
+    assert response.status_code == 200
+    assert response.cache_control.public and not response.cache_control.private
+
+def ref_count(key):
+    db.session.expire_all()
+    return db.session.get(MediaBlob, key).ref_count
+
+def test_references_are_counted_per_row(app, store_media):
+    with app.app_context():
+        user = User.query.filter_by(username='user6').one()
+        key = store_media(b'counted media')
+        assert ref_count(key) == 0
+
+        message = Message(sender_id=user.id, recipient_id=1, message_type='image', file_url=media_url(key))
+        story = Story(user_id=user.id, media_url=media_url(key), media_type='image')
+        db.session.add_all([message, story])
+        db.session.commit()
+        assert ref_count(key) == 2
+
+        previous_image = user.profile_image_url
+        user.profile_image_url = media_url(key)
+        db.session.commit()
+        assert ref_count(key) == 3
+
+        db.session.delete(message)
+        user.profile_image_url = previous_image
+        db.session.commit()
+        assert ref_count(key) == 1
+
+def test_garbage_collection_keeps_referenced_and_recent_blobs(app, store_media):
+    with app.app_context():
+        user = User.query.filter_by(username='user6').one()
+        orphan = store_media(b'nothing points here')
+        referenced = store_media(b'a story points here')
+        recent = store_media(b'just uploaded')
+        db.session.get(MediaBlob, recent).stored_at = datetime.utcnow()
+        db.session.add(Story(user_id=user.id, media_url=media_url(referenced), media_type='image'))
+        # Drift from bulk statements is corrected by the recount before collecting
+        db.session.get(MediaBlob, orphan).ref_count = 5
+        db.session.commit()
+        db.session.get(MediaBlob, referenced).ref_count = 0
+        db.session.commit()
+
+        collect_garbage()
+
+        db.session.expire_all()
+        assert db.session.get(MediaBlob, orphan) is None and not media_backend.exists(orphan)
+        assert ref_count(referenced) == 1 and media_backend.exists(referenced)
+        assert db.session.get(MediaBlob, recent) is not None and media_backend.exists(recent)
@@ -0,0 +1,73 @@
+"""Write-behind persistence: batched inserts, inbox updates and message_ack events."""
+from datetime import datetime
+
+import pytest
+
+import message_writer as message_writer_module
+from app import db
+from models import User, Message, Conversation, conversation_key
+from message_writer import MessageIdAllocator, MessageWriter
+
+@pytest.fixture
+def acks(monkeypatch):
+    """message_ack events emitted by the writer, as (sid, payload)."""
+    emitted = []
+    monkeypatch.setattr(message_writer_module.socketio, 'emit',
+                        lambda event, data, to=None: emitted.append((to, data)) if event == 'message_ack' else None)
+    return emitted
+
+def queued_writer(rows, batch_size=200):
+    writer = MessageWriter(batch_size=batch_size, max_retries=1)
+    writer._started = True  # flushed by the test instead of the background task
+    for row, sid in rows:
+        writer.submit(row, sid=sid)
+    return writer
+
+def direct_row(message_id, sender, recipient, content='write-behind'):
+    return {'id': message_id, 'content': content, 'sender_id': sender.id, 'recipient_id': recipient.id,
+            'group_id': None, 'message_type': 'text', 'timestamp': datetime.utcnow()}
+
+def test_allocator_continues_after_existing_ids(app):
+    with app.app_context():
+        allocator = MessageIdAllocator()
+        newest = db.session.query(db.func.max(Message.id)).scalar()
+        with db.engine.connect() as connection:
+            assert allocator.next_id(connection) == newest + 1
+        assert allocator.next_id() == newest + 2
+
+def test_flush_writes_batches_and_acks_senders(app, acks):
+    with app.app_context():
+        alice = User.query.filter_by(username='alice').one()
+        bob = User.query.filter_by(username='user2').one()
+        allocator = MessageIdAllocator()
+        ids = [allocator.next_id() for _ in range(5)]
+        writer = queued_writer([(direct_row(message_id, bob, alice), 'bob-sid') for message_id in ids], batch_size=2)
+
+        assert writer.pending() == 5
+        assert writer.flush() == 5
+        assert writer.pending() == 0
+
+        assert [m.id for m in Message.query.filter(Message.id.in_(ids)).order_by(Message.id)] == ids
+        inbox = Conversation.query.filter_by(user_id=alice.id, conversation_key=conversation_key(alice.id, bob.id)).one()
+        assert inbox.last_message_id == ids[-1]
+        # One ack per committed batch of two, two and one rows
+        assert acks == [('bob-sid', {'message_ids': ids[0:2], 'status': 'persisted'}),
+                        ('bob-sid', {'message_ids': ids[2:4], 'status': 'persisted'}),
+                        ('bob-sid', {'message_ids': ids[4:], 'status': 'persisted'})]
+
+def test_rejected_row_fails_alone(app, acks):
+    with app.app_context():
+        alice = User.query.filter_by(username='alice').one()
+        carol = User.query.filter_by(username='user3').one()
+        allocator = MessageIdAllocator()
+        good, bad = allocator.next_id(), allocator.next_id()
+        broken = direct_row(bad, carol, alice)
+        broken['sender_id'] = None
+        writer = queued_writer([(direct_row(good, carol, alice), 'carol-sid'), (broken, 'other-sid')])
+
+        writer.flush()
+
+        assert db.session.get(Message, good) is not None
+        assert db.session.get(Message, bad) is None
+        assert acks == [('carol-sid', {'message_ids': [good], 'status': 'persisted'}),
+                        ('other-sid', {'message_ids': [bad], 'status': 'failed'})]
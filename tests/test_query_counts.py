@@ -0,0 +1,55 @@
+"""Query-count regressions for the main pages.
+
+Each page must run a fixed number of SQL statements, no matter how many
+contacts, conversations, groups, members or stories there are. Counts are
+taken on a repeat request, once the user and membership caches are warm.
+"""
+from datetime import datetime
+
+import pytest
+
+from app import db
+from inbox import record_message
+from models import User, Message, GroupMembership, Contact, Story
+
+PAGE_QUERY_LIMITS = {
+    '/chat': 3,
+    '/groups': 2,
+    '/groups/1': 8,
+    '/stories': 3,
+}
+
+def page_query_count(client, count_queries, path):
+    assert client.get(path).status_code == 200
+    with count_queries() as statements:
+        response = client.get(path)
+    assert response.status_code == 200
+    return len(statements)
+
+@pytest.mark.parametrize('path', PAGE_QUERY_LIMITS)
+def test_page_query_count(client, count_queries, path):
+    assert page_query_count(client, count_queries, path) <= PAGE_QUERY_LIMITS[path]
+
+def add_contact(app, index):
+    """One more contact of alice with a direct chat, a story and a membership in group 1."""
+    with app.app_context():
+        alice = User.query.filter_by(username='alice').one()
+        user = User(username=f'extra{index}', email=f'extra{index}@example.com')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Contact(user_id=alice.id, contact_id=user.id))
+        db.session.add(GroupMembership(user_id=user.id, group_id=1))
+        message = Message(content='hi', sender_id=user.id, recipient_id=alice.id, timestamp=datetime.utcnow())
+        db.session.add(message)
+        db.session.flush()
+        record_message(message)
+        db.session.add(Story(user_id=user.id, content='extra story'))
+        db.session.commit()
+
+def test_page_query_counts_do_not_grow_with_data(app, client, count_queries):
+    before = {path: page_query_count(client, count_queries, path) for path in PAGE_QUERY_LIMITS}
+    for index in range(5):
+        add_contact(app, index)
+    after = {path: page_query_count(client, count_queries, path) for path in PAGE_QUERY_LIMITS}
+    assert after == before
@@ -0,0 +1,124 @@
+"""Two Socket.IO workers sharing a Redis message queue, with fakeredis standing in for Redis.
+
+Each worker is its own Flask app and SocketIO server using the client
+manager built by create_client_manager(), so messages only get from one
+worker to the other through the queue.
+"""
+import functools
+import time
+
+import pytest
+from flask import Flask, request
+import flask_socketio.test_client
+from flask_socketio import SocketIO, join_room
+
+fakeredis = pytest.importorskip('fakeredis')
+import redis  # noqa: E402
+import socketio  # noqa: E402
+
+import subscriptions  # noqa: E402
+from fanout import FanOutManager, RedisFanOutManager, create_client_manager  # noqa: E402
+
+REDIS_URL = 'redis://fake'
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url',
+                        classmethod(lambda cls, url, **options: fakeredis.FakeRedis(server=server, **options)))
+    return server
+
+@pytest.fixture
+def socket_registry(redis_server, monkeypatch):
+    registry = subscriptions.RedisSocketRegistry(REDIS_URL)
+    monkeypatch.setattr(subscriptions, 'socket_registry', registry)
+    return registry
+
+def create_worker(socket_registry):
+    """A worker whose sockets join the rooms given in their auth payload and register as that user."""
+    app = Flask(__name__)
+    socketio = SocketIO(app, async_mode='threading', client_manager=create_client_manager(REDIS_URL))
+    # Both the test client and the server initialize the manager, which would start two queue listeners
+    socketio.server.manager.initialize = functools.cache(socketio.server.manager.initialize)
+
+    @socketio.on('connect')
+    def on_connect(auth):
+        socket_registry.add(auth['user_id'], request.sid)
+        for room in auth.get('rooms', ()):
+            join_room(room)
+
+    return app, socketio
+
+@pytest.fixture
+def workers(socket_registry, monkeypatch):
+    # The test client refuses message queues because it expects every event to
+    # be delivered synchronously; the tests here wait for delivery instead
+    monkeypatch.setattr(flask_socketio.test_client, 'PubSubManager', type('NoPubSubManager', (), {}))
+    return create_worker(socket_registry), create_worker(socket_registry)
+
+def connect(app, socketio, **auth):
+    """A test client of one worker, returned once that worker listens on the queue."""
+    client = socketio.test_client(app, auth=auth)
+    client.get_received()
+    deadline = time.monotonic() + 2
+    while not socketio.server.manager.pubsub or not socketio.server.manager.pubsub.subscribed:
+        assert time.monotonic() < deadline, 'worker did not subscribe to the message queue'
+        time.sleep(0.01)
+    return client
+
+def wait_for(client, event, timeout=2):
+    """Events named event received by a test client, waiting up to timeout seconds for the first."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        received = [packet['args'][0] for packet in client.get_received() if packet['name'] == event]
+        if received:
+            return received
+        time.sleep(0.01)
+    return []
+
+def test_redis_fan_out_manager_relays_through_redis_and_fans_out_locally():
+    # PubSubManager.emit publishes; the receiving side's super().emit must reach FanOutManager.emit
+    mro = RedisFanOutManager.__mro__
+    assert mro.index(socketio.PubSubManager) < mro.index(FanOutManager) < mro.index(socketio.Manager)
+    assert isinstance(create_client_manager(REDIS_URL), RedisFanOutManager)
+
+def test_room_broadcast_reaches_other_worker(workers):
+    (app_a, socketio_a), (app_b, socketio_b) = workers
+    client_a = connect(app_a, socketio_a, user_id=1, rooms=['group_1'])
+    client_b = connect(app_b, socketio_b, user_id=2, rooms=['group_1'])
+
+    delivered = []
+    deliver = socketio_b.server.manager._deliver
+    socketio_b.server.manager._deliver = lambda *broadcast: delivered.append(broadcast[0]) or deliver(*broadcast)
+
+    socketio_a.emit('new_message', {'id': 1, 'content': 'hello'}, to='group_1')
+
+    assert wait_for(client_b, 'new_message') == [{'id': 1, 'content': 'hello'}]
+    assert wait_for(client_a, 'new_message') == [{'id': 1, 'content': 'hello'}]
+    # Worker B fanned the relayed broadcast out through FanOutManager
+    assert delivered == ['new_message']
+
+def test_subscribe_user_joins_sockets_on_other_worker(workers, monkeypatch):
+    (app_a, socketio_a), (app_b, socketio_b) = workers
+    client_b = connect(app_b, socketio_b, user_id=2)
+    sid = socketio_b.server.manager.sid_from_eio_sid(client_b.eio_sid, '/')
+    assert socketio_b.server.manager.is_connected(sid, '/')
+    assert not socketio_a.server.manager.is_connected(sid, '/')
+
+    # Worker A handles the join request, the socket lives on worker B
+    monkeypatch.setattr(subscriptions, 'socketio', socketio_a)
+    subscriptions.subscribe_user(2, 1)
+
+    deadline = time.monotonic() + 2
+    while 'group_1' not in socketio_b.server.rooms(sid) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert 'group_1' in socketio_b.server.rooms(sid)
+
+    socketio_a.emit('new_message', {'id': 2, 'content': 'welcome'}, to='group_1')
+    assert wait_for(client_b, 'new_message') == [{'id': 2, 'content': 'welcome'}]
+
+    subscriptions.unsubscribe_user(2, 1)
+    deadline = time.monotonic() + 2
+    while 'group_1' in socketio_b.server.rooms(sid) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert 'group_1' not in socketio_b.server.rooms(sid)
@@ -0,0 +1,49 @@
+"""Expired story sweeping and the media references it releases."""
+from datetime import datetime, timedelta
+
+from app import db
+from media_store import media_backend, media_url
+from models import User, Message, Story, StoryView, MediaBlob
+from stories import delete_stories, sweep_expired_stories
+
+def add_expired_story(user, media_key):
+    story = Story(user_id=user.id, media_url=media_url(media_key), media_type='image',
+                  created_at=datetime.utcnow() - timedelta(days=2), expires_at=datetime.utcnow() - timedelta(days=1))
+    db.session.add(story)
+    db.session.flush()
+    db.session.add(StoryView(story_id=story.id, viewer_id=user.id + 1))
+    db.session.commit()
+    return story.id
+
+def test_sweep_deletes_expired_stories_and_releases_media(app, store_media):
+    with app.app_context():
+        user = User.query.filter_by(username='user0').one()
+        key = store_media(b'swept story media')
+        story_id = add_expired_story(user, key)
+        assert db.session.get(MediaBlob, key).ref_count == 1
+
+        assert sweep_expired_stories() == 1
+        assert db.session.get(Story, story_id) is None
+        assert StoryView.query.filter_by(story_id=story_id).count() == 0
+        assert db.session.get(MediaBlob, key) is None
+        assert not media_backend.exists(key)
+        # Stories that have not expired are kept
+        assert Story.query.filter_by(user_id=user.id).count() == 1
+
+def test_sweeping_the_same_batch_twice_releases_media_once(app, store_media):
+    with app.app_context():
+        user = User.query.filter_by(username='user1').one()
+        key = store_media(b'media shared by a story and a message')
+        story_id = add_expired_story(user, key)
+        db.session.add(Message(sender_id=user.id, recipient_id=1, message_type='image', file_url=media_url(key)))
+        db.session.commit()
+        assert db.session.get(MediaBlob, key).ref_count == 2
+
+        # A second sweeper that selected the same batch deletes nothing and releases nothing
+        assert delete_stories([story_id]) == 1
+        assert delete_stories([story_id]) == 0
+        db.session.commit()
+
+        db.session.expire_all()
+        assert db.session.get(MediaBlob, key).ref_count == 1
+        assert media_backend.exists(key)
@@ -0,0 +1,73 @@
+"""Reconnect sync and delivery acknowledgements through the app's own socket handlers."""
+import pytest
+
+from app import db, socketio
+from inbox import record_message
+from models import User, Message, conversation_key
+
+@pytest.fixture
+def socket(app, client):
+    """alice's Socket.IO test client, logged in through the HTTP client's session."""
+    socket = socketio.test_client(app, flask_test_client=client)
+    socket.get_received()
+    yield socket
+    socket.disconnect()
+
+def events(socket, name):
+    return [packet['args'][0] for packet in socket.get_received() if packet['name'] == name]
+
+def conversation(app, username):
+    """(key, message ids oldest first, ids of the messages alice received) of alice's chat with username."""
+    with app.app_context():
+        alice = User.query.filter_by(username='alice').one()
+        partner = User.query.filter_by(username=username).one()
+        key = conversation_key(alice.id, partner.id)
+        messages = Message.query.filter_by(conversation_key=key).order_by(Message.id).all()
+        return key, [m.id for m in messages], [m.id for m in messages if m.recipient_id == alice.id]
+
+def test_sync_sends_only_missed_messages(app, socket):
+    key, ids, _ = conversation(app, 'user3')
+
+    socket.emit('sync', {'conversations': {key: ids[0], 'user_90_91': 0}})
+    received = socket.get_received()
+
+    assert [packet['name'] for packet in received] == ['sync_messages', 'sync_complete']
+    batch = received[0]['args'][0]
+    assert batch['conversation'] == key
+    assert [message['message_id'] for message in batch['messages']] == ids[1:]
+    assert received[1]['args'][0] == {'truncated': []}
+
+def test_sync_finds_conversations_without_a_cursor(app, socket):
+    key, ids, _ = conversation(app, 'user3')
+    with app.app_context():
+        newest_elsewhere = db.session.query(db.func.max(Message.id)).filter(Message.conversation_key != key).scalar()
+        alice = User.query.filter_by(username='alice').one()
+        partner = User.query.filter_by(username='user3').one()
+        message = Message(content='sent while offline', sender_id=partner.id, recipient_id=alice.id)
+        db.session.add(message)
+        db.session.flush()
+        record_message(message)
+        db.session.commit()
+        missed_id = message.id
+
+    # The client only knows the newest id it has seen anywhere
+    socket.emit('sync', {'since_id': max(newest_elsewhere, ids[-1]), 'conversations': {}})
+    batches = events(socket, 'sync_messages')
+    assert [(batch['conversation'], [m['message_id'] for m in batch['messages']]) for batch in batches] == \
+        [(key, [missed_id])]
+
+def test_sync_rejects_malformed_cursors(socket):
+    socket.emit('sync', {'conversations': {'user_1_2': 'latest'}})
+    assert events(socket, 'error') == [{'message': 'Invalid sync request'}]
+
+def test_delivered_sets_delivered_at_on_received_messages(app, socket):
+    key, ids, received = conversation(app, 'user1')
+
+    socket.emit('messages_delivered', {'conversation': key, 'up_to_message_id': ids[-1]})
+    socket.emit('messages_delivered', {'conversation': key, 'up_to_message_id': 'latest'})
+    assert events(socket, 'error') == []
+
+    with app.app_context():
+        delivered = {m.id: m.delivered_at is not None for m in Message.query.filter(Message.id.in_(ids))}
+    # Only messages alice received are marked; her own stay as they were
+    assert delivered == {message_id: message_id in received for message_id in ids}
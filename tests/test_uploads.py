@@ -0,0 +1,76 @@
+"""Resumable attachment uploads: offsets, chunk locks and the message sent on completion."""
+import hashlib
+
+import pytest
+
+import uploads
+from app import db
+from models import User, Message
+
+CONTENT = bytes(range(256)) * 40
+
+@pytest.fixture
+def recipient_id(app):
+    with app.app_context():
+        return User.query.filter_by(username='user4').one().id
+
+def create_upload(client, recipient_id, size=len(CONTENT)):
+    response = client.post('/api/uploads', json={'filename': 'report.pdf', 'size': size, 'recipient_id': recipient_id})
+    assert response.status_code == 201
+    return response.headers['Location']
+
+def patch(client, location, offset, chunk):
+    return client.patch(location, data=chunk, headers={'Upload-Offset': str(offset)})
+
+def test_chunks_resume_from_the_server_offset(app, client, recipient_id):
+    location = create_upload(client, recipient_id)
+    assert patch(client, location, 0, CONTENT[:4000]).headers['Upload-Offset'] == '4000'
+
+    # A chunk sent again for an old offset is refused; the client asks where to resume
+    assert patch(client, location, 0, CONTENT[:4000]).status_code == 409
+    assert client.head(location).headers['Upload-Offset'] == '4000'
+
+    response = patch(client, location, 4000, CONTENT[4000:])
+    assert response.status_code == 200
+    message = response.get_json()['message']
+    assert message['message_type'] == 'document' and message['file_size'] == len(CONTENT)
+    with app.app_context():
+        stored = db.session.get(Message, message['message_id'])
+        assert stored.file_hash == hashlib.sha256(CONTENT).hexdigest()
+
+    # Finished uploads are gone, so the last chunk cannot be sent twice
+    assert patch(client, location, 4000, CONTENT[4000:]).status_code == 404
+
+def test_chunk_refused_while_another_is_written(app, client, recipient_id):
+    location = create_upload(client, recipient_id)
+    upload_id = location.rsplit('/', 1)[1]
+
+    token = uploads.upload_locks.acquire(upload_id)
+    try:
+        assert patch(client, location, 0, CONTENT[:4000]).status_code == 409
+        assert client.head(location).headers['Upload-Offset'] == '0'
+    finally:
+        uploads.upload_locks.release(upload_id, token)
+    assert patch(client, location, 0, CONTENT[:4000]).headers['Upload-Offset'] == '4000'
+
+def test_redis_upload_locks_are_shared_by_workers(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    import redis
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url',
+                        classmethod(lambda cls, url, **options: fakeredis.FakeRedis(server=server, **options)))
+    worker_a = uploads.RedisUploadLocks('redis://fake')
+    worker_b = uploads.RedisUploadLocks('redis://fake')
+
+    token = worker_a.acquire('abc')
+    assert token is not None
+    assert worker_b.acquire('abc') is None
+
+    # Only the holder's token refreshes or releases the lock
+    assert not worker_b.refresh('abc', 'other-token')
+    worker_b.release('abc', 'other-token')
+    assert worker_b.acquire('abc') is None
+    assert worker_a.refresh('abc', token)
+
+    worker_a.release('abc', token)
+    assert worker_b.acquire('abc') is not None
@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+
+from app import app, socketio
+from subscriptions import conversation_rooms
+
+class TypingAggregator:
+    """Coalesces typing events into one periodic user_typing digest per room.
+
+    Clients report is_typing on and off; a typing state that is not refreshed
+    within ttl seconds expires. Repeating the current state only extends the
+    expiry, so only real changes mark a room dirty. Every interval seconds
+    each dirty room gets a single digest listing everyone typing in it,
+    instead of one event per typist per keystroke burst.
+    """
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, interval=0.5, ttl=6):
+        self.interval = interval
+        self.ttl = ttl
+        self._rooms = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def update(self, room, user_id, user_name, is_typing):
+        if is_typing:
+            self._start_typing(room, user_id, user_name, self.clock() + self.ttl)
+        else:
+            self._stop_typing(room, user_id)
+        self._ensure_started()
+
+    def _ensure_started(self):
+        with self._lock:
+            if not self._started:
+                self._started = True
+                socketio.start_background_task(self._run)
+
+    def _start_typing(self, room, user_id, user_name, expires_at):
+        with self._lock:
+            typists = self._rooms.setdefault(room, {})
+            if user_id not in typists:
+                self._dirty.add(room)
+            typists[user_id] = (user_name, expires_at)
+
+    def _stop_typing(self, room, user_id):
+        with self._lock:
+            typists = self._rooms.get(room)
+            if typists and typists.pop(user_id, None):
+                self._dirty.add(room)
+                if not typists:
+                    del self._rooms[room]
+
+    def _take_digests(self, now):
+        """Expire stale typists and return {room: [(user_id, user_name)]} for every changed room."""
+        with self._lock:
+            for room, typists in list(self._rooms.items()):
+                expired = [user_id for user_id, (_, expires_at) in typists.items() if expires_at <= now]
+                for user_id in expired:
+                    del typists[user_id]
+                if expired:
+                    self._dirty.add(room)
+                if not typists:
+                    del self._rooms[room]
+
+            dirty, self._dirty = self._dirty, set()
+            return {
+                room: [(user_id, user_name) for user_id, (user_name, _) in self._rooms.get(room, {}).items()]
+                for room in dirty
+            }
+
+    def flush(self):
+        """Emit a digest to every room whose typists changed. Returns the number of digests sent."""
+        digests = self._take_digests(self.clock())
+        for room, typists in digests.items():
+            socketio.emit('user_typing', {
+                'room': room,
+                'typing': [{'user_id': user_id, 'user_name': user_name} for user_id, user_name in typists]
+            }, to=conversation_rooms(room))
+        return len(digests)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            self.flush()
+
+class RedisTypingAggregator(TypingAggregator):
+    """TypingAggregator whose state is shared by all workers through Redis.
+
+    Each room is a hash of user id to name and expiry. Rooms with typists and
+    rooms with changes are kept in two sets; whichever worker flushes first
+    takes the dirty set, so each change produces one digest across workers.
+    """
+
+    ROOM_KEY = 'prochat:typing:room:{}'
+    ROOMS_KEY = 'prochat:typing:rooms'
+    DIRTY_KEY = 'prochat:typing:dirty'
+
+    # Expiries are compared across workers, which do not share a monotonic clock
+    clock = staticmethod(time.time)
+
+    def __init__(self, url, interval=0.5, ttl=6):
+        import redis
+        super().__init__(interval=interval, ttl=ttl)
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def _start_typing(self, room, user_id, user_name, expires_at):
+        entry = json.dumps([user_name, expires_at])
+        if self._redis.hset(self.ROOM_KEY.format(room), user_id, entry):
+            pipe = self._redis.pipeline()
+            pipe.sadd(self.ROOMS_KEY, room)
+            pipe.sadd(self.DIRTY_KEY, room)
+            pipe.execute()
+
+    def _stop_typing(self, room, user_id):
+        if self._redis.hdel(self.ROOM_KEY.format(room), user_id):
+            self._redis.sadd(self.DIRTY_KEY, room)
+
+    def _typists(self, room):
+        return {
+            int(user_id): json.loads(entry)
+            for user_id, entry in self._redis.hgetall(self.ROOM_KEY.format(room)).items()
+        }
+
+    def _take_digests(self, now):
+        for room in self._redis.smembers(self.ROOMS_KEY):
+            typists = self._typists(room)
+            expired = [user_id for user_id, (_, expires_at) in typists.items() if expires_at <= now]
+            if expired and self._redis.hdel(self.ROOM_KEY.format(room), *expired):
+                self._redis.sadd(self.DIRTY_KEY, room)
+            if not self._redis.hlen(self.ROOM_KEY.format(room)):
+                self._redis.srem(self.ROOMS_KEY, room)
+
+        pipe = self._redis.pipeline()
+        pipe.smembers(self.DIRTY_KEY)
+        pipe.delete(self.DIRTY_KEY)
+        dirty, _ = pipe.execute()
+        return {
+            room: [(user_id, user_name) for user_id, (user_name, _) in self._typists(room).items()]
+            for room in dirty
+        }
+
+if app.config['REDIS_URL']:
+    typing_aggregator = RedisTypingAggregator(
+        app.config['REDIS_URL'],
+        interval=app.config['TYPING_DIGEST_INTERVAL'],
+        ttl=app.config['TYPING_TTL']
+    )
+else:
+    typing_aggregator = TypingAggregator(
+        interval=app.config['TYPING_DIGEST_INTERVAL'],
+        ttl=app.config['TYPING_TTL']
+    )
@@ -0,0 +1,292 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+
+from app import app
+from media_store import store_file
+
+# Bytes read from the request body per iteration; bounds memory per upload
+UPLOAD_BUFFER_SIZE = 64 * 1024
+# Seconds an upload lock outlives a worker that stopped refreshing it, see RedisUploadLocks
+UPLOAD_LOCK_TTL = 60
+
+class HashingFile:
+    """Write-only file that hashes and counts bytes as they are written.
+
+    Used both as the multipart stream factory and for resumable chunks, so
+    the content hash is known as soon as the last byte lands on disk.
+    """
+
+    def __init__(self, path, mode='wb', hasher=None, size=0, max_size=None):
+        self.path = path
+        self.hasher = hasher or hashlib.sha256()
+        self.size = size
+        self.max_size = max_size
+        self._file = open(path, mode)
+
+    def write(self, data):
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            raise RequestEntityTooLarge()
+        self._file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def seek(self, *args):
+        # The multipart parser rewinds finished files; the data is already on disk
+        return 0
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+def _temp_path(name):
+    return os.path.join(app.config['UPLOAD_TMP_FOLDER'], name)
+
+def parse_streamed_upload(environ, max_size):
+    """Parse a multipart attachment upload straight to a temp file.
+
+    Returns (form, files, hashing_files). Each file part is written and hashed
+    in UPLOAD_BUFFER_SIZE pieces, so memory does not grow with the file size.
+    """
+    written = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        stream = HashingFile(_temp_path(f"{uuid.uuid4().hex}.part"), max_size=max_size)
+        written.append(stream)
+        return stream
+
+    try:
+        _, form, files = parse_form_data(environ, stream_factory=stream_factory,
+                                         max_content_length=max_size + UPLOAD_BUFFER_SIZE)
+    except Exception:
+        discard_files(written)
+        raise
+    for stream in written:
+        stream.close()
+    return form, files, written
+
+def discard_files(streams):
+    for stream in streams:
+        stream.close()
+        if os.path.exists(stream.path):
+            os.remove(stream.path)
+
+class UploadLocks:
+    """Uploads that have a chunk being written, so chunks of one upload are appended one at a time."""
+
+    def __init__(self):
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, upload_id):
+        """Return a token for release() and refresh(), or None if the upload is locked."""
+        with self._lock:
+            if upload_id in self._held:
+                return None
+            self._held.add(upload_id)
+            return upload_id
+
+    def refresh(self, upload_id, token):
+        """Keep a held lock alive; False if it was lost."""
+        return True
+
+    def release(self, upload_id, token):
+        with self._lock:
+            self._held.discard(upload_id)
+
+class RedisUploadLocks(UploadLocks):
+    """UploadLocks shared by all workers, so chunks sent to different workers cannot interleave.
+
+    Each lock is a key set with NX that expires after ttl seconds, in case its
+    worker dies mid-chunk; the writer refreshes it while the chunk streams in.
+    Refresh and release only touch the key while it still holds their token.
+    """
+
+    KEY = 'prochat:upload-lock:{}'
+    REFRESH_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+    )
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url, ttl=UPLOAD_LOCK_TTL):
+        import redis
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+
+    def acquire(self, upload_id):
+        token = uuid.uuid4().hex
+        if not self._redis.set(self.KEY.format(upload_id), token, nx=True, ex=self.ttl):
+            return None
+        return token
+
+    def refresh(self, upload_id, token):
+        return bool(self._redis.eval(self.REFRESH_SCRIPT, 1, self.KEY.format(upload_id), token, self.ttl))
+
+    def release(self, upload_id, token):
+        self._redis.eval(self.RELEASE_SCRIPT, 1, self.KEY.format(upload_id), token)
+
+if app.config['REDIS_URL']:
+    upload_locks = RedisUploadLocks(app.config['REDIS_URL'])
+else:
+    upload_locks = UploadLocks()
+
+class UploadSession:
+    """A resumable upload, in the spirit of the tus protocol.
+
+    The client declares the file up front, then appends chunks at the current
+    offset until the declared size is reached. State lives next to the partial
+    file in UPLOAD_TMP_FOLDER, so any worker can continue a session and the
+    offset survives restarts. Chunks are appended under upload_locks, so two
+    requests for the same upload never write at once, even on different
+    workers. The running hash is kept in process; a worker that did not see
+    the previous chunks rehashes the partial file once.
+    """
+
+    _hashers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, upload_id, meta):
+        self.upload_id = upload_id
+        self.meta = meta
+
+    @property
+    def data_path(self):
+        return _temp_path(f"{self.upload_id}.part")
+
+    @property
+    def meta_path(self):
+        return _temp_path(f"{self.upload_id}.json")
+
+    @property
+    def offset(self):
+        return os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+
+    @property
+    def size(self):
+        return self.meta['size']
+
+    @property
+    def is_complete(self):
+        return self.offset >= self.size
+
+    @classmethod
+    def create(cls, user_id, filename, size, **target):
+        session = cls(uuid.uuid4().hex, dict(target, user_id=user_id, filename=filename,
+                                             size=size, created_at=time.time()))
+        with open(session.meta_path, 'w') as f:
+            json.dump(session.meta, f)
+        open(session.data_path, 'wb').close()
+        return session
+
+    @classmethod
+    def load(cls, upload_id, user_id):
+        """Return the session if it exists and belongs to user_id, else None."""
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(_temp_path(f"{upload_id}.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(upload_id, meta) if meta.get('user_id') == user_id else None
+
+    def _hasher_at(self, offset):
+        cached = self._hashers.pop(self.upload_id, None)
+        if cached and cached[0] == offset:
+            return cached[1]
+        hasher = hashlib.sha256()
+        with open(self.data_path, 'rb') as f:
+            for block in iter(lambda: f.read(UPLOAD_BUFFER_SIZE), b''):
+                hasher.update(block)
+        return hasher
+
+    def append(self, stream, offset, max_chunk_size):
+        """Append a request body at offset.
+
+        Returns the new offset, or None if offset is not the current offset,
+        the upload is already complete, or another chunk is still being
+        written. Only the request that writes the last byte sees the upload
+        complete, so an upload is finished once.
+        """
+        token = upload_locks.acquire(self.upload_id)
+        if token is None:
+            return None
+        try:
+            # Checked under the lock, so the offset cannot move until the chunk is written
+            if offset != self.offset or self.is_complete:
+                return None
+            with self._lock:
+                hasher = self._hasher_at(offset)
+
+            target = HashingFile(self.data_path, 'ab', hasher=hasher, size=offset, max_size=self.size)
+            refreshed_at = time.monotonic()
+            try:
+                received = 0
+                while received < max_chunk_size:
+                    block = stream.read(min(UPLOAD_BUFFER_SIZE, max_chunk_size - received))
+                    if not block:
+                        break
+                    if time.monotonic() - refreshed_at > UPLOAD_LOCK_TTL / 3:
+                        if not upload_locks.refresh(self.upload_id, token):
+                            break  # The lock expired, so another chunk may be written from here on
+                        refreshed_at = time.monotonic()
+                    target.write(block)
+                    received += len(block)
+            finally:
+                target.close()
+                with self._lock:
+                    self._hashers[self.upload_id] = (target.size, hasher)
+            return target.size
+        finally:
+            upload_locks.release(self.upload_id, token)
+
+    @property
+    def hexdigest(self):
+        return self._hasher_at(self.offset).hexdigest()
+
+    def finish(self):
+        """Add the completed file to the media store. Returns (media key, file_hash)."""
+        file_hash = self.hexdigest
+        key = store_file(self.data_path, self.meta['filename'], file_hash, self.size)
+        self.discard()
+        return key, file_hash
+
+    def discard(self):
+        with self._lock:
+            self._hashers.pop(self.upload_id, None)
+        for path in (self.data_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def cleanup_stale_uploads(max_age=None):
+    """Delete partial uploads idle for more than max_age seconds (UPLOAD_SESSION_TTL by default)."""
+    max_age = app.config['UPLOAD_SESSION_TTL'] if max_age is None else max_age
+    folder = app.config['UPLOAD_TMP_FOLDER']
+
+    # A session's last activity is its newest file: chunks touch the .part file
+    last_activity = {}
+    for name in os.listdir(folder):
+        stem = os.path.splitext(name)[0]
+        last_activity[stem] = max(last_activity.get(stem, 0), os.path.getmtime(os.path.join(folder, name)))
+
+    removed = 0
+    cutoff = time.time() - max_age
+    for stem, mtime in last_activity.items():
+        if mtime >= cutoff:
+            continue
+        for ext in ('.part', '.json'):
+            path = os.path.join(folder, stem + ext)
+            if os.path.exists(path):
+                os.remove(path)
+        removed += 1
+    return removed
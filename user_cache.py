@@ -0,0 +1,127 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask_login import UserMixin
+from sqlalchemy import event
+
+from app import app, db
+from models import User
+
+# User fields kept in the identity cache; anything else is loaded from the database on access
+CACHED_FIELDS = ('id', 'username', 'first_name', 'last_name', 'email', 'profile_image_url',
+                 'is_admin', 'read_receipts', 'is_online', 'last_seen')
+
+def _snapshot(user):
+    data = {field: getattr(user, field) for field in CACHED_FIELDS}
+    data['last_seen'] = user.last_seen.isoformat() if user.last_seen else None
+    return data
+
+class CachedUser(UserMixin):
+    """Lightweight current_user built from the identity cache.
+
+    Cached fields are served without a query. Reading any other attribute, or
+    assigning one, loads the real User row for the rest of the request and
+    invalidates the cache entry.
+    """
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_user', None)
+
+    def _load(self):
+        if self._user is None:
+            object.__setattr__(self, '_user', db.session.get(User, self._data['id']))
+        return self._user
+
+    def __getattr__(self, name):
+        data = object.__getattribute__(self, '_data')
+        if name in data:
+            if name == 'last_seen' and data[name]:
+                return datetime.fromisoformat(data[name])
+            return data[name]
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+        data = object.__getattribute__(self, '_data')
+        if name in data:
+            data[name] = value.isoformat() if isinstance(value, datetime) else value
+        user_cache.invalidate(data['id'])
+
+    def get_display_name(self):
+        return User.get_display_name(self)
+
+class UserCache:
+    """In-process LRU of user snapshots with a short TTL."""
+
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return dict(data)
+
+    def set(self, user_id, data):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, data)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+class RedisUserCache(UserCache):
+    """UserCache shared by all workers, so invalidations are seen everywhere."""
+
+    KEY = 'prochat:user:{}'
+
+    def __init__(self, url, ttl=30):
+        import redis
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, user_id):
+        raw = self._redis.get(self.KEY.format(user_id))
+        return json.loads(raw) if raw else None
+
+    def set(self, user_id, data):
+        self._redis.setex(self.KEY.format(user_id), self.ttl, json.dumps(data))
+
+    def invalidate(self, user_id):
+        self._redis.delete(self.KEY.format(user_id))
+
+if app.config['REDIS_URL']:
+    user_cache = RedisUserCache(app.config['REDIS_URL'], ttl=app.config['USER_CACHE_TTL'])
+else:
+    user_cache = UserCache(ttl=app.config['USER_CACHE_TTL'])
+
+def load_cached_user(user_id):
+    """Return a CachedUser for user_id, querying the database only on a cache miss."""
+    data = user_cache.get(user_id)
+    if data is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        data = _snapshot(user)
+        user_cache.set(user_id, data)
+    return CachedUser(data)
+
+@event.listens_for(User, 'after_update')
+def invalidate_updated_user(mapper, connection, user):
+    user_cache.invalidate(user.id)
@@ -1,7 +1,4 @@
 import os
-import uuid
-from werkzeug.utils import secure_filename
-from flask import current_app
 
 ALLOWED_EXTENSIONS = {
     'image': {'png', 'jpg', 'jpeg', 'gif', 'webp'},
@@ -15,25 +12,11 @@ def allowed_file(filename, file_type='image'):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS.get(file_type, ALLOWED_EXTENSIONS['image'])
 
-def save_uploaded_file(file, subfolder=''):
-    """Save an uploaded file to the uploads directory."""
-    if file and allowed_file(file.filename):
-        # Generate unique filename
-        filename = secure_filename(file.filename)
-        name, ext = os.path.splitext(filename)
-        unique_filename = f"{name}_{uuid.uuid4().hex[:8]}{ext}"
-        
-        # Create subfolder if it doesn't exist
-        upload_path = current_app.config['UPLOAD_FOLDER']
-        if subfolder:
-            upload_path = os.path.join(upload_path, subfolder)
-            os.makedirs(upload_path, exist_ok=True)
-        
-        # Save file
-        file_path = os.path.join(upload_path, unique_filename)
-        file.save(file_path)
-        
-        return unique_filename
+def attachment_type(filename):
+    """Message type (image, document, video or audio) for an attachment, or None if not allowed."""
+    for file_type in ('image', 'video', 'audio', 'document'):
+        if allowed_file(filename, file_type):
+            return file_type
     return None
 
 def format_timestamp(timestamp):
@@ -56,6 +39,20 @@ def format_timestamp(timestamp):
     else:
         return "Just now"
 
+def encode_cursor(timestamp, item_id):
+    """Encode a (timestamp, id) keyset position as an opaque cursor string."""
+    return f"{timestamp.isoformat()}_{item_id}"
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor. Returns None if it is malformed."""
+    from datetime import datetime
+    
+    try:
+        timestamp, item_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
 def get_file_size_mb(file_path):
     """Get file size in MB."""
     try:
@@ -0,0 +1,76 @@
+"""Image processing for the media store, see media_store.py.
+
+Nothing here imports the app, so the spawned variant workers that run
+render_image_variants only load Pillow.
+"""
+import io
+import os
+
+# Formats whose metadata strip_image_metadata removes, by Pillow format name
+STRIPPED_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+def render_image_variants(source_path, sizes, formats=('webp', 'jpg')):
+    """Resize an image to each size (longest side, never upscaled) in each format.
+
+    Returns a list of (size, format, bytes). Orientation from EXIF is applied
+    and no metadata is written to the variants.
+    """
+    from PIL import Image, ImageOps
+
+    variants = []
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+        for size in sorted(sizes, reverse=True):
+            image.thumbnail((size, size), Image.LANCZOS)
+            for fmt in formats:
+                output = io.BytesIO()
+                if fmt == 'webp':
+                    image.save(output, 'WEBP', quality=80, method=4)
+                else:
+                    flat = image
+                    if has_alpha:
+                        flat = Image.new('RGB', image.size, (255, 255, 255))
+                        flat.paste(image, mask=image.getchannel('A'))
+                    flat.save(output, 'JPEG', quality=82, optimize=True, progressive=True)
+                variants.append((size, fmt, output.getvalue()))
+    return variants
+
+def strip_image_metadata(path):
+    """Rewrite a JPEG, PNG or WebP file in place without EXIF, XMP and text metadata.
+
+    The EXIF orientation is applied to the pixels first, so the image still
+    displays the right way up; the color profile is kept. JPEGs that need no
+    rotation keep their quantization tables, so they are not visibly
+    recompressed. Returns False, leaving the file alone, if it is not a
+    readable image of those formats.
+    """
+    from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(path) as image:
+            fmt = image.format
+            if fmt not in STRIPPED_FORMATS:
+                return False
+            # Only what is passed here is written; Pillow does not copy EXIF or text chunks by itself
+            options = {'icc_profile': image.info.get('icc_profile')}
+            if getattr(image, 'n_frames', 1) > 1:
+                options['save_all'] = True
+            elif fmt == 'JPEG' and image.getexif().get(ExifTags.Base.Orientation, 1) == 1:
+                options['quality'] = 'keep'
+            else:
+                image = ImageOps.exif_transpose(image)
+                if fmt in ('JPEG', 'WEBP'):
+                    options['quality'] = 95
+            output = io.BytesIO()
+            image.save(output, fmt, **options)
+    except (UnidentifiedImageError, OSError):
+        return False
+
+    temp_path = path + '.stripped'
+    with open(temp_path, 'wb') as f:
+        f.write(output.getvalue())
+    os.replace(temp_path, path)
+    return True
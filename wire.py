@@ -0,0 +1,66 @@
+from datetime import timezone
+
+from app import app
+from models import User
+
+# Short keys of compact new_message and sync_messages payloads, see message_event()
+COMPACT_MESSAGE_FIELDS = (
+    ('i', 'id'),
+    ('c', 'content'),
+    ('s', 'sender_id'),
+    ('r', 'recipient_id'),
+    ('g', 'group_id'),
+    ('y', 'message_type'),
+    ('f', 'file_url'),
+    ('n', 'file_name'),
+    ('z', 'file_size'),
+)
+
+def compact_events():
+    return app.config['SOCKET_COMPACT_EVENTS']
+
+def epoch_ms(value):
+    """Integer milliseconds since the epoch for a naive UTC datetime, or None."""
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000) if value else None
+
+def message_event(message, sender=None):
+    """Payload of new_message and sync_messages entries for a message.
+
+    The compact form uses short keys, omits empty fields and sends the
+    timestamp as epoch milliseconds. It carries no sender name or image; the
+    client resolves sender_id from its user directory (/api/users/directory).
+    """
+    if not compact_events():
+        return message.to_dict(sender)
+    data = {key: getattr(message, field) for key, field in COMPACT_MESSAGE_FIELDS}
+    data = {key: value for key, value in data.items() if value not in (None, '')}
+    data['t'] = epoch_ms(message.timestamp)
+    if data.get('y') == 'text':
+        del data['y']
+    return data
+
+def status_event(user_id, online, last_seen=None):
+    if compact_events():
+        data = {'u': user_id, 'o': int(online)}
+        if last_seen:
+            data['l'] = epoch_ms(last_seen)
+        return data
+    data = {'user_id': user_id, 'status': 'online' if online else 'offline'}
+    if last_seen:
+        data['last_seen'] = last_seen.isoformat()
+    return data
+
+def online_users_event(user_ids):
+    """Payload of online_users; the compact form is only the ids, so no users are loaded."""
+    if compact_events():
+        return {'u': sorted(user_ids)}
+    users = User.query.filter(User.id.in_(user_ids)).all() if user_ids else []
+    return {
+        'users': [
+            {
+                'id': user.id,
+                'name': user.get_display_name(),
+                'image': user.profile_image_url
+            } for user in users
+        ]
+    }